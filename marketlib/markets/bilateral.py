@@ -12,16 +12,31 @@ class BilateralMarket(mar.Market):
             The matching mechanism used by the market.
         bargain_method (function):
             The bargain procedure used by each pair of participants.
+        sparse (bool):
+            Whether buyers are only matched with sellers whose average ask
+            is not above their average bid (see general.candidate_graph()).
+        top_k (int):
+            If not None and sparse is True, the number of candidate sellers 
+            kept for each buyer, by utility.
     """
 
-    def __init__(self, matching_type="random", bargain_type="middle"):
+    def __init__(self, matching_type="random", bargain_type="middle", sparse=False, top_k=None):
         """A bilateral market.
 
         Args:
             matching_type (str, optional): 
-                The name of the matching method. Defaults to "random".
+                The name of the matching method. Defaults to "random". With
+                "transport", participants trade with several partners, up 
+                to their volumes (see matching.transport_matching()).
             bargain_type (str, optional): 
                 The name of the bargaining method. Defaults to "middle".
+            sparse (bool, optional):
+                If True, the stable, maximum, greedy and transport matching 
+                methods only consider the buyer-seller pairs that may trade, 
+                which scales to large markets. Defaults to False.
+            top_k (int, optional):
+                With sparse=True, the number of candidate sellers per buyer.
+                Defaults to all of them.
 
         Raises:
             ValueError: The matching method or bargaining method dose not exist.
@@ -37,6 +52,8 @@ class BilateralMarket(mar.Market):
         
         self.matching_method = match.MATCHING_METHODS[matching_type]
         self.bargain_method = bar.BARGAIN_METHODS[bargain_type]
+        self.sparse = sparse
+        self.top_k = top_k
 
     def clearing(self):
         """ Market clearing.
@@ -0,0 +1,363 @@
+""" A continuous market with a limit orderbook.
+"""
+
+import heapq
+from collections import deque
+import numpy as np
+import pandas as pd
+from marketlib.markets import market as mar
+from marketlib.markets import orderbook as ob
+from marketlib.utils import allocation as alloc
+
+class ContinuousMarket(mar.Market):
+    """ A continuous market where orders are matched as soon as they arrive.
+
+    Each incoming bid (ask) is matched against the resting asks (bids) with
+    price-time priority: best price first, then the earliest order at that
+    price. Trades happen at the price of the resting order. Whatever is left
+    of the incoming order rests in the book.
+
+    Price levels are kept in two heaps (max-heap for bids, min-heap for
+    asks), each level is a FIFO queue of orders. The matching engine does
+    not touch self.book: it is rebuilt from the resting orders when it is
+    read after a change, so show() and plot() work as for other markets.
+
+    Attributes:
+        fills (list):
+            All trades so far, as tuples of the form
+            (buyer, seller, units, price, bid order id, ask order id).
+            The order id of an incoming order that is fully filled is None.
+        on_fill (function):
+            Called with each trade tuple as it happens, if not None.
+    """
+
+    def __init__(self, on_fill=None):
+        """ A continuous market.
+
+        Args:
+            on_fill (function, optional):
+                Called with each trade tuple (buyer, seller, units, price,
+                bid order id, ask order id) as it happens.
+        """
+
+        super().__init__()
+
+        self.fills = []
+        self.on_fill = on_fill
+
+        # Heaps of price levels. Bid prices are negated for a max-heap.
+        self._heaps = ([], [])
+
+        # {price : deque of resting orders}, one dict per side. A resting
+        # order is a list [order id, remaining units, user id].
+        self._queues = ({}, {})
+
+        # {order id : (resting order, type code, price)}. Ids increase, so
+        # the dict is ordered by id.
+        self._resting = {}
+        self._next_id = 0
+
+        # Whether self.book is behind the resting orders.
+        self._stale = False
+
+        # {user id : utility of their trades}, one dict per side. Trades 
+        # happen at the resting price, so only the incoming order gains.
+        self._welfare = ({}, {})
+
+    @property
+    def book(self):
+        """ The resting orders as an orderbook, rebuilt on read if they changed.
+        """
+
+        if self._stale:
+            self._book = self._build_book()
+            self._stale = False
+
+        return self._book
+
+    @book.setter
+    def book(self, book):
+        self._book = book
+
+    def _build_book(self):
+        """ An orderbook with the resting orders, indexed by their order ids.
+        """
+
+        resting = [(entry, type_code, price) for entry, type_code, price in self._resting.values() 
+                   if entry[1] > 0]
+
+        cols = {
+            'Unit' : [entry[1] for entry, _, _ in resting],
+            'Price' : [price for _, _, price in resting],
+            'Type' : [type_code for _, type_code, _ in resting],
+            'User' : [entry[2] for entry, _, _ in resting],
+            'ID' : [entry[0] for entry, _, _ in resting],
+            'Alive' : [True] * len(resting)
+        }
+        cols = {name : np.array(col, dtype=ob._OrderBook.col_dtypes[name]) for name, col in cols.items()}
+
+        book = ob._OrderBook._from_columns(cols)
+        book._next_id = self._next_id
+
+        return book
+
+    # ------------------
+    #   Submit orders  -
+    # ------------------
+    def bid(self, unit : float, price : float, user_id : int):
+        """ Submit a bid, matched immediately against the resting asks.
+
+        Args:
+            unit (float):
+                Number of units for this bid
+            price (float):
+                Bid (per-unit) price
+            user_id (int):
+                Corresponding user id
+
+        Returns:
+            The id of the resting order, or None if the bid was fully filled.
+        """
+        return self._submit(ob.BID, unit, price, user_id)
+
+    def ask(self, unit : float, price : float, user_id : int):
+        """ Submit an ask, matched immediately against the resting bids.
+
+        Args:
+            unit (float):
+                Number of units for this ask
+            price (float):
+                Ask (per-unit) price
+            user_id (int):
+                Corresponding user id
+
+        Returns:
+            The id of the resting order, or None if the ask was fully filled.
+        """
+        return self._submit(ob.ASK, unit, price, user_id)
+
+    def add_orders(self, side : str, orders=None, unit=None, price=None, user_id=None):
+        """ Submit a collection of bids or asks, matched one after another in the given order.
+
+        Args:
+            side (str):
+                Either "bid" or "ask".
+            orders (optional):
+                A dataframe with columns Unit, Price, User; a 2-D array of rows
+                [unit, price, user_id]; or an iterable of (unit, price, user_id) tuples.
+            unit, price, user_id (array-like, optional):
+                Columns of the orders. Used when orders is not given.
+
+        Returns:
+            A list with the id of the resting order (or None) of each submitted order.
+        """
+
+        if side not in ob.TYPES:
+            raise ValueError(f"Invalid order type: {side}")
+
+        if orders is not None:
+            unit, price, user_id = self._book._to_columns(orders)
+
+        type_code = ob.TYPES.index(side)
+        submit = self._submit
+
+        return [submit(type_code, u, p, i)
+                for u, p, i in zip(list(unit), list(price), list(user_id))]
+
+    # -------------------
+    #   Matching engine  -
+    # -------------------
+    def _submit(self, type_code, unit, price, user_id):
+        """ Match an incoming order against the other side, then rest what is left.
+
+        Returns:
+            The id of the resting order, or None if the order was fully filled.
+        """
+
+        unit, price = float(unit), float(price)
+
+        other = 1 - type_code
+        heap, queues = self._heaps[other], self._queues[other]
+        sign = -1 if other == ob.BID else 1
+        self._stale = True
+
+        while unit > 0 and heap:
+            best = sign * heap[0]
+
+            # Stop once the best resting price does not cross.
+            if (price < best) if type_code == ob.BID else (price > best):
+                break
+
+            queue = queues.get(best)
+            if not queue:
+                # Stale heap entry of a level that was emptied.
+                heapq.heappop(heap)
+                queues.pop(best, None)
+                continue
+
+            resting = queue[0]
+            order_id, remaining, resting_user = resting
+
+            if remaining <= 0:  # Cancelled order
+                queue.popleft()
+                continue
+
+            traded = min(unit, remaining)
+            unit -= traded
+            resting[1] = remaining - traded
+
+            if type_code == ob.BID:
+                fill = (user_id, resting_user, traded, best, None, order_id)
+            else:
+                fill = (resting_user, user_id, traded, best, order_id, None)
+
+            self.fills.append(fill)
+
+            gain = (price - best if type_code == ob.BID else best - price) * traded
+            welfare = self._welfare[type_code]
+            welfare[user_id] = welfare.get(user_id, 0) + gain
+            if self.on_fill is not None:
+                self.on_fill(fill)
+
+            if resting[1] <= 0:
+                queue.popleft()
+                del self._resting[order_id]
+
+        if unit <= 0:
+            return None
+
+        # Rest the remaining units.
+        order_id = self._next_id
+        self._next_id += 1
+        resting = [order_id, unit, user_id]
+
+        queues = self._queues[type_code]
+        if price not in queues:
+            queues[price] = deque()
+            heapq.heappush(self._heaps[type_code], -price if type_code == ob.BID else price)
+        queues[price].append(resting)
+
+        self._resting[order_id] = (resting, type_code, price)
+
+        return order_id
+
+    def cancel(self, order_id : int):
+        """ Cancel a resting order.
+
+        The order is only marked as cancelled in its queue, and skipped
+        when it reaches the front.
+
+        Args:
+            order_id (int):
+                The id returned when the order was submitted.
+
+        Raises:
+            ValueError: There is no resting order with this id.
+        """
+
+        if order_id not in self._resting:
+            raise ValueError(f"Invalid order id: {order_id}")
+
+        resting, _, _ = self._resting.pop(order_id)
+        resting[1] = 0
+        self._stale = True
+
+    def modify(self, order_id : int, unit : float = None, price : float = None):
+        """ Change a resting order.
+
+        Reducing the units keeps the time priority of the order. Any other
+        change cancels the order and submits a new one, which may trade at once.
+
+        Args:
+            order_id (int):
+                The id returned when the order was submitted.
+            unit (float, optional):
+                The new number of units.
+            price (float, optional):
+                The new per-unit price.
+
+        Returns:
+            The id of the order, which is new unless only the units were reduced.
+
+        Raises:
+            ValueError: There is no resting order with this id.
+        """
+
+        if order_id not in self._resting:
+            raise ValueError(f"Invalid order id: {order_id}")
+
+        resting, type_code, old_price = self._resting[order_id]
+
+        if (price is None or price == old_price) and unit is not None and 0 < unit <= resting[1]:
+            resting[1] = unit
+            self._stale = True
+            return order_id
+
+        user_id = resting[2]
+        new_unit = resting[1] if unit is None else unit
+        new_price = old_price if price is None else price
+
+        self.cancel(order_id)
+        return self._submit(type_code, new_unit, new_price, user_id)
+
+    # --------------
+    #   Clearing   -
+    # --------------
+    def trades(self):
+        """ All trades so far.
+
+        Returns:
+            A dataframe with columns "Buyer" | "Seller" | "Units" | "Price" | "Bid ID" | "Ask ID".
+        """
+
+        return pd.DataFrame(self.fills, columns=["Buyer", "Seller", "Units", "Price", "Bid ID", "Ask ID"])
+
+    # @override
+    def clearing(self):
+        """ Summarize the trades so far per user.
+
+        Trades already happened when the orders arrived. alloc_buyer and
+        alloc_seller are set to the total units of each user, their
+        volume-weighted average price and the utility of their trades.
+        """
+
+        trades = np.array([fill[:4] for fill in self.fills], dtype=np.float64).reshape(-1, 4)
+
+        for type_code, side, attr in [(ob.BID, "buyer", "alloc_buyer"), (ob.ASK, "seller", "alloc_seller")]:
+            users, units, prices = ob.group_by_user(trades[:, type_code].astype(np.int64), 
+                                                    trades[:, 2], trades[:, 3])
+            welfare = [self._welfare[type_code].get(user, 0) for user in users.tolist()]
+
+            setattr(self, attr, alloc.AllocationResult(side, users, units, prices, welfare))
+
+if __name__ == "__main__":  # python3 -m marketlib.markets.continuous
+    M = ContinuousMarket(on_fill=print)
+
+    M.ask(10, 1, 0)
+    M.ask(5, 1.5, 1)
+    M.bid(12, 2, 3)   # Takes 10 units at 1 and 2 units at 1.5
+    M.bid(10, 1.2, 4) # Rests in the book
+    M.ask(4, 1, 2)    # Sells 4 units at 1.2
+
+    M.show()
+    M.clearing()
+
+    print(M.alloc_buyer)
+    print(M.alloc_seller)
+
+    """
+    (3, 0, 10.0, 1.0, None, 0)
+    (3, 1, 2.0, 1.5, None, 1)
+    (4, 2, 4.0, 1.2, 2, None)
+       Unit  Price Type  User
+    1   3.0    1.5  ask     1
+    2   6.0    1.2  bid     4
+
+       User  Units Bought  Price
+    0     3          12.0   1.083333
+    1     4           4.0   1.200000
+       User  Units Sold  Price
+    0     0         10.0    1.0
+    1     1          2.0    1.5
+    2     2          4.0    1.2
+    """
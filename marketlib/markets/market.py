@@ -3,8 +3,8 @@
 
 from marketlib.markets import orderbook as ob
 from marketlib.utils import allocation as alloc
+from marketlib.utils import snapshot
 from abc import abstractmethod
-import pandas as pd
 
 class Market():
     """ The base market class.
@@ -14,15 +14,16 @@ class Market():
             Tracks all active bids and asks.
         divisible (bool, default=True): 
             If goods are divisible, fractional assignments are allowed.
-        alloc_buyer (Dataframe):
-            Stores results for buyers after market clearing.
-        alloc_seller (Dataframe):
+        alloc_buyer (AllocationResult):
+            Stores results for buyers after market clearing. Call 
+            to_frame() for a dataframe.
+        alloc_seller (AllocationResult):
             Stores results for sellers after market clearing.
         alloc_method (function, default=UNIFORM):
             The allocation method used by the market. 
     """
 
-    def __init__(self, alloc_type: str="uniform", divisible: bool=True):
+    def __init__(self, alloc_type: str="uniform", divisible: bool=True, storage: str=None):
         """ A market instance.
 
         Args:
@@ -30,6 +31,9 @@ class Market():
                 The name of the allocation method used after computing a clearing price.
             divisible (bool, optional): 
                 If goods are divisible, fractional assignments are allowed. 
+            storage (str, optional): 
+                A directory for an out-of-core orderbook whose columns are 
+                memory-mapped files. By default the orderbook is held in memory.
 
         Raises:
             ValueError: The allocation method dose not exist.
@@ -37,13 +41,16 @@ class Market():
 
         # An OrderBook instance has the following four columns: 1. "Unit", 
         # 2. "Price", 3. "Type", and 4. "User".
-        self.book = ob._OrderBook()
+        if storage is None:
+            self.book = ob._OrderBook()
+        else:
+            self.book = ob._MemmapOrderBook(storage)
         self.divisible = divisible
         
         # Placeholders to later store results after clearing.
         # Units bought and sold for a user can be zero
-        self.alloc_buyer = pd.DataFrame(columns=["User", "Units Bought", "Price"])
-        self.alloc_seller = pd.DataFrame(columns=["User", "Units Sold", "Price"])
+        self.alloc_buyer = alloc.AllocationResult("buyer")
+        self.alloc_seller = alloc.AllocationResult("seller")
 
         # Currently, four allocation methods are implemented: 1. "uniform", 
         # 2. "price", 3. "welfare", and 4. "proportional".
@@ -67,18 +74,31 @@ class Market():
                 Bid (per-unit) price
             user_id (int): 
                 Corresponding user id
+
+        Returns:
+            The id of the new order.
         """
 
-        self.book.add_bid(unit, price, user_id)
+        return self.book._add_bid(unit, price, user_id)
     
-    def bid_csv(self, input_path : str):
+    def bid_csv(self, input_path : str, chunksize : int = ob.CSV_CHUNKSIZE, verbose : bool = False):
         """ Add a collection of bids to the orderbook.
 
         Args:
             input_path (str): 
                 Path to the .csv file. Columns: Unit, Price, User
+            chunksize (int, optional): 
+                Number of rows parsed at a time.
+            verbose (bool, optional): 
+                If True, print the loading throughput.
+
+        Raises:
+            ValueError: The header of the file does not match the columns Unit, Price, User.
+
+        Returns:
+            The number of bids loaded.
         """
-        self.book.add_bid_csv(input_path)
+        return ob.load_csv(input_path, 'bid', self.add_orders, chunksize, verbose)
 
     def ask(
         self,
@@ -95,18 +115,101 @@ class Market():
                 Ask (per-unit) price
             user_id (int): 
                 Corresponding user id
+
+        Returns:
+            The id of the new order.
         """ 
-        self.book.add_ask(unit, price, user_id)
+        return self.book._add_ask(unit, price, user_id)
     
-    def ask_csv(self, input_path : str):
+    def ask_csv(self, input_path : str, chunksize : int = ob.CSV_CHUNKSIZE, verbose : bool = False):
         """ Add a collection of asks to the orderbook.
 
         Args:
             input_path (str): 
                 path to the .csv file. Columns: Unit, Price, User
+            chunksize (int, optional): 
+                Number of rows parsed at a time.
+            verbose (bool, optional): 
+                If True, print the loading throughput.
+
+        Raises:
+            ValueError: The header of the file does not match the columns Unit, Price, User.
+
+        Returns:
+            The number of asks loaded.
         """
-        self.book.add_ask_csv(input_path)
+        return ob.load_csv(input_path, 'ask', self.add_orders, chunksize, verbose)
     
+    def add_orders(
+        self,
+        side : str,
+        orders=None,
+        unit=None,
+        price=None,
+        user_id=None
+    ):
+        """ Add a collection of bids or asks to the orderbook in one pass.
+
+        Args:
+            side (str): 
+                Either "bid" or "ask".
+            orders (optional): 
+                A dataframe with columns Unit, Price, User; a 2-D array of rows 
+                [unit, price, user_id]; or an iterable of (unit, price, user_id) tuples.
+            unit (array-like, optional): 
+                Number of units of each order. Used when orders is not given.
+            price (array-like, optional): 
+                Per-unit price of each order. Used when orders is not given.
+            user_id (array-like, optional): 
+                Corresponding user ids. Used when orders is not given.
+
+        Returns:
+            An array with the ids of the new orders.
+        """
+        return self.book.add_orders(side, orders, unit=unit, price=price, user_id=user_id)
+
+    def cancel(self, order_id : int):
+        """ Cancel an active bid or ask.
+
+        Args:
+            order_id (int): 
+                The id returned when the order was added.
+        """
+        self.book.cancel(order_id)
+
+    def modify(self, order_id : int, unit : float = None, price : float = None):
+        """ Change the units and/or the price of an active bid or ask.
+
+        Args:
+            order_id (int): 
+                The id returned when the order was added.
+            unit (float, optional): 
+                The new number of units.
+            price (float, optional): 
+                The new per-unit price.
+        """
+        self.book.modify(order_id, unit=unit, price=price)
+
+    def save(self, path : str):
+        """ Save the orderbook and the clearing results as a binary snapshot.
+
+        Args:
+            path (str): 
+                The snapshot directory. One .npy file is written per column.
+        """
+        snapshot.save_market(self, path)
+
+    def load(self, path : str, mmap : bool = True):
+        """ Restore the orderbook and the clearing results from a snapshot.
+
+        Args:
+            path (str): 
+                The snapshot directory written by save().
+            mmap (bool, optional): 
+                If True, the columns are memory-mapped instead of read into memory.
+        """
+        snapshot.load_market(self, path, mmap)
+
     def show(self, scale: int = 0):
         """ Returns the dataframe.
 
@@ -5,16 +5,358 @@
     2. For testing: python3 -m marketlib.markets.orderbook
 """
 
+import json
+import os
+import time
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt  # type: ignore
 from marketlib.utils import bidask as ba
 
+# The "Type" column is stored as int8 codes in the buffers. 
+BID, ASK = 0, 1
+TYPES = ["bid", "ask"]
+
+# Number of rows parsed at a time when loading orders from a csv file.
+CSV_CHUNKSIZE = 1_000_000
+
+class _PriceLevels():
+    """ Aggregated units per price for one side of the orderbook.
+
+    The levels are kept up to date as orders are added, so that the demand 
+    or supply curve is read without scanning the orders. The levels are 
+    kept in hash maps, so an order at a new price is added in O(1). The 
+    prices are only sorted when they are read, and kept sorted until a 
+    level is added or dropped: the first read after a new or emptied 
+    price takes O(levels log levels), later reads O(levels).
+
+    Attributes:
+        descending (bool):
+            Order of the prices in the curve. True for bids, False for asks.
+        units (dict):
+            {price : total units at this price}
+        count (dict):
+            {price : number of orders at this price}
+        prices (list):
+            All prices with active units, sorted in non-descending order.
+    """
+
+    def __init__(self, descending=False):
+        self.descending = descending
+        self.units = {}
+        self.count = {}
+
+        # The sorted prices and the curve, dropped whenever a level is added 
+        # or dropped, and whenever a level changes, respectively.
+        self._prices = []
+        self._curve = None
+
+    def __len__(self):
+        return len(self.units)
+
+    @property
+    def prices(self):
+        """ The prices of the levels, sorted in non-descending order.
+        """
+
+        if self._prices is None:
+            self._prices = sorted(self.units)
+
+        return self._prices
+
+    def add(self, price, units):
+        """ Add an order of the given price and units.
+        """
+
+        price = float(price)
+        if price in self.units:
+            self.units[price] += units
+            self.count[price] += 1
+        else:
+            self.units[price] = units
+            self.count[price] = 1
+            self._prices = None
+
+        self._curve = None
+
+    def remove(self, price, units):
+        """ Remove an order of the given price and units.
+
+        The level is dropped once its last order is removed.
+        """
+
+        price = float(price)
+        self.count[price] -= 1
+
+        if self.count[price] == 0:
+            del self.units[price], self.count[price]
+            self._prices = None
+        else:
+            self.units[price] -= units
+
+        self._curve = None
+
+    def add_many(self, prices, units, counts=None):
+        """ Add a collection of orders given by their prices and units.
+
+        Units of equal prices are summed with NumPy first, so the Python 
+        work is per price level rather than per order.
+        """
+
+        if len(prices) == 0:
+            return
+
+        levels, inverse = np.unique(np.asarray(prices, dtype=np.float64), return_inverse=True)
+        sums = np.bincount(inverse, weights=units)
+        
+        # counts is given when the pairs are already aggregated levels.
+        if counts is None:
+            counts = np.bincount(inverse)
+        else:
+            counts = np.bincount(inverse, weights=counts).astype(np.int64)
+
+        for price, total, n in zip(levels.tolist(), sums.tolist(), counts.tolist()):
+            if price in self.units:
+                self.units[price] += total
+                self.count[price] += n
+            else:
+                self.units[price] = total
+                self.count[price] = n
+                self._prices = None
+
+        self._curve = None
+
+    def counts(self):
+        """ Number of orders per level, in the same order as curve().
+        """
+
+        prices = self.prices[::-1] if self.descending else self.prices
+        return np.array([self.count[p] for p in prices], dtype=np.int64)
+
+    def curve(self):
+        """ The step curve of this side.
+
+        Returns:
+            A numpy array of the form [[price_1, units_1], [price_2, units_2], ...],
+            sorted by price (non-ascending if descending is set).
+        """
+
+        if self._curve is None:
+            prices = self.prices[::-1] if self.descending else self.prices
+            curve = np.empty((len(prices), 2), dtype=np.float64)
+            curve[:, 0] = prices
+            curve[:, 1] = [self.units[p] for p in prices]
+            self._curve = curve
+
+        return self._curve
+
+class _UserIndex():
+    """ Orders and running totals of each user for one side of the orderbook.
+
+    Maintained as orders are added, cancelled or modified, so that the 
+    ladder or the totals of a user are found without scanning the book.
+
+    Attributes:
+        orders (dict):
+            {user : list of order ids}. Ids of cancelled orders are only 
+            dropped lazily, once the user has no active orders left.
+        stats (dict):
+            {user : [number of active orders, total units, total price * units]}
+    """
+
+    def __init__(self):
+        self.orders = {}
+        self.stats = {}
+
+    def add(self, user, order_id, price, units):
+        user = int(user)
+        if user in self.stats:
+            stats = self.stats[user]
+            stats[0] += 1
+            stats[1] += units
+            stats[2] += price * units
+            self.orders[user].append(order_id)
+        else:
+            self.stats[user] = [1, units, price * units]
+            self.orders[user] = [order_id]
+
+    def add_many(self, users, order_ids, prices, units):
+        """ Add a collection of orders, grouped by user with NumPy first.
+        """
+
+        if len(users) == 0:
+            return
+
+        users, order_ids = np.asarray(users), np.asarray(order_ids)
+        prices = np.asarray(prices, dtype=np.float64)
+        units = np.asarray(units, dtype=np.float64)
+
+        # Group the orders of each user, keeping the order of the rows.
+        keys, first, inverse = np.unique(users, return_index=True, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.cumsum(np.bincount(inverse))[:-1]
+        groups = np.split(order_ids[order], bounds)
+
+        counts = np.bincount(inverse)
+        totals = np.bincount(inverse, weights=units)
+        values = np.bincount(inverse, weights=prices * units)
+
+        # Visit the users in order of their first order, like add() does.
+        for k in np.argsort(first, kind='stable').tolist():
+            user = int(keys[k])
+            if user in self.stats:
+                stats = self.stats[user]
+                stats[0] += int(counts[k])
+                stats[1] += float(totals[k])
+                stats[2] += float(values[k])
+                self.orders[user].extend(groups[k].tolist())
+            else:
+                self.stats[user] = [int(counts[k]), float(totals[k]), float(values[k])]
+                self.orders[user] = groups[k].tolist()
+
+    def remove(self, user, price, units):
+        user = int(user)
+        stats = self.stats[user]
+        stats[0] -= 1
+
+        if stats[0] == 0:
+            del self.stats[user], self.orders[user]
+        else:
+            stats[1] -= units
+            stats[2] -= price * units
+
+    def order_ids(self, user):
+        return self.orders.get(int(user), [])
+
+class _UserRuns():
+    """ Orders and totals of each user for one side, as NumPy arrays.
+
+    A read-only counterpart of _UserIndex for memory-mapped books: the ids 
+    are sorted by user into runs, so the index takes a few bytes per order 
+    instead of one Python int, and is rebuilt when the side changes.
+
+    Attributes:
+        keys (array):
+            The users, sorted.
+        offsets (array):
+            The ids of keys[k] are ids[offsets[k]:offsets[k + 1]].
+        ids (array):
+            The order ids, grouped by user, in increasing order within a user.
+        stats (dict):
+            {user : [number of active orders, total units, total price * units]}, 
+            users in the order of their first order.
+    """
+
+    def __init__(self, users, order_ids, prices, units):
+        users, order_ids = np.asarray(users), np.asarray(order_ids)
+
+        order = np.argsort(users, kind='stable')
+        self.ids = order_ids[order]
+        self.keys, starts, inverse = np.unique(users[order], return_index=True, return_inverse=True)
+        self.offsets = np.append(starts, len(order))
+
+        counts = np.diff(self.offsets)
+        totals = np.bincount(inverse, weights=units[order], minlength=len(self.keys))
+        values = np.bincount(inverse, weights=(prices * units)[order], minlength=len(self.keys))
+
+        first = np.argsort(self.ids[starts], kind='stable')
+        self.stats = {int(self.keys[k]) : [int(counts[k]), float(totals[k]), float(values[k])] 
+                      for k in first.tolist()}
+
+    def order_ids(self, user):
+        k = int(np.searchsorted(self.keys, user))
+        if k == len(self.keys) or self.keys[k] != user:
+            return self.ids[:0]
+
+        return self.ids[self.offsets[k]:self.offsets[k + 1]]
+
+def group_by_user(users, units, prices):
+    """ Per-user total units and volume-weighted average prices of a collection of orders.
+
+    Args:
+        users, units, prices (array):
+            Columns of the orders.
+
+    Returns:
+        A tuple of three arrays (users, total units, average per-unit prices), 
+        users listed in the order of their first order.
+    """
+
+    keys, first, inverse = np.unique(np.asarray(users), return_index=True, return_inverse=True)
+    totals = np.bincount(inverse, weights=units).astype(np.float64, copy=False)
+    values = np.bincount(inverse, weights=np.asarray(prices) * np.asarray(units)).astype(np.float64, copy=False)
+    avg = np.divide(values, totals, out=np.zeros_like(values), where=totals != 0)
+
+    order = np.argsort(first, kind='stable')
+    return keys[order], totals[order], avg[order]
+
+def load_csv(input_path, side, add_orders, chunksize=CSV_CHUNKSIZE, verbose=False):
+    """ Stream a .csv file of orders chunk by chunk.
+
+    The columns are parsed straight into the dtypes of the orderbook buffers, 
+    so only one chunk is held as a dataframe at any time.
+
+    Args:
+        input_path (str):
+            Path to the .csv file. Columns: Unit, Price, User (in any order).
+        side (str):
+            Either "bid" or "ask".
+        add_orders (function):
+            Called as add_orders(side, chunk) with each chunk, e.g., 
+            _OrderBook.add_orders() or Market.add_orders().
+        chunksize (int, optional):
+            Number of rows parsed at a time.
+        verbose (bool, optional):
+            If True, print the number of rows and rows per second.
+
+    Raises:
+        ValueError: The header of the file does not match the columns Unit, Price, User.
+
+    Returns:
+        The number of rows loaded.
+    """
+
+    csv_columns = ['Unit', 'Price', 'User']
+
+    header = pd.read_csv(input_path, sep=',', nrows=0).columns.tolist()
+    if sorted(header) != sorted(csv_columns):
+        raise ValueError(f"Invalid header in {input_path}: {header}. Expected columns: {csv_columns}")
+
+    start = time.perf_counter()
+    rows = 0
+
+    chunks = pd.read_csv(
+        input_path, 
+        sep=',', 
+        dtype={name : _OrderBook.col_dtypes[name] for name in csv_columns}, 
+        chunksize=chunksize
+    )
+
+    for chunk in chunks:
+        add_orders(side, chunk)
+        rows += len(chunk)
+
+    if verbose:
+        elapsed = time.perf_counter() - start
+        rate = rows / elapsed if elapsed > 0 else float('inf')
+        print(f"Loaded {rows} {side}s from {input_path} in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+
+    return rows
+
 class _OrderBook():
     """ Track of all active bids and asks.
 
+    Orders are stored in growable typed column buffers, one per column. 
+    Appending an order writes into the buffers in amortized O(1) time; 
+    the "orders" dataframe is only built when it is read.
+
+    Each order gets a stable id. Cancelled orders are only marked as dead 
+    in the "Alive" buffer, and the buffers are compacted once the fraction 
+    of dead rows exceeds compact_ratio.
+
     Attributes:
         orders (dataframe):
-            Columns are "Unit" | "Price" | "Type" | "User". 
+            Columns are "Unit" | "Price" | "Type" | "User", indexed by order id. 
             "Price" is per-unit, "Type" is either bid or ask, 
             "User" is user id.
     """
@@ -26,9 +368,490 @@ class _OrderBook():
         'User'
     ] 
 
+    # Dtypes of the column buffers.
+    col_dtypes = {
+        'Unit' : np.float64,
+        'Price' : np.float64,
+        'Type' : np.int8,
+        'User' : np.int32,
+        'ID' : np.int64,
+        'Alive' : np.bool_
+    }
+
+    # Initial number of rows of the buffers. The capacity doubles when full.
+    init_capacity = 1024
+
+    # The buffers are compacted when more than this fraction of rows is dead.
+    compact_ratio = 0.25
+
+    # Maximum number of derived products memoized, see _memo().
+    cache_size = 64
+
+    # Whether feasible orders are sliced from price-sorted sides, see 
+    # _feasible_columns(). Memory-mapped books scan chunk by chunk instead.
+    sorted_sides = True
+
     def __init__(self):
         # Initially an empty order book
-        self.orders = pd.DataFrame(columns=self.col_names)
+        self._size = 0
+        self._capacity = self.init_capacity
+        self._cols = {name : np.empty(self._capacity, dtype=dtype) 
+                      for name, dtype in self.col_dtypes.items()}
+
+        # Order ids increase with the rows, so the ID buffer stays sorted.
+        self._next_id = 0
+        self._dead = 0
+
+        # Mutation counter of each side, and products derived from the 
+        # orders (curves, feasible sets, ...) memoized against it, see _memo().
+        self._versions = [0, 0]
+        self._cache = {}
+
+        # Price levels of the bids (demand) and the asks (supply), indexed 
+        # by the type code.
+        self._levels = (_PriceLevels(descending=True), _PriceLevels())
+
+        # Orders of each user per side. Books built on existing columns 
+        # create it on first use, see _users().
+        self._user_index = (_UserIndex(), _UserIndex())
+
+        # Functions called after the price levels change, see _notify().
+        self._watchers = []
+
+    # ---------------------------
+    #   Column buffer handling   -
+    # ---------------------------
+    def __len__(self):
+        return self._size - self._dead
+
+    def _reserve(self, n):
+        """ Make sure the buffers can hold n more rows.
+
+        The capacity is at least doubled on growth, which makes appends 
+        amortized O(1) per row.
+        """
+
+        needed = self._size + n
+        if needed <= self._capacity:
+            return
+
+        capacity = max(2 * self._capacity, needed)
+        for name, col in self._cols.items():
+            new_col = np.empty(capacity, dtype=col.dtype)
+            new_col[:self._size] = col[:self._size]
+            self._cols[name] = new_col
+
+        self._capacity = capacity
+
+    @classmethod
+    def _from_columns(cls, cols, levels=None):
+        """ Build an orderbook on top of existing column arrays.
+
+        The arrays are used as they are (e.g., read-only memory maps), they 
+        are only copied once the book needs to grow.
+
+        Args:
+            cols (dict):
+                {column name : 1-D array}, one entry per buffer column.
+            levels (tuple, optional):
+                The ((demand curve, counts), (supply curve, counts)) of the 
+                orders. Recomputed from the columns if not given.
+        """
+
+        book = cls()
+        book._size = len(cols['Unit'])
+        book._capacity = book._size
+        book._cols = {name : cols[name] for name in cls.col_dtypes}
+        book._next_id = int(cols['ID'][-1]) + 1 if book._size else 0
+        book._dead = book._size - int(np.count_nonzero(cols['Alive']))
+        book._user_index = None
+
+        for type_code, levels_side in enumerate(book._levels):
+            if levels is not None:
+                curve, counts = levels[type_code]
+                levels_side.add_many(curve[:, 0], curve[:, 1], counts)
+            else:
+                mask = (book._cols['Type'][:book._size] == type_code) & book._cols['Alive'][:book._size]
+                levels_side.add_many(book._cols['Price'][:book._size][mask], book._cols['Unit'][:book._size][mask])
+
+        return book
+
+    def _append(self, unit, price, type_code, user_id):
+        """ Append a single row to the buffers.
+
+        Returns:
+            The id of the new order.
+        """
+
+        self._reserve(1)
+
+        i, order_id = self._size, self._next_id
+        self._cols['Unit'][i] = unit
+        self._cols['Price'][i] = price
+        self._cols['Type'][i] = type_code
+        self._cols['User'][i] = user_id
+        self._cols['ID'][i] = order_id
+        self._cols['Alive'][i] = True
+
+        self._size += 1
+        self._next_id += 1
+        self._versions[type_code] += 1
+
+        self._levels[type_code].add(price, unit)
+        if self._user_index is not None:
+            self._user_index[type_code].add(user_id, order_id, price, unit)
+        if self._watchers:
+            self._notify(type_code, [price], [unit], [1])
+
+        return order_id
+
+    def _extend(self, units, prices, type_code, user_ids):
+        """ Append a collection of rows of the same type to the buffers.
+
+        Args:
+            units, prices, user_ids (array-like):
+                Columns of the new rows, all of the same length.
+            type_code (int): 
+                BID or ASK.
+
+        Returns:
+            An array with the ids of the new orders.
+        """
+
+        n = len(units)
+        self._reserve(n)
+
+        start, end = self._size, self._size + n
+        order_ids = np.arange(self._next_id, self._next_id + n, dtype=np.int64)
+        self._cols['Unit'][start:end] = units
+        self._cols['Price'][start:end] = prices
+        self._cols['Type'][start:end] = type_code
+        self._cols['User'][start:end] = user_ids
+        self._cols['ID'][start:end] = order_ids
+        self._cols['Alive'][start:end] = True
+
+        self._size = end
+        self._next_id += n
+        self._versions[type_code] += 1
+
+        self._levels[type_code].add_many(prices, units)
+        if self._user_index is not None:
+            self._user_index[type_code].add_many(user_ids, order_ids, prices, units)
+        if self._watchers:
+            self._notify(type_code, prices, units, np.ones(n, dtype=np.int64))
+
+        return order_ids
+
+    # -------------------------------
+    #   Cancel and modify an order   -
+    # -------------------------------
+    def _row(self, order_id):
+        """ The row of an active order in the buffers, found by binary search.
+
+        Raises:
+            ValueError: There is no active order with this id.
+        """
+
+        row = int(np.searchsorted(self._cols['ID'][:self._size], order_id))
+        if (row == self._size or self._cols['ID'][row] != order_id 
+                or not self._cols['Alive'][row]):
+            raise ValueError(f"Invalid order id: {order_id}")
+
+        return row
+
+    def _writable(self):
+        """ Copy the buffers into memory if they are read-only (e.g., loaded from a snapshot).
+        """
+
+        if all(col.flags.writeable for col in self._cols.values()):
+            return
+
+        self._cols = {name : np.array(col[:self._capacity]) for name, col in self._cols.items()}
+
+    def cancel(self, order_id):
+        """ Cancel an active order.
+
+        The row is only marked as dead, nothing is copied. The buffers are 
+        compacted once more than compact_ratio of the rows are dead.
+
+        Args:
+            order_id (int):
+                The id of the order.
+
+        Raises:
+            ValueError: There is no active order with this id.
+        """
+
+        row = self._row(order_id)
+        self._writable()
+
+        self._cols['Alive'][row] = False
+        self._dead += 1
+
+        type_code, price, unit = self._cols['Type'][row], self._cols['Price'][row], self._cols['Unit'][row]
+        self._versions[type_code] += 1
+        self._levels[type_code].remove(price, unit)
+        if self._user_index is not None:
+            self._user_index[type_code].remove(self._cols['User'][row], price, unit)
+        if self._watchers:
+            self._notify(type_code, [price], [-unit], [-1])
+
+        if self._dead > self.compact_ratio * self._size:
+            self._compact()
+
+    def modify(self, order_id, unit=None, price=None):
+        """ Change the units and/or the price of an active order in place.
+
+        Args:
+            order_id (int):
+                The id of the order.
+            unit (float, optional):
+                The new number of units.
+            price (float, optional):
+                The new per-unit price.
+
+        Raises:
+            ValueError: There is no active order with this id.
+        """
+
+        row = self._row(order_id)
+        self._writable()
+
+        type_code, user = self._cols['Type'][row], self._cols['User'][row]
+        old_price, old_unit = self._cols['Price'][row], self._cols['Unit'][row]
+
+        if unit is not None:
+            self._cols['Unit'][row] = unit
+        if price is not None:
+            self._cols['Price'][row] = price
+        new_price, new_unit = self._cols['Price'][row], self._cols['Unit'][row]
+
+        self._levels[type_code].remove(old_price, old_unit)
+        self._levels[type_code].add(new_price, new_unit)
+        if self._watchers:
+            self._notify(type_code, [old_price, new_price], [-old_unit, new_unit], [-1, 1])
+
+        # The order keeps its place in the list of the user.
+        if self._user_index is not None:
+            stats = self._user_index[type_code].stats[int(user)]
+            stats[1] += new_unit - old_unit
+            stats[2] += new_price * new_unit - old_price * old_unit
+
+        self._versions[type_code] += 1
+
+    def _notify(self, type_code, prices, units, counts):
+        """ Pass a change of the price levels to the watchers.
+
+        Called after the levels are updated. Each watcher receives 
+        (type code, prices, changes of units, changes of the number of orders).
+        """
+
+        for watcher in self._watchers:
+            watcher(type_code, prices, units, counts)
+
+    # ------------------------
+    #   Derived products     -
+    # ------------------------
+    @property
+    def version(self):
+        """ The mutation counters (bids, asks). Each order added, cancelled 
+        or modified increases the counter of its side.
+        """
+        return tuple(self._versions)
+
+    def _memo(self, key, sides, compute):
+        """ A product derived from the orders of some sides, computed once per version.
+
+        Args:
+            key (tuple):
+                Identifies the product, e.g., ("feasible", BID, price).
+            sides (tuple):
+                The type codes the product depends on. A change of another 
+                side keeps the product.
+            compute (function):
+                Computes the product if there is no up-to-date one.
+        """
+
+        versions = tuple(self._versions[side] for side in sides)
+
+        hit = self._cache.get(key)
+        if hit is not None and hit[0] == versions:
+            return hit[1]
+
+        # Drop the products that are out of date before caching a new one.
+        self._cache = {k : (v, value, deps) for k, (v, value, deps) in self._cache.items()
+                       if v == tuple(self._versions[side] for side in deps)}
+
+        # Keep at most cache_size products, dropping the oldest first.
+        while len(self._cache) >= self.cache_size:
+            del self._cache[next(iter(self._cache))]
+
+        value = compute()
+        self._cache[key] = (versions, value, sides)
+        return value
+
+    def _compact(self):
+        """ Drop the dead rows from the buffers.
+
+        Alive rows are moved to the front chunk by chunk, keeping their order, 
+        so the ID buffer stays sorted.
+        """
+
+        end = 0
+        for _, chunk in self._chunks():
+            alive = chunk['Alive'].copy()
+            n = int(np.count_nonzero(alive))
+            for name, col in chunk.items():
+                self._cols[name][end:end + n] = col[alive]
+            end += n
+
+        self._size = end
+        self._dead = 0
+
+    def column(self, name):
+        """ A read-only view of a column over all rows of the orderbook.
+        """
+
+        view = self._cols[name][:self._size]
+        view.flags.writeable = False
+        return view
+
+    def _chunks(self, chunksize=None):
+        """ Iterate over the rows of the orderbook in chunks.
+
+        Args:
+            chunksize (int, optional):
+                Number of rows per chunk. Defaults to the whole book.
+
+        Yields:
+            Tuples of the form (first row, {column name : view of the chunk})
+        """
+
+        chunksize = chunksize or max(self._size, 1)
+        for start in range(0, self._size, chunksize):
+            end = min(start + chunksize, self._size)
+            yield start, {name : col[start:end] for name, col in self._cols.items()}
+
+    def _sorted_side(self, type_code):
+        """ The active orders of one side sorted by price, best price first.
+
+        Bids are sorted in non-ascending and asks in non-descending order by 
+        price, orders of the same price by id. Kept until the side changes.
+
+        Returns:
+            {column name : read-only array} for "Unit", "Price", "User", "ID" 
+            and "Key", the sort key (-price for bids, price for asks).
+        """
+
+        def compute():
+            mask = (self._cols['Type'][:self._size] == type_code) & self._cols['Alive'][:self._size]
+            price = self._cols['Price'][:self._size][mask]
+            key = -price if type_code == BID else price
+
+            # Rows are in id order, which the stable sort keeps within a price.
+            order = np.argsort(key, kind='stable')
+
+            side = {name : self._cols[name][:self._size][mask][order] for name in ('Unit', 'Price', 'User', 'ID')}
+            side['Key'] = key[order]
+            for col in side.values():
+                col.flags.writeable = False
+
+            return side
+
+        return self._memo(("sorted", type_code), (type_code,), compute)
+
+    def _feasible_columns(self, type_code, clearing_price, chunksize=None):
+        """ The orders of one side that trade under a clearing price, as arrays.
+
+        Bids are feasible if their price is at least the clearing price, 
+        asks if their price is at most the clearing price. They are listed 
+        best price first, orders of the same price by id.
+
+        With sorted sides (in memory books), the feasible orders are a prefix 
+        of the sorted side found by binary search, and the arrays are 
+        read-only views of it. Otherwise (memory-mapped books) the book is 
+        scanned chunk by chunk and only the feasible rows are gathered.
+
+        Args:
+            type_code (int):
+                BID or ASK.
+            clearing_price (float):
+                The market clearing price.
+            chunksize (int, optional):
+                Number of rows scanned at a time. Defaults to the whole book.
+
+        Returns:
+            {column name : array} for "Unit", "Price", "User" and "ID".
+        """
+
+        if self.sorted_sides:
+            side = self._sorted_side(type_code)
+            key = -clearing_price if type_code == BID else clearing_price
+            n = int(np.searchsorted(side['Key'], key, side='right'))
+
+            return {name : side[name][:n] for name in ('Unit', 'Price', 'User', 'ID')}
+
+        return self._memo(("feasible_columns", type_code, float(clearing_price)), (type_code,),
+                          lambda: self._scan_feasible(type_code, clearing_price, chunksize))
+
+    def _scan_feasible(self, type_code, clearing_price, chunksize=None):
+        parts = {name : [] for name in ('Unit', 'Price', 'User', 'ID')}
+
+        for start, chunk in self._chunks(chunksize):
+            if type_code == BID:
+                mask = (chunk['Type'] == BID) & (chunk['Price'] >= clearing_price)
+            else:
+                mask = (chunk['Type'] == ASK) & (chunk['Price'] <= clearing_price)
+            mask &= chunk['Alive']
+
+            for name, part in parts.items():
+                part.append(chunk[name][mask])
+
+        cols = {name : np.concatenate(part) if part else np.empty(0, dtype=self.col_dtypes[name])
+                for name, part in parts.items()}
+
+        # Best price first, as the sorted sides.
+        order = np.argsort(-cols['Price'] if type_code == BID else cols['Price'], kind='stable')
+        return {name : col[order] for name, col in cols.items()}
+
+    def _feasible(self, type_code, clearing_price, chunksize=None):
+        """ The orders of one side that trade under a clearing price.
+
+        See _feasible_columns(). The result is kept until the side changes, 
+        so it must not be modified.
+
+        Returns:
+            A dataframe with columns "Unit" | "Price" | "Type" | "User", indexed 
+            by order id, best price first.
+        """
+
+        def compute():
+            cols = self._feasible_columns(type_code, clearing_price, chunksize)
+            return pd.DataFrame({
+                'Unit' : cols['Unit'],
+                'Price' : cols['Price'],
+                'Type' : pd.Categorical.from_codes(np.full(len(cols['ID']), type_code, dtype=np.int8), 
+                                                   categories=TYPES),
+                'User' : cols['User']
+            }, index=cols['ID'])
+
+        return self._memo(("feasible", type_code, float(clearing_price)), (type_code,), compute)
+
+    @property
+    def orders(self):
+        """ The orderbook as a dataframe, built from the buffers on demand.
+        """
+
+        return self._memo(("orders",), (BID, ASK), self._build_frame)
+
+    def _build_frame(self):
+        alive = self._cols['Alive'][:self._size]
+        return pd.DataFrame({
+            'Unit' : self._cols['Unit'][:self._size][alive],
+            'Price' : self._cols['Price'][:self._size][alive],
+            'Type' : pd.Categorical.from_codes(self._cols['Type'][:self._size][alive], categories=TYPES),
+            'User' : self._cols['User'][:self._size][alive]
+        }, index=self._cols['ID'][:self._size][alive])
 
     # ----------------------
     #   Add a single bid   -
@@ -49,17 +872,21 @@ class _OrderBook():
             user_id (int):
                 The id of the buyer who placed this bid.
                 (Buyers and sellers ids don't overlap)
+
+        Returns:
+            The id of the new order.
         """
 
-        new_bid = pd.DataFrame([[unit, price, 'bid', user_id]], columns=self.col_names)
-        self.orders = pd.concat([self.orders, new_bid], ignore_index=True)
+        return self._append(unit, price, BID, user_id)
 
     # --------------------------
     #   Add a bundle of bids   -
     # --------------------------
     def add_bid_csv(
         self,
-        input_path
+        input_path,
+        chunksize=CSV_CHUNKSIZE,
+        verbose=False
     ):
         """ Add a collection of bids to the orderbook.
 
@@ -68,12 +895,16 @@ class _OrderBook():
                 Path to the .csv file which contains a collection of bids.
                 Columns of csv: Unit, Price, User.
                 Note: The "Type" column will be added automatically to the orderbook. No need to specify it in the csv file.
+            chunksize (int, optional):
+                Number of rows parsed at a time.
+            verbose (bool, optional):
+                If True, print the loading throughput.
+
+        Returns:
+            The number of bids loaded.
         """
 
-        new_bid = pd.read_csv(input_path, sep=',')
-        new_bid["Type"] = "bid"
-        new_bid = new_bid[self.col_names]
-        self.orders = pd.concat([self.orders, new_bid], ignore_index=True)
+        return load_csv(input_path, 'bid', self.add_orders, chunksize, verbose)
 
     # ----------------------
     #   Add a single ask   -
@@ -94,17 +925,21 @@ class _OrderBook():
             user_id (int):
                 The id of the seller who placed this bid.
                 (Buyers and sellers ids don't overlap)
+
+        Returns:
+            The id of the new order.
         """  
         
-        new_ask = pd.DataFrame([[unit, price, 'ask', user_id]], columns=self.col_names)
-        self.orders = pd.concat([self.orders, new_ask], ignore_index=True)
+        return self._append(unit, price, ASK, user_id)
     
     # --------------------------
     #   Add a bundle of asks   -
     # --------------------------
     def add_ask_csv(
         self,
-        input_path
+        input_path,
+        chunksize=CSV_CHUNKSIZE,
+        verbose=False
     ):
         """ Add a collection of asks to the orderbook.
 
@@ -113,12 +948,172 @@ class _OrderBook():
                 Path to the .csv file which contains a collection of asks.
                 Columns of csv: Unit, Price, User.
                 Note: The "Type" column will be added automatically to the orderbook. No need to specify it in the csv file.
+            chunksize (int, optional):
+                Number of rows parsed at a time.
+            verbose (bool, optional):
+                If True, print the loading throughput.
+
+        Returns:
+            The number of asks loaded.
+        """
+
+        return load_csv(input_path, 'ask', self.add_orders, chunksize, verbose)
+
+    # ------------------------------------
+    #   Add a bundle of bids or asks     -
+    # ------------------------------------
+    def add_orders(
+        self,
+        side,
+        orders=None,
+        unit=None,
+        price=None,
+        user_id=None
+    ):
+        """ Add a collection of bids or asks to the orderbook in one pass.
+
+        The orders are given either by "orders" or by the three columns 
+        "unit", "price" and "user_id".
+
+        Args:
+            side (str):
+                Either "bid" or "ask".
+            orders (optional):
+                A dataframe with columns Unit, Price, User; a 2-D array whose 
+                rows are [unit, price, user_id]; or an iterable (e.g., a 
+                generator) of (unit, price, user_id) tuples.
+            unit (array-like, optional):
+                Number of units of each order.
+            price (array-like, optional):
+                Per-unit price of each order.
+            user_id (array-like, optional):
+                The id of the user who placed each order.
+
+        Raises:
+            ValueError: Invalid side, or the columns are missing or of different lengths.
+
+        Returns:
+            An array with the ids of the new orders.
+        """
+
+        if side not in TYPES:
+            raise ValueError(f"Invalid order type: {side}")
+
+        if orders is not None:
+            unit, price, user_id = self._to_columns(orders)
+
+        if unit is None or price is None or user_id is None:
+            raise ValueError("Either orders or all of unit, price and user_id must be given.")
+
+        unit = np.asarray(unit, dtype=self.col_dtypes['Unit'])
+        price = np.asarray(price, dtype=self.col_dtypes['Price'])
+        user_id = np.asarray(user_id, dtype=self.col_dtypes['User'])
+
+        if not (unit.shape == price.shape == user_id.shape) or unit.ndim != 1:
+            raise ValueError("The columns unit, price and user_id must be 1-D and of the same length.")
+
+        return self._extend(unit, price, TYPES.index(side), user_id)
+
+    def _to_columns(self, orders):
+        """ Split a collection of orders into the columns (unit, price, user_id).
+        """
+
+        if isinstance(orders, pd.DataFrame):
+            return orders['Unit'].to_numpy(), orders['Price'].to_numpy(), orders['User'].to_numpy()
+
+        if isinstance(orders, np.ndarray) and orders.ndim == 2:
+            return orders[:, 0], orders[:, 1], orders[:, 2]
+
+        # Consume the iterable in one pass straight into a typed record array.
+        record = np.dtype([(name, self.col_dtypes[name]) for name in ('Unit', 'Price', 'User')])
+        rows = np.fromiter((tuple(row) for row in orders), dtype=record)
+
+        return rows['Unit'], rows['Price'], rows['User']
+
+    # ------------------------
+    #   Per-user lookups     -
+    # ------------------------
+    def _users(self, type_code):
+        """ The user index of one side, built with one pass over the book if missing.
+        """
+
+        if self._user_index is None:
+            self._user_index = (_UserIndex(), _UserIndex())
+            for _, chunk in self._chunks():
+                for code, index in enumerate(self._user_index):
+                    mask = (chunk['Type'] == code) & chunk['Alive']
+                    index.add_many(chunk['User'][mask], chunk['ID'][mask], 
+                                   chunk['Price'][mask], chunk['Unit'][mask])
+
+        return self._user_index[type_code]
+
+    def user_orders(self, user_id, side):
+        """ The ladder of a user on one side of the book.
+
+        Args:
+            user_id (int):
+                The id of the user.
+            side (str):
+                Either "bid" or "ask".
+
+        Returns:
+            A numpy array of the form [[price_1, units_1], [price_2, units_2], ...], 
+            sorted in non-ascending order by prices for bids and non-descending 
+            order for asks. Orders of the same price are listed in the order 
+            they were added.
         """
 
-        new_ask = pd.read_csv(input_path, sep=',')  # <- no header=None
-        new_ask["Type"] = "ask"
-        new_ask = new_ask[self.col_names]
-        self.orders = pd.concat([self.orders, new_ask], ignore_index=True)
+        type_code = TYPES.index(side)
+        order_ids = self._users(type_code).order_ids(user_id)
+
+        # Cancelled ids are dropped lazily, and may be gone from the buffers
+        # after compaction: keep the rows that hold the live order, as in _row().
+        order_ids = np.asarray(order_ids, dtype=self._cols['ID'].dtype)
+        rows = np.searchsorted(self._cols['ID'][:self._size], order_ids)
+        inside = rows < self._size
+        rows, order_ids = rows[inside], order_ids[inside]
+        rows = rows[(self._cols['ID'][rows] == order_ids) & self._cols['Alive'][rows]]
+
+        prices, units = self._cols['Price'][rows], self._cols['Unit'][rows]
+        order = np.argsort(-prices if type_code == BID else prices, kind='stable')
+
+        return np.column_stack((prices[order], units[order]))
+
+    def user_summary(self, side, clearing_price=None):
+        """ Per-user total units and volume-weighted average per-unit prices.
+
+        Args:
+            side (str):
+                Either "bid" or "ask".
+            clearing_price (float, optional):
+                If given, only the orders that trade under this price are 
+                counted (see _feasible_columns()). Otherwise the running totals 
+                of the user index are read in O(users). The result is kept 
+                until the side changes.
+
+        Returns:
+            A tuple of three arrays (users, total units, average per-unit prices), 
+            users listed in the order of their first order (their first 
+            feasible order by price priority if clearing_price is given).
+        """
+
+        type_code = TYPES.index(side)
+        key = ("user_summary", type_code, None if clearing_price is None else float(clearing_price))
+
+        return self._memo(key, (type_code,), lambda: self._summarize_users(type_code, clearing_price))
+
+    def _summarize_users(self, type_code, clearing_price=None):
+        if clearing_price is not None:
+            feasible = self._feasible_columns(type_code, clearing_price)
+            return group_by_user(feasible['User'], feasible['Unit'], feasible['Price'])
+
+        stats = self._users(type_code).stats
+        users = np.fromiter(stats.keys(), dtype=np.int64, count=len(stats))
+        totals = np.fromiter((v[1] for v in stats.values()), dtype=np.float64, count=len(stats))
+        values = np.fromiter((v[2] for v in stats.values()), dtype=np.float64, count=len(stats))
+        avg = np.divide(values, totals, out=np.zeros_like(values), where=totals != 0)
+
+        return users, totals, avg
 
     # -----------------------------------
     #   Display the current orderbook   -
@@ -136,7 +1131,7 @@ class _OrderBook():
         if scale == 0:
             print(self.orders)
         elif scale == 1:
-            print([self.orders['Type'] == 'bid'])
+            print(self.orders[self.orders['Type'] == 'bid'])
         else:
             print(self.orders[self.orders['Type'] == 'ask'])
 
@@ -150,15 +1145,15 @@ class _OrderBook():
         """ Extract all bids, sorted in non-ascending order by prices. Bids of the same prices are merged where their units accumulate.
 
         This function gives the demand curve, which is used to compute the market clearing price.
+        The price levels are maintained on insert. The first read after a price 
+        level is added or dropped sorts the levels in O(levels log levels), 
+        other reads take O(levels).
 
         Returns:
             A numpy array of the form [[bid_price_1, units_1], [bid_price_2, units_2], ...]
         """
 
-        bids = self.orders[self.orders['Type'] == 'bid']
-        bid_curves = bids.groupby('Price')['Unit'].sum().reset_index()
-
-        return bid_curves.sort_values(by=['Price'], ascending=False).to_numpy()
+        return self._memo(("curve", BID), (BID,), self._levels[BID].curve)
  
     # ------------------
     #   Get all asks   -
@@ -167,15 +1162,15 @@ class _OrderBook():
         """ Extract all asks, sorted in non-descending order by prices. Asks of the same prices are merged where their units accumulate.
 
         This function gives the supply curve, which is used to compute the market clearing price.
+        The price levels are maintained on insert. The first read after a price 
+        level is added or dropped sorts the levels in O(levels log levels), 
+        other reads take O(levels).
 
         Returns:
             A numpy array of the form [[ask_price_1, units_1] ...]
         """
 
-        asks = self.orders[self.orders['Type'] == 'ask']
-        ask_curves = asks.groupby('Price')['Unit'].sum().reset_index()
-
-        return ask_curves.sort_values(by=['Price']).to_numpy()
+        return self._memo(("curve", ASK), (ASK,), self._levels[ASK].curve)
 
     # ---------------------------------
     #   Plot supply & demand curves   -
@@ -186,8 +1181,8 @@ class _OrderBook():
             *This code is generated by ChatGPT*
         """
 
-        demand_curve = self.get_bids().tolist()
-        supply_curve = self.get_asks().tolist()
+        demand_curve = self._get_bids().tolist()
+        supply_curve = self._get_asks().tolist()
 
         demand_units = [unit for price, unit in demand_curve]
         demand_prices = [price for price, unit in demand_curve]
@@ -216,6 +1211,148 @@ class _OrderBook():
         plt.show()
     
 
+class _MemmapOrderBook(_OrderBook):
+    """ An orderbook whose columns live in memory-mapped files.
+
+    Meant for books larger than RAM. Each column is a raw binary file 
+    <directory>/<column>.bin that grows (by doubling) as orders are appended. 
+    The number of rows and the next order id are recorded in 
+    <directory>/meta.json by flush(). 
+    Opening an existing directory resumes the book; its price levels are 
+    rebuilt chunk by chunk. 
+
+    Note: reading "orders" loads the whole book into memory. Clearing only 
+    uses the price levels and _feasible(), which work chunk by chunk.
+    Per-user lookups read a NumPy index of the side (see _UserRuns) built 
+    chunk by chunk on first use, instead of a Python list per user.
+
+    Attributes:
+        directory (str):
+            Where the column files are stored.
+        chunksize (int):
+            Number of rows processed at a time when scanning the book.
+    """
+
+    # Sorting a side would load it into memory, feasible orders are 
+    # gathered chunk by chunk instead.
+    sorted_sides = False
+
+    def __init__(self, directory, chunksize=CSV_CHUNKSIZE):
+        """ Open (or create) a memory-mapped orderbook.
+
+        Args:
+            directory (str):
+                Where the column files are stored. Created if it does not exist.
+            chunksize (int, optional):
+                Number of rows processed at a time when scanning the book.
+        """
+
+        super().__init__()
+
+        self.directory = directory
+        self.chunksize = chunksize
+        os.makedirs(directory, exist_ok=True)
+
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self._size, self._next_id, self._dead = meta['size'], meta['next_id'], meta['dead']
+
+        # The files might be larger than the book, from a previous growth.
+        self._capacity = max(self._size, self.init_capacity)
+        for name in self.col_dtypes:
+            path = self._path(name)
+            if os.path.exists(path):
+                itemsize = np.dtype(self.col_dtypes[name]).itemsize
+                self._capacity = max(self._capacity, os.path.getsize(path) // itemsize)
+
+        self._cols = {name : self._open(name, self._capacity) for name in self.col_dtypes}
+
+        for start, chunk in self._chunks():
+            for type_code, levels_side in enumerate(self._levels):
+                mask = (chunk['Type'] == type_code) & chunk['Alive']
+                levels_side.add_many(chunk['Price'][mask], chunk['Unit'][mask])
+
+        # The user index is not kept on appends, it would hold one Python 
+        # int per order. It is built as NumPy runs on first use, see _users().
+        self._user_index = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.bin")
+
+    def _open(self, name, capacity):
+        """ Memory-map the file of a column, resized to hold capacity rows.
+        """
+
+        dtype = np.dtype(self.col_dtypes[name])
+        path = self._path(name)
+
+        with open(path, 'ab') as f:
+            if f.tell() < capacity * dtype.itemsize:
+                f.truncate(capacity * dtype.itemsize)
+
+        return np.memmap(path, dtype=dtype, mode='r+', shape=(capacity,))
+
+    def _reserve(self, n):
+        """ Make sure the column files can hold n more rows.
+
+        The files are extended (at least doubled) and mapped again. Nothing 
+        is copied through memory.
+        """
+
+        needed = self._size + n
+        if needed <= self._capacity:
+            return
+
+        capacity = max(2 * self._capacity, needed)
+        for name, col in self._cols.items():
+            col.flush()
+            self._cols[name] = None
+            del col
+            self._cols[name] = self._open(name, capacity)
+
+        self._capacity = capacity
+
+    def _extend(self, units, prices, type_code, user_ids):
+        order_ids = super()._extend(units, prices, type_code, user_ids)
+        self.flush()
+        return order_ids
+
+    def _chunks(self, chunksize=None):
+        return super()._chunks(chunksize or self.chunksize)
+
+    def _feasible_columns(self, type_code, clearing_price, chunksize=None):
+        return super()._feasible_columns(type_code, clearing_price, chunksize or self.chunksize)
+
+    def _users(self, type_code):
+        """ The user index of one side as NumPy runs, gathered chunk by chunk, kept until the side changes.
+        """
+
+        def compute():
+            cols = {name : [] for name in ('User', 'ID', 'Price', 'Unit')}
+            for _, chunk in self._chunks():
+                mask = (chunk['Type'] == type_code) & chunk['Alive']
+                for name, parts in cols.items():
+                    parts.append(chunk[name][mask])
+
+            cols = {name : np.concatenate(parts) if parts else np.empty(0, dtype=self.col_dtypes[name]) 
+                    for name, parts in cols.items()}
+            return _UserRuns(cols['User'], cols['ID'], cols['Price'].astype(np.float64), 
+                             cols['Unit'].astype(np.float64))
+
+        return self._memo(("users", type_code), (type_code,), compute)
+
+    def flush(self):
+        """ Write the columns and the number of rows to disk.
+        """
+
+        for col in self._cols.values():
+            col.flush()
+
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump({'size' : self._size, 'next_id' : self._next_id, 'dead' : self._dead}, f)
+
 if __name__ == "__main__":
     B_1 = _OrderBook()
     B_2 = _OrderBook()
@@ -241,21 +1378,21 @@ if __name__ == "__main__":
     OUTPUTS:
 
     --- Order Book 1 ---
-    Unit Price Type User
-    0    5     1  bid    0
-    1   10   1.5  bid    1
-    2   20   0.5  bid    2
-    3    7  0.85  ask    3
-    4   12  1.15  ask    4
+       Unit  Price Type  User
+    0   5.0   1.00  bid     0
+    1  10.0   1.50  bid     1
+    2  20.0   0.50  bid     2
+    3   7.0   0.85  ask     3
+    4  12.0   1.15  ask     4
 
     --- Order Book 2 ---
-    Unit  Price Type User
-    0   10    1.0  ask    0
-    1    5    1.5  ask    1
-    2    3    2.0  ask    2
-    3    1    1.2  ask    0
-    4   10    1.0  bid    3
-    5   10    2.0  bid    3
-    6    5    2.0  bid    4
-    7   10    2.5  bid    5
+       Unit  Price Type  User
+    0  10.0    1.0  ask     0
+    1   5.0    1.5  ask     1
+    2   3.0    2.0  ask     2
+    3   1.0    1.2  ask     0
+    4  10.0    1.0  bid     3
+    5  10.0    2.0  bid     3
+    6   5.0    2.0  bid     4
+    7  10.0    2.5  bid     5
     """
\ No newline at end of file
@@ -1,8 +1,12 @@
 """ A pooled market
 """
 
+import numpy as np
+import pandas as pd
 from marketlib.markets import market
+from marketlib.markets import orderbook as ob
 from marketlib.utils import bidask as ba
+from marketlib.utils import allocation as alloc
 # from typing import override  # Need Python 3.12
 
 class PoolMarket(market.Market):
@@ -12,10 +16,62 @@ class PoolMarket(market.Market):
     then the problem of maximizing volume is NOT the same as minimizing the gap.
     """
 
+    def __init__(
+        self, 
+        alloc_type: str="uniform", 
+        divisible: bool=True, 
+        engine: str="vectorized", 
+        storage: str=None,
+        incremental: bool=False
+    ):
+        """ A pooled market.
+
+        Args:
+            alloc_type (str, optional): 
+                The name of the allocation method used after computing a clearing price.
+            divisible (bool, optional): 
+                If goods are divisible, fractional assignments are allowed. 
+            engine (str, optional): 
+                The name of the engine that computes the clearing price. 
+                "vectorized" (default) or "reference", the latter evaluates 
+                prices one by one and is kept to compare results.
+            storage (str, optional): 
+                A directory for an out-of-core orderbook whose columns are 
+                memory-mapped files. By default the orderbook is held in memory.
+            incremental (bool, optional): 
+                If True, the clearing price is kept up to date as orders are 
+                added, cancelled or modified, see indicative_price(). The 
+                engine argument is then ignored.
+
+        Raises:
+            ValueError: The allocation method or the clearing engine dose not exist.
+        """
+
+        super().__init__(alloc_type=alloc_type, divisible=divisible, storage=storage)
+
+        if engine not in ba.CLEARING_ENGINES:
+            raise ValueError(f"Invalid clearing engine: {engine}")
+
+        self.clearing_engine = ba.CLEARING_ENGINES[engine]
+
+        self._incremental = ba.IncrementalClearing(self.book) if incremental else None
+
+    def indicative_price(self):
+        """ The current clearing price, volume and gap, without allocation.
+
+        With incremental=True this only reads the maintained state, which 
+        is cheap enough to call after every order.
+
+        Returns:
+            A tuple of the form (clearing price, clearing volume, gap)
+        """
+
+        return self._compute_clearing_price()
+
     def _compute_clearing_price(self):
         """
         1. Sort the union of ask and bid prices in non-descending order.
-        2. Iterate over each price, compute the corresponding volume.
+        2. Evaluate the volume at each price.
         3. Return the price with the highest volume.
 
         Note: the volume should be non-decreasing as price increases to 
@@ -27,52 +83,92 @@ class PoolMarket(market.Market):
             (float), the clearing volume (int), and the gap (int)
         """
 
-        # self.book is the orderbook that stores all active bids and asks.
-        # Functions get_bids() / get_asks() returns an array of the form: 
-        # [bid/ask_price, unit].
-        bids = self.book.get_bids().tolist()
-        asks = self.book.get_asks().tolist()
-
-        if len(bids) == 0:
+        # Number of bid / ask price levels of the orderbook.
+        if len(self.book._levels[ob.BID]) == 0:
             print("There are no active bids.")
             return 0, 0, 0
 
-        elif len(asks) == 0:
+        elif len(self.book._levels[ob.ASK]) == 0:
             print("There are no active asks.")
             return 0, 0, 0
 
-        # Since prices are already sorted in bids and asks, the operations below 
-        # can be done in linear time where no additional sorting is needed.
-        prices = [x[0] for x in bids] + [y[0] for y in asks]
-        prices = sorted(set(prices))
+        if self._incremental is not None:
+            # The orderbook was replaced, e.g., by load().
+            if self._incremental.book is not self.book:
+                self._incremental = ba.IncrementalClearing(self.book)
 
-        cumu_bids, cumu_asks = {}, {}  # cumu_bids/asks: [bid/ask_price, number of feasible units].
+            clearing_price, volume, gap = self._incremental.clearing()
 
-        for i in range(0, len(bids)):
-            if i == 0:
-                cumu_bids[bids[i][0]] = bids[i][1]
-            else:
-                cumu_bids[bids[i][0]] = bids[i][1] + cumu_bids[bids[i-1][0]]
-        
-        for i in range(0, len(asks)):
-            if i == 0:
-                cumu_asks[asks[i][0]] = asks[i][1]
-            else:
-                cumu_asks[asks[i][0]] = asks[i][1] + cumu_asks[asks[i-1][0]]
+        else:
+            # self.book is the orderbook that stores all active bids and asks.
+            # Functions _get_bids() / _get_asks() returns an array of the form: 
+            # [bid/ask_price, unit].
+            bids = self.book._get_bids()
+            asks = self.book._get_asks()
+
+            clearing_price, volume, gap = self.clearing_engine(bids, asks)
+
+        # Whole units: the volume is capped here, before it is reported or 
+        # allocated, as clear_markets() does for each market.
+        if not self.divisible and clearing_price != 0:
+            volume = alloc.whole_volume(self, clearing_price, volume)
+
+        return clearing_price, volume, gap
+
+    def sensitivity(self, change : str="withdraw", factor : float=1.1, side : str="bid"):
+        """ The clearing price, volume and gap if one user changed their orders, for every user.
+
+        All users are evaluated together on the cached curves of the book 
+        (see bidask.perturbed_clearing()), the book itself is not changed.
+
+        Args:
+            change (str, optional): 
+                "withdraw": the user cancels all their bids and asks. 
+                "scale": the prices of the user's orders on one side are multiplied by factor.
+            factor (float, optional): 
+                The price factor of "scale", e.g., 1.1 raises the prices by 10%.
+            side (str, optional): 
+                The side scaled by "scale", either "bid" or "ask".
+
+        Returns:
+            A dataframe with columns "User" | "Price" | "Volume" | "Gap", one row per user.
 
-        # Compute the target price by iterating over all prices sorted in non-descending order.
-        curr_vol, curr_gap = -1, -1
+        Raises:
+            ValueError: The change or the side does not exist.
+        """
+
+        if change not in ("withdraw", "scale"):
+            raise ValueError(f"Invalid change: {change}")
+
+        if side not in ob.TYPES:
+            raise ValueError(f"Invalid order type: {side}")
 
-        for i in range(len(prices)):
-            new_vol, new_gap = ba.compute_vol(prices[i], cumu_bids, cumu_asks)
+        orders = self.book.orders
+        users, scenario = np.unique(orders["User"].to_numpy(), return_inverse=True)
+        scenario = scenario.reshape(-1)
+        is_bid = (orders["Type"].cat.codes == ob.BID).to_numpy()
+        price = orders["Price"].to_numpy()
+        unit = orders["Unit"].to_numpy()
 
-            if new_vol < curr_vol:  # this never gets called at i = 0.
-                return prices[i-1], curr_vol, curr_gap
+        if change == "withdraw":
+            unit, count = -unit, -np.ones(len(unit), dtype=np.int64)
+        else:
+            # Each order of the side moves from its price to the scaled price.
+            moved = is_bid if side == "bid" else ~is_bid
+            n = int(np.count_nonzero(moved))
 
-            curr_vol = new_vol
-            curr_gap = new_gap 
+            scenario = np.tile(scenario[moved], 2)
+            is_bid = np.tile(is_bid[moved], 2)
+            price = np.concatenate((price[moved], price[moved] * factor))
+            unit = np.concatenate((-unit[moved], unit[moved]))
+            count = np.repeat(np.array([-1, 1], dtype=np.int64), n)
 
-        return prices[-1], curr_vol, curr_gap
+        prices, volumes, gaps = ba.perturbed_clearing(
+            self.book._get_bids(), self.book._get_asks(), 
+            self.book._levels[ob.BID].counts(), self.book._levels[ob.ASK].counts(), 
+            (scenario, is_bid, price, unit, count), len(users))
+
+        return pd.DataFrame({"User" : users, "Price" : prices, "Volume" : volumes, "Gap" : gaps})
 
     # @override
     def clearing(self):
@@ -105,15 +201,120 @@ class PoolMarket(market.Market):
         print("\n---- Seller Allocation ----")
         print(self.alloc_seller)
 
+# ---------------------------
+# -   Batch Market Clearing   -
+# ---------------------------
+def clear_markets(orders : pd.DataFrame, alloc_type : str="uniform", divisible : bool=True):
+    """ Clear many independent pool markets in one call.
+
+    Gives the same clearing price, volume and gap as PoolMarket for each 
+    market, without building a PoolMarket per market: the orders of all 
+    markets are cleared and allocated together with segmented NumPy 
+    operations (see bidask.segmented_clearing()).
+
+    Note: users in the allocations are sorted by id, except for the "price" 
+    allocation which lists them in order of priority. The "uniform" 
+    allocation gives one row per user.
+
+    Args:
+        orders (pd.DataFrame): 
+            The stacked orders of all markets, with columns 
+            "Market" | "Unit" | "Price" | "Type" | "User", Type being "bid" or "ask".
+        alloc_type (str, optional): 
+            The name of the allocation method, as for PoolMarket.
+        divisible (bool, optional): 
+            If False, the allocations are whole units, as for PoolMarket.
+
+    Returns:
+        A tuple of three dataframes:
+            (clearing info with columns "Market" | "Price" | "Volume" | "Gap", 
+             buyer allocation with columns "Market" | "User" | "Units Bought" | "Price", 
+             seller allocation with columns "Market" | "User" | "Units Sold" | "Price")
+
+    Raises:
+        ValueError: The allocation method or an order type does not exist.
+    """
+
+    if alloc_type not in alloc.SEGMENTED_ALLOCATION_METHODS:
+        raise ValueError(f"Invalid allocation method: {alloc_type}")
+
+    invalid = ~orders["Type"].isin(ob.TYPES)
+    if invalid.any():
+        raise ValueError(f"Invalid order type: {orders['Type'][invalid].iloc[0]}")
+
+    labels, seg = np.unique(orders["Market"].to_numpy(), return_inverse=True)
+    seg = seg.reshape(-1)
+    unit = orders["Unit"].to_numpy(dtype=np.float64)
+    price = orders["Price"].to_numpy(dtype=np.float64)
+    user = orders["User"].to_numpy()
+    is_bid = (orders["Type"] == "bid").to_numpy()
+
+    prices, volumes, gaps, buyers, sellers = _clear_segments(seg, unit, price, is_bid, user, 
+                                                             len(labels), alloc_type, divisible)
+
+    info = pd.DataFrame({"Market" : labels, "Price" : prices, "Volume" : volumes, "Gap" : gaps})
+
+    allocations = []
+    for (a_seg, a_user, a_units), column in [(buyers, "Units Bought"), (sellers, "Units Sold")]:
+        allocations.append(pd.DataFrame({"Market" : labels[a_seg], "User" : a_user, 
+                                         column : a_units, "Price" : prices[a_seg]}))
+
+    return info, allocations[0], allocations[1]
+
+def _clear_segments(seg, unit, price, is_bid, user, n_markets, alloc_type, divisible=True):
+    """ Clear and allocate markets 0, 1, ..., n_markets - 1 given as flat order columns.
+
+    Returns:
+        A tuple (clearing prices, clearing volumes, gaps, buyer allocation, 
+        seller allocation), the allocations being tuples of arrays (market, user, units).
+    """
+
+    prices, volumes, gaps = ba.segmented_clearing(seg, unit, price, is_bid, n_markets=n_markets)
+
+    # Feasible orders of the markets that cleared.
+    cleared = (prices != 0)[seg]
+    feasible_bids = cleared & is_bid & (price >= prices[seg])
+    feasible_asks = cleared & ~is_bid & (price <= prices[seg])
+
+    # Whole units: the volumes and the units of the orders are rounded down 
+    # before allocating, the allocations after. The volume of a market is 
+    # capped at the whole units each side offers, so no user gets more than
+    # it bid or asked.
+    if not divisible:
+        unit = np.floor(unit)
+        volumes = np.floor(volumes)
+        for feasible in (feasible_bids, feasible_asks):
+            offered = np.bincount(seg[feasible], weights=unit[feasible], minlength=len(volumes))
+            volumes = np.minimum(volumes, offered)
+
+    alloc_method = alloc.SEGMENTED_ALLOCATION_METHODS[alloc_type]
+    allocations = []
+    for feasible, descending in [(feasible_bids, True), (feasible_asks, False)]:
+        a_seg, a_user, a_units = alloc_method(seg[feasible], user[feasible], unit[feasible], 
+                                              price[feasible], descending, volumes)
+        if not divisible:
+            a_units = alloc._largest_remainder(a_seg, a_units, volumes)
+
+        allocations.append((a_seg, a_user, a_units))
+
+    return prices, volumes, gaps, allocations[0], allocations[1]
+
 if __name__ == "__main__": # python3 -m marketlib.markets.pool
 
     allocation_methods = ["proportional", "uniform", "price", "welfare"]
 
+    book = None
     for alloc_type in allocation_methods:
         P = PoolMarket(alloc_type=alloc_type, divisible=True)
 
-        P.bid_csv("./data/example_bids.csv")
-        P.ask_csv("./data/example_asks.csv")
+        # The markets share one orderbook, so the curves and feasible sets 
+        # computed by the first clearing are reused by the others.
+        if book is None:
+            P.bid_csv("./data/example_bids.csv")
+            P.ask_csv("./data/example_asks.csv")
+            book = P.book
+        else:
+            P.book = book
 
         print(f"Allocation method: {alloc_type}")
         P.clearing()
@@ -162,7 +363,6 @@ if __name__ == "__main__": # python3 -m marketlib.markets.pool
     0    0    6.333333    2.0
     1    1    6.333333    2.0
     2    2    6.333333    2.0
-    3    0    6.333333    2.0
 
     3. Price: 
 
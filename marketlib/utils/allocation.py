@@ -3,8 +3,112 @@
     Allocation happens after a clearing price is computed.
 """
 
+import numpy as np
 import pandas as pd
-from itertools import zip_longest
+from marketlib.markets import orderbook as ob
+
+# ------------------------------
+# -   Allocation Result        -
+# ------------------------------
+class AllocationResult():
+    """ The allocation of one side of a market, backed by NumPy arrays.
+
+    Clearing results are kept as arrays, so simulation loops can read the 
+    totals without building a dataframe. to_frame() builds the dataframe 
+    with columns "User" | "Units Bought" (or "Units Sold") | "Price" on demand.
+
+    Attributes:
+        side (str): 
+            Either "buyer" or "seller".
+        users (array): 
+            The user id of each allocation.
+        units (array): 
+            The number of units bought or sold.
+        prices (array): 
+            The per-unit price.
+        welfare (array): 
+            The utility of each allocation: the valuation of the units minus 
+            the payment for buyers, the payment minus the valuation for sellers. 
+            NaN where the valuation is not known.
+    """
+
+    # The dataframe column of the units of each side.
+    UNIT_COLUMNS = {
+        "buyer" : "Units Bought",
+        "seller" : "Units Sold"
+    }
+
+    def __init__(self, side : str, users=(), units=(), prices=(), welfare=None):
+        """ An allocation result.
+
+        Args:
+            side (str): 
+                Either "buyer" or "seller".
+            users, units, prices (array-like, optional): 
+                One entry per allocation. Empty by default.
+            welfare (array-like, optional): 
+                The utility of each allocation. NaN if not given.
+
+        Raises:
+            ValueError: The side does not exist.
+        """
+
+        if side not in self.UNIT_COLUMNS:
+            raise ValueError(f"Invalid side: {side}")
+
+        self.side = side
+        self.users = np.asarray(users, dtype=np.int64)
+        self.units = np.asarray(units, dtype=np.float64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.welfare = (np.full(len(self.users), np.nan) if welfare is None 
+                        else np.asarray(welfare, dtype=np.float64))
+
+        self._frame = None
+
+    def __len__(self):
+        return len(self.users)
+
+    def __repr__(self):
+        return repr(self.to_frame())
+
+    @property
+    def total_units(self):
+        """ The total number of units allocated.
+        """
+        return float(self.units.sum())
+
+    @property
+    def total_welfare(self):
+        """ The total utility of the allocations.
+        """
+        return float(self.welfare.sum())
+
+    def append(self, other):
+        """ A new result with the allocations of other after the ones of self.
+        """
+
+        if len(self) == 0:
+            return other
+
+        return AllocationResult(self.side, 
+                                np.concatenate((self.users, other.users)), 
+                                np.concatenate((self.units, other.units)), 
+                                np.concatenate((self.prices, other.prices)), 
+                                np.concatenate((self.welfare, other.welfare)))
+
+    def to_frame(self):
+        """ The allocations as a dataframe, built on the first call.
+
+        Returns:
+            A dataframe with columns "User" | "Units Bought" (or "Units Sold") | "Price".
+        """
+
+        if self._frame is None:
+            self._frame = pd.DataFrame({"User" : self.users, 
+                                        self.UNIT_COLUMNS[self.side] : self.units, 
+                                        "Price" : self.prices})
+
+        return self._frame
 
 # ------------------------------
 # -   Feasible Bids and Asks   -
@@ -22,11 +126,72 @@ def feasible_bidask(M, clearing_price : float):
         A tuple of the form: (Orderbook for feasible buyers, Orderbook for feasible sellers).
     """
 
-    feasible_bids = M.book.orders[(M.book.orders["Type"] == "bid") & (M.book.orders["Price"] >= clearing_price)]
-    feasible_asks = M.book.orders[(M.book.orders["Type"] == "ask") & (M.book.orders["Price"] <= clearing_price)]
+    # The feasible orders are a prefix of each price-sorted side of the book 
+    # (or gathered chunk by chunk for memory-mapped books), so the whole book 
+    # is never materialized as a dataframe.
+    feasible_bids = M.book._feasible(ob.BID, clearing_price)
+    feasible_asks = M.book._feasible(ob.ASK, clearing_price)
 
     return feasible_bids, feasible_asks
 
+def whole_volume(M, clearing_price : float, volume : float):
+    """ The clearing volume of a market whose goods are not divisible.
+
+    The volume is rounded down, and capped at the whole units of the 
+    feasible orders of each side, so no user gets more than it bid or asked.
+
+    Args:
+        M (Market): 
+            A market instance.
+        clearing_price (float): 
+            The market clearing price.
+        volume (float): 
+            The clearing volume.
+
+    Returns:
+        The volume in whole units (float).
+    """
+
+    offered = [np.floor(M.book._feasible_columns(type_code, clearing_price)["Unit"]).sum() 
+               for type_code in (ob.BID, ob.ASK)]
+
+    return float(min(np.floor(volume), *offered))
+
+def _allocate(M, clearing_price, volume, kernel):
+    """ Run an allocation kernel (see Segmented Allocations) on both sides of M.
+
+    Each side's result is built once and appended to M.alloc_buyer / M.alloc_seller. 
+    If the goods of M are not divisible, the volume is expected in whole 
+    units (see whole_volume()), and so are the allocations, see 
+    _largest_remainder().
+    """
+
+    # Slices of the price-sorted sides of the book, no copy.
+    sides = []
+    for type_code in (ob.BID, ob.ASK):
+        feasible = M.book._feasible_columns(type_code, clearing_price)
+        sides.append((feasible["User"], feasible["Unit"], feasible["Price"]))
+
+    volume = np.array([volume], dtype=np.float64)
+    if not M.divisible:
+        sides = [(user, np.floor(unit), price) for user, unit, price in sides]
+
+    clearing_prices = np.array([clearing_price], dtype=np.float64)
+
+    for (user, unit, price), descending, attr, side in zip(sides, (True, False), 
+                                                           ("alloc_buyer", "alloc_seller"), 
+                                                           ("buyer", "seller")):
+        seg = np.zeros(len(user), dtype=np.int64)
+
+        a_seg, users, units = kernel(seg, user, unit, price, descending, volume)
+        if not M.divisible:
+            units = _largest_remainder(a_seg, units, volume)
+        welfare = _allocation_welfare(seg, user, unit, price, descending, 
+                                      a_seg, users, units, clearing_prices)
+
+        result = AllocationResult(side, users, units, np.full(len(users), clearing_price), welfare)
+        setattr(M, attr, getattr(M, attr).append(result))
+
 # -------------------------------
 # -   Proportional Allocation   -
 # -------------------------------
@@ -51,32 +216,8 @@ def proportional_allocation(M, clearing_price, volume):
         None. The two attributes: alloc_seller and alloc_buyer of M are updated to record the resulting allocations.
     """
 
-    # Extract the number of feasible units for each buyer/seller if they 
-    # have incentives to buy/sell under the clearing price.
-    feasible_bids, feasible_asks = feasible_bidask(M, clearing_price)
-
-    # Step I: Compute the total units for each user that is willing to trade.
-    buyer_allocation = feasible_bids.groupby("User")["Unit"].sum().to_dict()
-    seller_allocation = feasible_asks.groupby("User")["Unit"].sum().to_dict()
+    _allocate(M, clearing_price, volume, _segmented_proportional)
 
-    # Step II: compute the total feasible bid and ask units.
-    # This total sum might not equal to the clearing volume, as true
-    # clearing might not exist.
-    total_buy = sum(buyer_allocation.values())
-    total_sell = sum(seller_allocation.values())
-
-    # Step III: allocation.
-    for buyer in buyer_allocation.keys():
-        active_vol = volume * (buyer_allocation[buyer] / total_buy) 
-        new_row = pd.DataFrame({"User" : [buyer], "Units Bought" : [active_vol], "Price" : [clearing_price]})
-
-        M.alloc_buyer = pd.concat([M.alloc_buyer, new_row], ignore_index=True)
-
-    for seller in seller_allocation.keys():
-        active_vol = volume * (seller_allocation[seller] / total_sell) 
-        new_row = pd.DataFrame({"User" : [seller], "Units Sold" : [active_vol], "Price" : [clearing_price]})
-
-        M.alloc_seller = pd.concat([M.alloc_seller, new_row], ignore_index=True)
 
 # --------------------------
 # -   Uniform Allocation   -
@@ -100,23 +241,8 @@ def uniform_allocation(M, clearing_price, volume):
         None. The two attributes: alloc_seller and alloc_buyer of M are updated to record the resulting allocations.
     """
 
-    # Extract the number of units for each buyer/seller.
-    feasible_bids, feasible_asks = feasible_bidask(M, clearing_price)
+    _allocate(M, clearing_price, volume, _segmented_uniform)
 
-    # Step I: Compute the number of buyers/sellers that are willing to trade.
-    buyer_num = feasible_bids["User"].nunique()
-    seller_num = feasible_asks["User"].nunique()
-
-    # Step II: Evenly divide the clearing units.
-    for buyer in feasible_bids["User"]:
-        active_vol = volume / buyer_num
-        new_row = pd.DataFrame({"User" : [buyer], "Units Bought" : [active_vol], "Price" : [clearing_price]})
-        M.alloc_buyer = pd.concat([M.alloc_buyer, new_row], ignore_index=True)
-
-    for seller in feasible_asks["User"]:
-        active_vol = volume / seller_num
-        new_row = pd.DataFrame({"User" : [seller], "Units Sold" : [active_vol], "Price" : [clearing_price]})
-        M.alloc_seller = pd.concat([M.alloc_seller, new_row], ignore_index=True)
 
 # ------------------------------
 # -   Price-Based Allocation   -
@@ -141,68 +267,9 @@ def price_priority_allocation(M, clearing_price, volume):
         None. The two attributes: alloc_seller and alloc_buyer of M are updated to record the resulting allocations.
     """
 
-    feasible_bids, feasible_asks = feasible_bidask(M, clearing_price)
-
-    # Step I: Compute the averaged per-unit price.
-    # buyer_price_dict = {buyer : per-unit price}
-    buyer_price_dict, seller_price_dict = {}, {}
-
-    # total_units_buyer = {buyer : units}
-    total_units_buyer = feasible_bids.groupby("User")["Unit"].sum().to_dict()
-    total_units_seller = feasible_asks.groupby("User")["Unit"].sum().to_dict()
-
-    for row in feasible_bids.itertuples(index=False):
-        buyer = row.User
-        units = row.Unit
-        price = row.Price
-        if buyer not in buyer_price_dict:
-            buyer_price_dict[buyer] = price * units
-        else:
-            buyer_price_dict[buyer] += price * units
-
-    for buyer in buyer_price_dict.keys(): 
-        buyer_price_dict[buyer] /= total_units_buyer[buyer]
-    
-    for row in feasible_asks.itertuples(index=False):
-        seller = row.User
-        units = row.Unit
-        price = row.Price
-        if seller not in seller_price_dict:
-            seller_price_dict[seller] = price * units
-        else:
-            seller_price_dict[seller] += price * units
-
-    for seller in seller_price_dict.keys(): 
-        seller_price_dict[seller] /= total_units_seller[seller]
-
-    # Step II: Ranking buyers and sellers by their per-unit-price.
-    # Python 3.7+ supports ordered dict. Not using it here. 
-    ordered_buyer = sorted(buyer_price_dict.keys(), 
-                           key=lambda x: buyer_price_dict[x], reverse=True)
-    
-    # Sellers are ranked in non-descending order.
-
-    ordered_seller = sorted(seller_price_dict.keys(), 
-                            key=lambda x: seller_price_dict[x])
-
-    # Step III: Allocate the volumes based on the ordering.
-    buy_volume, sell_volume = volume, volume
-
-    for buyer, seller in zip_longest(ordered_buyer, ordered_seller, fillvalue=None):
-        if buyer is not None and buy_volume != 0:
-            vol = min(total_units_buyer[buyer], buy_volume)
-            buy_volume = max(0, buy_volume - vol)
+    _allocate(M, clearing_price, volume, _segmented_price)
 
-            new_row = pd.DataFrame({"User" : [buyer], "Units Bought" : [vol], "Price" : [clearing_price]})
-            M.alloc_buyer = pd.concat([M.alloc_buyer, new_row], ignore_index=True)
 
-        if seller is not None and sell_volume != 0:
-            vol = min(total_units_seller[seller], sell_volume)
-            sell_volume = max(0, sell_volume - vol)
-
-            new_row = pd.DataFrame({"User" : [seller], "Units Sold" : [vol], "Price" : [clearing_price]})
-            M.alloc_seller = pd.concat([M.alloc_seller, new_row], ignore_index=True)
-    
 # ------------------------------
 # -   Max-Welfare Allocation   -
 # ------------------------------
@@ -235,48 +302,227 @@ def welfare_allocation(M, clearing_price, volume):
         None. The two attributes: alloc_seller and alloc_buyer of M are updated to record the resulting allocations.
     """
 
-    feasible_bids, feasible_asks = feasible_bidask(M, clearing_price)
+    _allocate(M, clearing_price, volume, _segmented_welfare)
+
+
+# ------------------------------
+# -   Segmented Allocations    -
+# ------------------------------
+# The functions below allocate many independent markets (segments) at once 
+# on NumPy arrays. Each takes the feasible orders of one side of all markets:
+#     seg, user, unit, price (array): one entry per feasible order, seg is 
+#         the index of the market of the order.
+#     descending (bool): True for bids (higher prices first), False for asks.
+#     volume (array): the clearing volume of each market.
+# and returns a tuple of arrays (seg, user, units allocated). The allocation 
+# functions above run them on a single market (segment 0).
+
+def _group_users(seg, user, unit, price):
+    """ Total units and average per-unit price of each user in each segment.
+
+    Returns:
+        A tuple of arrays (seg, user, total units, average price, first order), 
+        sorted by segment then user. "first order" is the position of the 
+        first order of the user in the input.
+    """
+
+    if len(seg) == 0:
+        empty = np.empty(0)
+        return seg, user, empty, empty, np.empty(0, dtype=np.int64)
+
+    order = np.lexsort((user, seg))
+    s, u = seg[order], user[order]
+
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (s[1:] != s[:-1]) | (u[1:] != u[:-1])
+    starts = np.flatnonzero(new_group)
+
+    totals = np.add.reduceat(unit[order], starts)
+    values = np.add.reduceat((unit * price)[order], starts)
+    avg = np.divide(values, totals, out=np.zeros_like(values), where=totals != 0)
+    first = np.minimum.reduceat(order, starts)
+
+    return s[starts], u[starts], totals, avg, first
+
+def _segment_exclusive_cumsum(seg, values):
+    """ Cumulative sum within each segment, excluding the current entry.
+
+    seg must be sorted, i.e., the entries of a segment are contiguous.
+    """
+
+    cumu = np.cumsum(values)
+    excl = cumu - values
+
+    new_seg = np.ones(len(seg), dtype=bool)
+    new_seg[1:] = seg[1:] != seg[:-1]
+    starts = np.flatnonzero(new_seg)
+
+    # Subtract the total before the segment, repeated over the segment.
+    base = np.repeat(excl[starts], np.diff(np.append(starts, len(seg))))
+    return excl - base
+
+def _segmented_proportional(seg, user, unit, price, descending, volume):
+    """ Segmented version of proportional_allocation(), users sorted by id.
+
+    Each user gets a share of the clearing volume of its segment in 
+    proportion to the total units of its feasible orders.
+    """
+
+    g_seg, g_user, totals, _, _ = _group_users(seg, user, unit, price)
+    seg_totals = np.bincount(g_seg, weights=totals, minlength=len(volume))
+
+    # Segments without units, e.g., whole units of fractional orders, trade nothing.
+    shares = np.divide(totals, seg_totals[g_seg], out=np.zeros_like(totals), 
+                       where=seg_totals[g_seg] > 0)
+
+    return g_seg, g_user, volume[g_seg] * shares
+
+def _segmented_uniform(seg, user, unit, price, descending, volume):
+    """ Segmented version of uniform_allocation(), users sorted by id.
+
+    The clearing volume of each segment is divided evenly among the users 
+    with feasible orders in it, but no user gets more than its total units: 
+    what a user cannot take is divided evenly among the others.
+    """
+
+    g_seg, g_user, totals, _, _ = _group_users(seg, user, unit, price)
+
+    # Users of each segment by total units. If the k smallest users take 
+    # all their units, the others get (volume - their units) / (n - k) each.
+    order = np.lexsort((totals, g_seg))
+    s_seg, s_totals = g_seg[order], totals[order]
+    before = _segment_exclusive_cumsum(s_seg, s_totals)
+    others = np.bincount(s_seg, minlength=len(volume))[s_seg] - _segment_exclusive_cumsum(s_seg, np.ones(len(s_seg)))
+    level = (volume[s_seg] - before) / others
 
-    # Step I: Sort the bids (non-ascending) and asks (non-descending) by price.
-    # Note that we sort bids and asks, not participants.
-    feasible_bids = feasible_bids.sort_values(by="Price", ascending=False)
-    feasible_asks = feasible_asks.sort_values(by="Price", ascending=True)
+    # The share of a segment is the level at its first user that cannot 
+    # take it all (the levels only decrease from there on).
+    share = np.full(len(volume), -np.inf)
+    capped = s_totals >= level
+    np.maximum.at(share, s_seg[capped], level[capped])
+    share[share == -np.inf] = np.inf
 
-    # Step II: allocation by prices
-    buy_welfare, sell_welfare = 0, 0  # Nice to keep track
-    buy_vol, sell_vol = volume, volume
+    units = np.empty(len(totals))
+    units[order] = np.minimum(s_totals, share[s_seg])
 
-    for row in feasible_bids.itertuples(index=False):
-        if buy_vol == 0:  # When all volumes are allocated
-            break
-        buyer = row.User
-        units = row.Unit
-        price = row.Price
+    return g_seg, g_user, units
+
+def _segmented_price(seg, user, unit, price, descending, volume):
+    """ Segmented version of price_priority_allocation(), users in order of priority.
+
+    Users are ranked by their average per-unit price within each segment, 
+    ties broken by their first order. The allocation of each user is its 
+    total units, cut off once the clearing volume is used up.
+    """
+
+    g_seg, g_user, totals, avg, first = _group_users(seg, user, unit, price)
+
+    order = np.lexsort((first, -avg if descending else avg, g_seg))
+    g_seg, g_user, totals = g_seg[order], g_user[order], totals[order]
+
+    before = _segment_exclusive_cumsum(g_seg, totals)
+    units = np.clip(volume[g_seg] - before, 0, totals)
+
+    keep = units > 0
+    return g_seg[keep], g_user[keep], units[keep]
+
+def _segmented_welfare(seg, user, unit, price, descending, volume):
+    """ Segmented version of welfare_allocation(), users sorted by id.
+
+    Orders are ranked by price within each segment (ties in the order they 
+    were given), each order is allocated its units until the clearing volume 
+    is used up, then the allocations are summed per user.
+    """
+
+    order = np.lexsort((np.arange(len(seg)), -price if descending else price, seg))
+    o_seg, o_unit = seg[order], unit[order]
+
+    before = _segment_exclusive_cumsum(o_seg, o_unit)
+    units = np.clip(volume[o_seg] - before, 0, o_unit)
+
+    keep = units > 0
+    g_seg, g_user, totals, _, _ = _group_users(o_seg[keep], user[order][keep], units[keep], 
+                                               np.zeros(int(keep.sum())))
+    return g_seg, g_user, totals
+
+def _largest_remainder(seg, quotas, volume):
+    """ Round the allocations of each segment to whole units, keeping their sum.
+
+    Each allocation is rounded down, then the units left in the segment go 
+    one each to the allocations with the largest fractional parts (ties to 
+    the first one). Whole-unit allocations, e.g., from the price and welfare 
+    kernels run on whole units, are kept as they are.
+
+    Args:
+        seg (array): 
+            Segment of each allocation.
+        quotas (array): 
+            The (fractional) units of each allocation.
+        volume (array): 
+            The clearing volume of each segment, a whole number.
+
+    Returns:
+        An array of whole units, in the order of quotas.
+    """
+
+    units = np.floor(quotas)
+    remainders = quotas - units
+    if len(units) == 0:
+        return units
+
+    # Units left to hand out in each segment.
+    left = np.rint(volume - np.bincount(seg, weights=units, minlength=len(volume))).astype(np.int64)
+
+    order = np.lexsort((np.arange(len(units)), -remainders, seg))
+    ranks = _segment_exclusive_cumsum(seg[order], np.ones(len(order)))
+
+    extra = order[ranks < left[seg[order]]]
+    units[extra] += 1
+
+    return units
+
+def _allocation_welfare(seg, user, unit, price, descending, a_seg, a_user, a_units, clearing_prices):
+    """ The utility of each allocation (a_seg, a_user, a_units) returned by a kernel.
+
+    The units allocated to a user are taken from their feasible orders with 
+    the best prices first (highest bids, lowest asks). Each unit counts the 
+    gap between its order price and the clearing price of its segment.
+
+    Returns:
+        An array with the utility of each allocation, in the order of a_user.
+    """
 
-        actual_units = min(buy_vol, units)
-        buy_vol = max(0, buy_vol - actual_units)
-        buy_welfare += (price - clearing_price) * actual_units
+    if len(a_user) == 0:
+        return np.empty(0)
 
-        new_row = pd.DataFrame({"User" : [buyer], "Units Bought" : [actual_units], "Price" : [clearing_price]})
-        M.alloc_buyer = pd.concat([M.alloc_buyer, new_row], ignore_index=True)
+    # Map each (segment, user) pair to one integer key.
+    low = min(user.min(), a_user.min())
+    width = max(user.max(), a_user.max()) - low + 1
+    keys = seg * width + (user - low)
+    a_keys = a_seg * width + (a_user - low)
 
-    M.alloc_buyer = M.alloc_buyer.groupby("User", as_index=False).agg({"Units Bought": "sum", "Price": "first"})
+    # Orders grouped by key, best price first.
+    order = np.lexsort((np.arange(len(seg)), -price if descending else price, keys))
+    keys, unit, price, o_seg = keys[order], unit[order], price[order], seg[order]
 
-    for row in feasible_asks.itertuples(index=False):
-        if sell_vol == 0:
-            break
-        seller = row.User
-        units = row.Unit
-        price = row.Price
+    # Units allocated to the group of each order.
+    sorted_keys = np.argsort(a_keys, kind='stable')
+    where = np.searchsorted(a_keys[sorted_keys], keys)
+    where = np.minimum(where, len(a_keys) - 1)
+    found = a_keys[sorted_keys][where] == keys
+    allocated = np.where(found, a_units[sorted_keys][where], 0)
 
-        actual_units = min(sell_vol, units)
-        sell_vol = max(0, sell_vol - actual_units)
-        sell_welfare += (price - clearing_price) * actual_units
+    before = _segment_exclusive_cumsum(keys, unit)
+    filled = np.clip(allocated - before, 0, unit)
 
-        new_row = pd.DataFrame({"User" : [seller], "Units Sold" : [actual_units], "Price" : [clearing_price]})
-        M.alloc_seller = pd.concat([M.alloc_seller, new_row], ignore_index=True)
+    gap = price - clearing_prices[o_seg] if descending else clearing_prices[o_seg] - price
+    values = np.bincount(np.where(found, where, 0), weights=np.where(found, gap * filled, 0), 
+                         minlength=len(a_keys))
 
-    M.alloc_seller = M.alloc_seller.groupby("User", as_index=False).agg({"Units Sold": "sum", "Price": "first"})
+    # Back to the order of a_user.
+    welfare = np.empty(len(a_keys))
+    welfare[sorted_keys] = values
+    return welfare
 
 # Factory
 ALLOCATION_METHODS = {
@@ -284,4 +530,11 @@ ALLOCATION_METHODS = {
     "uniform" : uniform_allocation,
     "price" : price_priority_allocation,
     "welfare" : welfare_allocation
-}
\ No newline at end of file
+}
+
+SEGMENTED_ALLOCATION_METHODS = {
+    "proportional" : _segmented_proportional,
+    "uniform" : _segmented_uniform,
+    "price" : _segmented_price,
+    "welfare" : _segmented_welfare
+}
@@ -1,7 +1,38 @@
 from typing import Dict
-import pandas as pd
+from marketlib.utils import allocation as alloc
 import warnings
 
+def _split_item(M, winners, valuation, payment, paid=False):
+    """ Share the item evenly among the winners and record it in M.alloc_buyer.
+
+    Each winner gets 1/len(winners) of the item and pays (or, if paid, 
+    receives) the same share of the payment. As in the other allocations, 
+    the welfare of a winner is the gap between its bid and the payment 
+    per unit, times its units. It is 0 when the payment is the winning bid 
+    (first-price and reverse auctions).
+
+    Args:
+        M (Market):
+            A one-sided market instance.
+        winners (list):
+            The user ids of the winners.
+        valuation (float):
+            The bid of the winners.
+        payment (float):
+            The price of the whole item.
+        paid (bool, optional):
+            If True, the winners are paid the price, as in a reverse auction.
+    """
+
+    share = 1 / len(winners)
+    gap = payment - valuation if paid else valuation - payment
+
+    units = [share] * len(winners)
+    prices = [payment * share] * len(winners)
+    welfare = [gap * share] * len(winners)
+
+    M.alloc_buyer = alloc.AllocationResult("buyer", winners, units, prices, welfare)
+
 # ----------------- 
 #   First Price   -
 # ----------------- 
@@ -26,12 +57,7 @@ def first_price_sealed_bid(M, bids : Dict):
     winning_bid = max(bids.values())  # As in the first price auction.
     winners = [u for u, bid in bids.items() if bid == winning_bid]
 
-    rows = []
-    for u in winners:
-        new_row = {"User" : u, "Units Bought" : 1/len(winners), "Price" : winning_bid * 1/len(winners)}
-        rows.append(new_row)
-
-    M.alloc_buyer = pd.DataFrame(rows)
+    _split_item(M, winners, winning_bid, winning_bid)
 
 # ----------------- 
 #   Second Price  -
@@ -64,12 +90,7 @@ def second_price_sealed_bid(M, bids : Dict):
 
     winners = [u for u, bid in bids.items() if bid == max_bid]
 
-    rows = []
-    for u in winners:
-        new_row = {"User" : u, "Units Bought" : 1/len(winners), "Price" : sec_bid * 1/len(winners)}
-        rows.append(new_row)
-
-    M.alloc_buyer = pd.DataFrame(rows)
+    _split_item(M, winners, max_bid, sec_bid)
 
 # -------------------- 
 #   Double Auction   -
@@ -102,12 +123,7 @@ def reverse_auction(M, bids : Dict):
     winning_bid = min(bids.values())  # As in the reverse auction.
     winners = [u for u, bid in bids.items() if bid == winning_bid]
 
-    rows = []
-    for u in winners:
-        new_row = {"User" : u, "Units Bought" : 1/len(winners), "Price" : winning_bid * 1/len(winners)}
-        rows.append(new_row)
-
-    M.alloc_buyer = pd.DataFrame(rows)
+    _split_item(M, winners, winning_bid, winning_bid, paid=True)
 
 
 
@@ -1,5 +1,4 @@
-from collections import defaultdict
-import pandas as pd
+from marketlib.utils import allocation as alloc
 
 def middle_bargaining(M, matching):
     """
@@ -13,7 +12,9 @@ def middle_bargaining(M, matching):
             The market where bargaining happens.
 
         matching (dict): 
-            The buyer-seller matching returned by a matching mechanism.
+            The buyer-seller matching returned by a matching mechanism. With
+            a transport matching, {buyer_id : {seller_id : units}}, a user 
+            trades with each of its partners, up to the units routed to it.
     
     Returns:
         None
@@ -21,54 +22,51 @@ def middle_bargaining(M, matching):
         record the resulting allocations.
     """
 
-    bids = M.book.orders[(M.book.orders["Type"] == "bid")]
-    asks = M.book.orders[(M.book.orders["Type"] == "ask")]
-
-    # Format: {user_id : [(price, units) ...]}
-    buyer_price_dict, seller_price_dict = defaultdict(list), defaultdict(list)
-
-    for row in bids.itertuples(index=False):
-        user = row.User
-        price = row.Price
-        units = row.Unit
-
-        buyer_price_dict[user].append([price, units])
-
-    for row in asks.itertuples(index=False):
-        user = row.User
-        price = row.Price
-        units = row.Unit
-
-        seller_price_dict[user].append([price, units])
-
-    # Sort by price. For buyers, in descending order, sellers, in ascending
-    # orders.
-    for user, prices in buyer_price_dict.items():
-        prices.sort(reverse=True)
-
-    for user, prices in seller_price_dict.items():
-        prices.sort()
-
+    # (buyer, seller, most units) of each pair.
+    pairs = []
+    for buyer, seller in matching.items():
+        if isinstance(seller, dict):
+            pairs.extend((buyer, partner, cap) for partner, cap in seller.items())
+        else:
+            pairs.append((buyer, seller, float("inf")))
+
+    # Format: {user_id : [[price, units] ...]}. Only the ladders of the 
+    # matched users are read from the user index of the orderbook. Bids 
+    # are sorted by price in descending order, asks in ascending order.
+    # A user with several partners trades from the same ladder, so the 
+    # current level of each ladder is kept across pairs.
+    buyer_price_dict = {buyer : M.book.user_orders(buyer, "bid").tolist() for buyer, _, _ in pairs}
+    seller_price_dict = {seller : M.book.user_orders(seller, "ask").tolist() for _, seller, _ in pairs}
+    buyer_level, seller_level = dict.fromkeys(buyer_price_dict, 0), dict.fromkeys(seller_price_dict, 0)
+
+    # Columns of the allocations, one entry per pair that trades.
+    users = ([], [])
+    units, prices, welfare = [], [], []
 
     # Meet in the middle from the supply and demand curve
-    for buyer, seller in matching.items():
+    for buyer, seller, cap in pairs:
         total_units = 0
         avg_price = 0
-        i, j = 0, 0
+        surplus = 0
+        i, j = buyer_level[buyer], seller_level[seller]
 
         while (i < len(buyer_price_dict[buyer]) 
-               and j < len(seller_price_dict[seller])):
+               and j < len(seller_price_dict[seller])
+               and total_units < cap):
             # When the buying price is less than the selling price, no trade
             # could happen.
             if buyer_price_dict[buyer][i][0] < seller_price_dict[seller][j][0]:
                 break
 
             min_units = min(buyer_price_dict[buyer][i][1],
-                            (seller_price_dict[seller][j][1]))
+                            seller_price_dict[seller][j][1],
+                            cap - total_units)
 
             total_units += min_units
             avg_price += (buyer_price_dict[buyer][i][0] 
                           + seller_price_dict[seller][j][0]) / 2 * min_units 
+            surplus += (buyer_price_dict[buyer][i][0] 
+                        - seller_price_dict[seller][j][0]) * min_units
 
             buyer_price_dict[buyer][i][1] -= min_units
             seller_price_dict[seller][j][1] -= min_units
@@ -78,15 +76,27 @@ def middle_bargaining(M, matching):
 
             if seller_price_dict[seller][j][1] == 0:
                 j += 1
+
+        buyer_level[buyer], seller_level[seller] = i, j
         
+        # The pair could not agree on any unit, e.g., the buyer bids less 
+        # than the seller asks.
+        if total_units == 0:
+            continue
+
         # Update avg_price
         avg_price /= total_units
 
-        new_row = pd.DataFrame({"User" : [buyer], "Units Bought" : [total_units], "Price" : [avg_price]})
-        M.alloc_buyer = pd.concat([M.alloc_buyer, new_row], ignore_index=True)
+        users[0].append(buyer)
+        users[1].append(seller)
+        units.append(total_units)
+        prices.append(avg_price)
+
+        # Each unit trades at the middle price, so the surplus is split evenly.
+        welfare.append(surplus / 2)
 
-        new_row = pd.DataFrame({"User" : [seller], "Units Sold" : [total_units], "Price" : [avg_price]})
-        M.alloc_seller = pd.concat([M.alloc_seller, new_row], ignore_index=True)
+    M.alloc_buyer = M.alloc_buyer.append(alloc.AllocationResult("buyer", users[0], units, prices, welfare))
+    M.alloc_seller = M.alloc_seller.append(alloc.AllocationResult("seller", users[1], units, prices, welfare))
 
 
 def nash_bargaining(M, matching):
@@ -3,6 +3,7 @@
 
 from typing import List
 from typing import Dict
+import numpy as np
 
 # ----------------------
 # -   Cumulative Sum   -
@@ -131,12 +132,675 @@ def compute_vol(p : float, cumu_bids : Dict, cumu_asks : Dict):
     bid_prices = sorted(cumu_bids.keys(), reverse=True)
     ask_prices = sorted(cumu_asks.keys())
 
-    # Find the feasible bid and ask volumes
-    bid_vol = cumu_bids[search_bid(p, bid_prices)]
-    ask_vol = cumu_asks[search_ask(p, ask_prices)]
+    # Find the feasible bid and ask volumes. The searches return -1 when no
+    # bid (ask) is feasible under p, in which case the volume is zero.
+    bid_vol = cumu_bids.get(search_bid(p, bid_prices), 0)
+    ask_vol = cumu_asks.get(search_ask(p, ask_prices), 0)
 
     # The final clearing volume is always the minimum volume between bids and
     # asks. The gap is then the remaining uncleared feasible volume.
     vol, gap = min(bid_vol, ask_vol), abs(bid_vol - ask_vol)
 
-    return vol, gap
\ No newline at end of file
+    return vol, gap
+
+# ---------------------------------
+# -   Reference clearing engine   -
+# ---------------------------------
+def reference_clearing(bids : List, asks : List):
+    """ Compute the volume-maximizing price by evaluating each price in turn.
+
+    1. Sort the union of ask and bid prices in non-descending order.
+    2. Iterate over each price, compute the corresponding volume.
+    3. Return the price with the highest volume.
+
+    Note: the volume should be non-decreasing as price increases to 
+    the volume-maximizing price. Therefore,  once we see the volume start 
+    to decrease, the previous price is then the target price.
+
+    Each call to compute_vol re-sorts the prices, so this takes 
+    O(P^2 log P) time for P distinct prices. Kept as a reference for 
+    vectorized_clearing().
+
+    Args:
+        bids (list): 
+            The demand curve [[bid_price, units], ...], sorted in non-ascending order by prices.
+        asks (list): 
+            The supply curve [[ask_price, units], ...], sorted in non-descending order by prices.
+
+    Returns:
+        A tuple of the form (clearing price, clearing volume, gap)
+    """
+
+    bids, asks = list(map(list, bids)), list(map(list, asks))
+
+    # Since prices are already sorted in bids and asks, the operations below 
+    # can be done in linear time where no additional sorting is needed.
+    prices = [x[0] for x in bids] + [y[0] for y in asks]
+    prices = sorted(set(prices))
+
+    cumu_bids, cumu_asks = {}, {}  # cumu_bids/asks: [bid/ask_price, number of feasible units].
+
+    for i in range(0, len(bids)):
+        if i == 0:
+            cumu_bids[bids[i][0]] = bids[i][1]
+        else:
+            cumu_bids[bids[i][0]] = bids[i][1] + cumu_bids[bids[i-1][0]]
+    
+    for i in range(0, len(asks)):
+        if i == 0:
+            cumu_asks[asks[i][0]] = asks[i][1]
+        else:
+            cumu_asks[asks[i][0]] = asks[i][1] + cumu_asks[asks[i-1][0]]
+
+    # Compute the target price by iterating over all prices sorted in non-descending order.
+    curr_vol, curr_gap = -1, -1
+
+    for i in range(len(prices)):
+        new_vol, new_gap = compute_vol(prices[i], cumu_bids, cumu_asks)
+
+        if new_vol < curr_vol:  # this never gets called at i = 0.
+            return prices[i-1], curr_vol, curr_gap
+
+        curr_vol = new_vol
+        curr_gap = new_gap 
+
+    return prices[-1], curr_vol, curr_gap
+
+# ----------------------------------
+# -   Vectorized clearing engine   -
+# ----------------------------------
+def curve_volumes(prices, bids, asks):
+    """ Evaluate the feasible bid and ask volumes at a collection of prices.
+
+    The bid volume at p is the total units of bids with prices at least p, 
+    the ask volume at p is the total units of asks with prices at most p.
+
+    Args:
+        prices (array): 
+            Prices to evaluate.
+        bids (array): 
+            The demand curve [[bid_price, units], ...], sorted in non-ascending order by prices.
+        asks (array): 
+            The supply curve [[ask_price, units], ...], sorted in non-descending order by prices.
+
+    Returns:
+        A tuple of two arrays: (bid volumes, ask volumes)
+    """
+
+    bids = np.asarray(bids, dtype=np.float64).reshape(-1, 2)
+    asks = np.asarray(asks, dtype=np.float64).reshape(-1, 2)
+
+    # Flip the bids into non-descending order so both sides can be searched.
+    bid_prices, bid_units = bids[::-1, 0], bids[::-1, 1]
+    ask_prices, ask_units = asks[:, 0], asks[:, 1]
+
+    # suffix[i] = units of the bids at positions >= i, prefix[i] = units of 
+    # the asks at positions < i.
+    suffix = np.zeros(len(bid_units) + 1)
+    suffix[:-1] = np.cumsum(bid_units[::-1])[::-1]
+    prefix = np.zeros(len(ask_units) + 1)
+    prefix[1:] = np.cumsum(ask_units)
+
+    bid_vol = suffix[np.searchsorted(bid_prices, prices, side='left')]
+    ask_vol = prefix[np.searchsorted(ask_prices, prices, side='right')]
+
+    return bid_vol, ask_vol
+
+def first_peak(volumes):
+    """ Index of the last volume before the volume first decreases.
+
+    This is the price picked by reference_clearing(). Since the bid volume 
+    is non-increasing and the ask volume is non-decreasing in the price, 
+    it is also a volume-maximizing price.
+
+    Args:
+        volumes (array): 
+            Clearing volumes at prices sorted in non-descending order.
+
+    Returns:
+        An int
+    """
+
+    drops = np.flatnonzero(volumes[1:] < volumes[:-1])
+    return int(drops[0]) if len(drops) else len(volumes) - 1
+
+def vectorized_clearing(bids, asks):
+    """ Compute the volume-maximizing price with NumPy.
+
+    The cumulative bid and ask curves are built once and the volume and gap 
+    at every candidate price are evaluated with searchsorted. This takes 
+    O((n + m) log(n + m)) time for n bid and m ask price levels, and gives 
+    the same result as reference_clearing().
+
+    Args:
+        bids (array): 
+            The demand curve [[bid_price, units], ...], sorted in non-ascending order by prices.
+        asks (array): 
+            The supply curve [[ask_price, units], ...], sorted in non-descending order by prices.
+
+    Returns:
+        A tuple of the form (clearing price, clearing volume, gap)
+    """
+
+    bids = np.asarray(bids, dtype=np.float64).reshape(-1, 2)
+    asks = np.asarray(asks, dtype=np.float64).reshape(-1, 2)
+
+    prices = np.union1d(bids[:, 0], asks[:, 0])
+    bid_vol, ask_vol = curve_volumes(prices, bids, asks)
+
+    volumes = np.minimum(bid_vol, ask_vol)
+    i = first_peak(volumes)
+
+    return float(prices[i]), float(volumes[i]), float(abs(bid_vol[i] - ask_vol[i]))
+
+# ---------------------------------
+# -   Segmented clearing engine   -
+# ---------------------------------
+def segmented_clearing(market, unit, price, is_bid, n_markets=None):
+    """ Compute the volume-maximizing price of many independent markets at once.
+
+    The orders of all markets are given as flat arrays. Each (market, price) 
+    pair is mapped to the integer key market * R + rank of the price among 
+    all prices, so one sort and one searchsorted per side evaluate the bid 
+    and ask volumes at every candidate price of every market. The price 
+    picked in each market is the one vectorized_clearing() would pick.
+
+    Args:
+        market (array): 
+            Market index of each order, in 0, 1, ..., n_markets - 1.
+        unit (array): 
+            Units of each order.
+        price (array): 
+            Per-unit price of each order.
+        is_bid (array): 
+            True for bids, False for asks.
+        n_markets (int, optional): 
+            Number of markets. By default, the largest market index plus one.
+
+    Returns:
+        A tuple of three arrays, one entry per market: (clearing prices, 
+        clearing volumes, gaps). Markets without bids or without asks get 
+        a price, volume and gap of 0, as in PoolMarket.
+    """
+
+    market = np.asarray(market, dtype=np.int64)
+    unit = np.asarray(unit, dtype=np.float64)
+    price = np.asarray(price, dtype=np.float64)
+    is_bid = np.asarray(is_bid, dtype=bool)
+
+    if n_markets is None:
+        n_markets = int(market.max()) + 1 if len(market) else 0
+
+    clearing_prices = np.zeros(n_markets)
+    volumes = np.zeros(n_markets)
+    gaps = np.zeros(n_markets)
+
+    # Markets with both sides.
+    has_bids = np.bincount(market[is_bid], minlength=n_markets) > 0
+    has_asks = np.bincount(market[~is_bid], minlength=n_markets) > 0
+    active = (has_bids & has_asks)[market]
+    if not active.any():
+        return clearing_prices, volumes, gaps
+
+    market, unit, price, is_bid = market[active], unit[active], price[active], is_bid[active]
+
+    levels, ranks = np.unique(price, return_inverse=True)
+    R = len(levels)
+    keys = market * R + ranks.reshape(-1)
+
+    # Sorted keys and cumulative units of each side.
+    bid_order = np.argsort(keys[is_bid], kind='stable')
+    bid_keys = keys[is_bid][bid_order]
+    bid_prefix = np.zeros(len(bid_keys) + 1)
+    bid_prefix[1:] = np.cumsum(unit[is_bid][bid_order])
+
+    ask_order = np.argsort(keys[~is_bid], kind='stable')
+    ask_keys = keys[~is_bid][ask_order]
+    ask_prefix = np.zeros(len(ask_keys) + 1)
+    ask_prefix[1:] = np.cumsum(unit[~is_bid][ask_order])
+
+    # Candidate prices, sorted by market then price.
+    candidates = np.sort(keys)
+    candidates = candidates[np.append(True, candidates[1:] != candidates[:-1])]
+    seg = candidates // R
+
+    # Bids in the same market with prices >= p, asks with prices <= p.
+    bid_vol = (bid_prefix[np.searchsorted(bid_keys, (seg + 1) * R, side='left')]
+               - bid_prefix[np.searchsorted(bid_keys, candidates, side='left')])
+    ask_vol = (ask_prefix[np.searchsorted(ask_keys, candidates, side='right')]
+               - ask_prefix[np.searchsorted(ask_keys, seg * R, side='left')])
+    vol = np.minimum(bid_vol, ask_vol)
+
+    # The first peak of each market: the first candidate that is followed by 
+    # a lower volume in the same market, or the last candidate of the market.
+    last = np.ones(len(candidates), dtype=bool)
+    last[:-1] = seg[1:] != seg[:-1]
+    drop = np.zeros(len(candidates), dtype=bool)
+    drop[:-1] = vol[1:] < vol[:-1]
+
+    ends = np.flatnonzero(last | drop)
+    markets, first = np.unique(seg[ends], return_index=True)
+    peaks = ends[first]
+
+    clearing_prices[markets] = levels[candidates[peaks] % R]
+    volumes[markets] = vol[peaks]
+    gaps[markets] = np.abs(bid_vol[peaks] - ask_vol[peaks])
+
+    return clearing_prices, volumes, gaps
+
+# -----------------------------------
+# -   Perturbed clearing (what-if)  -
+# -----------------------------------
+# Number of (scenario, price) cells evaluated at a time.
+PERTURBED_BLOCK = 1 << 22
+
+def perturbed_clearing(bids, asks, bid_counts, ask_counts, changes, n_scenarios):
+    """ Clearing price of a book under many independent changes, in one batched pass.
+
+    Each scenario removes and/or adds a few orders. The volumes of all 
+    scenarios are evaluated on one grid of prices: the price levels of the 
+    book and the prices of the changes. A grid price only counts in a 
+    scenario if some order is left at it, so each scenario gets the price 
+    vectorized_clearing() would give on its changed book.
+
+    Args:
+        bids (array): 
+            The demand curve [[bid_price, units], ...] of the book, sorted in non-ascending order by prices.
+        asks (array): 
+            The supply curve [[ask_price, units], ...] of the book, sorted in non-descending order by prices.
+        bid_counts, ask_counts (array):
+            Number of orders at each level of the curves.
+        changes (tuple):
+            Arrays (scenario, is_bid, price, change of units, change of the 
+            number of orders), one entry per changed order, e.g., units 
+            -u and count -1 to remove an order of u units.
+        n_scenarios (int):
+            Number of scenarios, indexed 0, 1, ..., n_scenarios - 1.
+
+    Returns:
+        A tuple of three arrays, one entry per scenario: (clearing prices, 
+        clearing volumes, gaps). Scenarios without bids or asks get 0, 0, 0.
+    """
+
+    bids = np.asarray(bids, dtype=np.float64).reshape(-1, 2)
+    asks = np.asarray(asks, dtype=np.float64).reshape(-1, 2)
+    scenario, is_bid, price, unit, count = (np.asarray(col) for col in changes)
+
+    grid = np.unique(np.concatenate((bids[:, 0], asks[:, 0], price)))
+    n = len(grid)
+
+    base_bid, base_ask = curve_volumes(grid, bids, asks)
+    base_count = np.zeros(n, dtype=np.int64)
+    np.add.at(base_count, np.searchsorted(grid, bids[:, 0]), bid_counts)
+    np.add.at(base_count, np.searchsorted(grid, asks[:, 0]), ask_counts)
+
+    # Number of bids and asks left in each scenario.
+    bids_left = np.sum(bid_counts) + np.bincount(scenario[is_bid], weights=count[is_bid], minlength=n_scenarios)
+    asks_left = np.sum(ask_counts) + np.bincount(scenario[~is_bid], weights=count[~is_bid], minlength=n_scenarios)
+
+    clearing_prices = np.zeros(n_scenarios)
+    volumes = np.zeros(n_scenarios)
+    gaps = np.zeros(n_scenarios)
+    if n == 0:
+        return clearing_prices, volumes, gaps
+
+    order = np.argsort(scenario, kind='stable')
+    scenario, is_bid, price, unit, count = scenario[order], is_bid[order], price[order], unit[order], count[order]
+    cols = np.searchsorted(grid, price)
+
+    block = max(1, PERTURBED_BLOCK // max(n, 1))
+    for first in range(0, n_scenarios, block):
+        last = min(first + block, n_scenarios)
+        k = last - first
+        lo, hi = np.searchsorted(scenario, [first, last])
+        rows = scenario[lo:hi] - first
+
+        # Changes of units and counts at each grid price, per scenario.
+        d_bid = np.zeros((k, n))
+        d_ask = np.zeros((k, n))
+        d_count = np.zeros((k, n), dtype=np.int64)
+        side = is_bid[lo:hi]
+        np.add.at(d_bid, (rows[side], cols[lo:hi][side]), unit[lo:hi][side])
+        np.add.at(d_ask, (rows[~side], cols[lo:hi][~side]), unit[lo:hi][~side])
+        np.add.at(d_count, (rows, cols[lo:hi]), count[lo:hi])
+
+        # Bids at prices >= p (suffix sums), asks at prices <= p (prefix sums).
+        bid_vol = base_bid + np.cumsum(d_bid[:, ::-1], axis=1)[:, ::-1]
+        ask_vol = base_ask + np.cumsum(d_ask, axis=1)
+        vol = np.minimum(bid_vol, ask_vol)
+        valid = (base_count + d_count) > 0
+
+        # Next valid grid price after each price (n if none).
+        index = np.where(valid, np.arange(n), n)
+        following = np.full((k, n), n)
+        following[:, :-1] = np.minimum.accumulate(index[:, :0:-1], axis=1)[:, ::-1]
+
+        # The first peak over the valid prices of each scenario.
+        has_next = following < n
+        next_vol = np.take_along_axis(vol, np.minimum(following, n - 1), axis=1)
+        ends = valid & (~has_next | (next_vol < vol))
+        peak = np.argmax(ends, axis=1)
+
+        r = np.arange(k)
+        ok = (bids_left[first:last] > 0) & (asks_left[first:last] > 0) & ends[r, peak]
+        clearing_prices[first:last] = np.where(ok, grid[peak], 0)
+        volumes[first:last] = np.where(ok, vol[r, peak], 0)
+        gaps[first:last] = np.where(ok, np.abs(bid_vol[r, peak] - ask_vol[r, peak]), 0)
+
+    return clearing_prices, volumes, gaps
+
+# Factory
+CLEARING_ENGINES = {
+    "vectorized" : vectorized_clearing,
+    "reference" : reference_clearing
+}
+
+# -----------------------------------
+# -   Incremental clearing engine   -
+# -----------------------------------
+class _Fenwick():
+    """ A Fenwick (binary indexed) tree over a fixed number of non-negative values.
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        self.n = len(values)
+
+        # tree[i] = sum of values over (i - lowbit(i), i], 1-indexed.
+        cumu = np.concatenate(([0.0], np.cumsum(values)))
+        idx = np.arange(1, self.n + 1)
+        self.tree = [0.0] + (cumu[idx] - cumu[idx - (idx & -idx)]).tolist()
+
+        self.top = 1 << max(self.n.bit_length() - 1, 0)
+
+    def add(self, i, delta):
+        """ values[i] += delta
+        """
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        """ Sum of values[0..i]. Zero if i < 0.
+        """
+        total, i = 0.0, i + 1
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def assign(self, lo, values):
+        """ Replace values[lo:lo + len(values)] by values with the same sum.
+
+        The window must be aligned: its length a power of two that divides lo.
+        Then the nodes inside it only cover values of the window, and the 
+        nodes above it keep their sums, so only len(values) - 1 nodes change.
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        cumu = np.concatenate(([0.0], np.cumsum(values)))
+        idx = np.arange(1, len(values))
+        self.tree[lo + 1:lo + len(values)] = (cumu[idx] - cumu[idx - (idx & -idx)]).tolist()
+
+    def search(self, target):
+        """ The smallest i such that prefix(i) > target, or n if there is none.
+        """
+        pos, step = 0, self.top
+        while step:
+            if pos + step <= self.n and self.tree[pos + step] <= target:
+                pos += step
+                target -= self.tree[pos]
+            step >>= 1
+        return pos
+
+class IncrementalClearing():
+    """ Keeps the clearing price of an orderbook up to date as orders arrive or leave.
+
+    The candidate prices (all prices with a bid or an ask level) are laid 
+    out in order on a grid of slots with gaps between them, with Fenwick 
+    trees over the bid and ask units at each slot. An order added, cancelled
+    or modified at an existing price updates the trees in O(log P).
+
+    A new price takes a free slot between its neighbours, so the trees are 
+    not rebuilt. When its neighbours are adjacent, the prices of the smallest
+    aligned window of slots around them that is sparse enough are spread out
+    evenly again (as in a packed-memory array), and only when the grid is 
+    more than half full is it rebuilt with twice the slots. A new price thus 
+    costs amortized O(log^2 P) tree updates, whatever the order of arrival.
+
+    The bid volume B(p) is non-increasing and the ask volume A(p) is 
+    non-decreasing in p. The volume-maximizing price is found next to the 
+    first price k with B(k) < A(k), by a few O(log P) tree searches, and is 
+    the same price picked by reference_clearing().
+
+    Attributes:
+        book (OrderBook):
+            The tracked orderbook. The engine registers itself as a watcher 
+            of its price levels.
+        capacity (int):
+            The number of slots, a power of two.
+        slot (dict):
+            {price : slot} of the candidate prices. Prices whose levels are 
+            gone keep their slot (inactive) until the next rebuild.
+    """
+
+    # Type code of the bids, the same as orderbook.BID.
+    BID = 0
+
+    # Slots per price after a rebuild, and the step of a new lowest or 
+    # highest price from its neighbour.
+    SPACING = 8
+
+    def __init__(self, book):
+        self.book = book
+        book._watchers.append(self.update)
+        self._rebuild()
+
+    def _rebuild(self, capacity=0):
+        """ Lay the prices of the book out evenly on a grid of at least capacity slots.
+        """
+
+        bids, asks = self.book._levels
+        prices = np.union1d(bids.prices, asks.prices)
+        n = len(prices)
+
+        self.capacity = 1 << (max(self.SPACING * n, capacity, 1) - 1).bit_length()
+        slots = ((2 * np.arange(n) + 1) * self.capacity) // (2 * max(n, 1))
+        self.slot = dict(zip(prices.tolist(), slots.tolist()))
+        self.size = n
+
+        # key[s] is the price at slot s, or at the next used slot for a free 
+        # one (inf past the last), so that the keys are sorted.
+        self.key = np.append(prices, np.inf)[np.searchsorted(slots, np.arange(self.capacity))]
+        self.used = np.zeros(self.capacity, dtype=bool)
+        self.used[slots] = True
+
+        bid_units, ask_units, bid_counts = (np.zeros(self.capacity) for _ in range(3))
+        bid_units[slots] = [bids.units.get(p, 0.0) for p in prices.tolist()]
+        ask_units[slots] = [asks.units.get(p, 0.0) for p in prices.tolist()]
+        bid_counts[slots] = [bids.count.get(p, 0) for p in prices.tolist()]
+        active_flags = self.used.astype(np.float64)
+
+        # The values at each slot, to move them when the prices are spread out.
+        self.values = [bid_units.tolist(), ask_units.tolist(), bid_counts.tolist()]
+        self.active_flags = active_flags.tolist()
+
+        self.bid_units = _Fenwick(bid_units)
+        self.ask_units = _Fenwick(ask_units)
+        self.bid_counts = _Fenwick(bid_counts)
+        self.active = _Fenwick(active_flags)
+        self.num_active = n
+
+        self.total_bid = float(bid_units.sum())
+
+    def _insert(self, price):
+        """ Give a slot to a new price, with no units.
+
+        Returns:
+            False if the grid is too full and has to be rebuilt.
+        """
+
+        # The free slots [s, stop) lie between the neighbours of the price.
+        s = int(np.searchsorted(self.key, price))
+        after = float(self.key[s]) if s < self.capacity else np.inf
+        stop = self.slot[after] if after != np.inf else self.capacity
+
+        if s < stop:
+            if s == 0:
+                t = max(stop - self.SPACING, (stop - 1) // 2)
+            elif stop == self.capacity:
+                t = min(s + self.SPACING - 1, (s + stop - 1) // 2)
+            else:
+                t = (s + stop - 1) // 2
+
+            self.key[s:t + 1] = price
+            self.used[t] = True
+            self.slot[price] = t
+            self.size += 1
+            return True
+
+        # The smallest aligned window around s whose density is below a 
+        # threshold that goes from 1 for 2 slots to 1/2 for the whole grid.
+        levels = self.capacity.bit_length() - 1
+        for level in range(1, levels + 1):
+            width = 1 << level
+            lo = (min(s, self.capacity - 1) // width) * width
+            hi = lo + width
+            count = int(self.used[lo:hi].sum()) + 1
+            if count <= width * (1 - level / (2 * levels)):
+                break
+        else:
+            return False
+
+        # Spread the prices of the window and the new one evenly over it. 
+        # The window keeps its sums, as the new price has no units yet.
+        old = np.flatnonzero(self.used[lo:hi])
+        prices = self.key[lo + old]
+        at = int(np.searchsorted(prices, price))
+        slots = ((2 * np.arange(count) + 1) * width) // (2 * count)
+        new = np.delete(slots, at)
+
+        for column, tree in zip(self.values + [self.active_flags], 
+                                (self.bid_units, self.ask_units, self.bid_counts, self.active)):
+            window = np.zeros(width)
+            window[new] = np.asarray(column[lo:hi], dtype=np.float64)[old]
+            column[lo:hi] = window.tolist()
+            tree.assign(lo, window)
+
+        prices = np.insert(prices, at, price)
+        self.used[lo:hi] = False
+        self.used[lo + slots] = True
+        self.slot.update(zip(prices.tolist(), (lo + slots).tolist()))
+        self.size += 1
+
+        following = self.key[hi] if hi < self.capacity else np.inf
+        self.key[lo:hi] = np.append(prices, following)[np.searchsorted(slots, np.arange(width))]
+        return True
+
+    def update(self, type_code, prices, units, counts):
+        """ Apply a change of the price levels of the book (a watcher callback).
+
+        Args:
+            type_code (int): 
+                0 for bids, 1 for asks.
+            prices, units, counts (array-like):
+                The changed prices, with the changes of units and of the number of orders.
+        """
+
+        prices = [float(p) for p in prices]
+        new_prices = [p for p in dict.fromkeys(prices) if p not in self.slot]
+
+        # Many new prices at once (e.g., a bulk insert) are laid out together.
+        if len(new_prices) > self.size or not all(self._insert(p) for p in new_prices):
+            self._rebuild(2 * self.capacity if new_prices else 0)
+            return
+
+        bids, asks = self.book._levels
+
+        for price, unit, count in zip(prices, units, counts):
+            i = self.slot[price]
+            self.values[type_code][i] += unit
+
+            if type_code == self.BID:
+                self.values[2][i] += count
+                self.bid_units.add(i, unit)
+                self.bid_counts.add(i, count)
+                self.total_bid += unit
+            else:
+                self.ask_units.add(i, unit)
+
+            active = float(price in bids.units or price in asks.units)
+            if active != self.active_flags[i]:
+                self.active.add(i, active - self.active_flags[i])
+                self.num_active += int(active - self.active_flags[i])
+                self.active_flags[i] = active
+
+        # Drop inactive prices once they make up half of the grid.
+        if 2 * self.num_active < self.size:
+            self._rebuild()
+
+    def _volumes(self, i):
+        """ (B(prices[i]), A(prices[i]))
+        """
+        return self.total_bid - self.bid_units.prefix(i - 1), self.ask_units.prefix(i)
+
+    def _crossing(self):
+        """ The first slot k where (total bids - B(k)) + A(k) > total bids, i.e. B(k) < A(k).
+
+        Both trees are walked down together. The bid units at the slot 
+        itself are taken out, as B(k) includes them.
+        """
+
+        bid_tree, ask_tree, bid_units = self.bid_units.tree, self.ask_units.tree, self.values[0]
+        pos, step = 0, self.bid_units.top
+        bid_sum = ask_sum = 0.0
+
+        while step:
+            i = pos + step
+            if i <= self.capacity:
+                bids, asks = bid_sum + bid_tree[i], ask_sum + ask_tree[i]
+                if bids - bid_units[i - 1] + asks <= self.total_bid:
+                    pos, bid_sum, ask_sum = i, bids, asks
+            step >>= 1
+
+        return pos
+
+    def _nth_active(self, n):
+        """ The index of the n-th active price (0-based).
+        """
+        return self.active.search(n)
+
+    def clearing(self):
+        """ The current volume-maximizing price.
+
+        Returns:
+            A tuple of the form (clearing price, clearing volume, gap), or 
+            (0, 0, 0) if there are no prices.
+        """
+
+        if self.num_active == 0:
+            return 0, 0, 0
+
+        # k: the first price where the bid volume drops below the ask volume.
+        k = self._crossing()
+
+        # a: the last active price before k, b: the first active price from k.
+        before = int(round(self.active.prefix(k - 1)))
+        a = self._nth_active(before - 1) if before > 0 else None
+        b = self._nth_active(before) if before < self.num_active else None
+
+        if b is None:
+            # The volume never decreases.
+            best = self._nth_active(self.num_active - 1)
+        elif a is not None and self._volumes(b)[0] < self._volumes(a)[1]:
+            # The volume decreases right after the crossing.
+            best = a
+        else:
+            # From b on the volume is B(p), constant until the first price 
+            # with bids, and decreasing after it.
+            m = self.bid_counts.search(self.bid_counts.prefix(b - 1))
+            best = m if m < self.capacity else self._nth_active(self.num_active - 1)
+
+        bid_vol, ask_vol = self._volumes(best)
+        return float(self.key[best]), float(min(bid_vol, ask_vol)), float(abs(bid_vol - ask_vol))
@@ -2,52 +2,208 @@
 """
 
 from collections import defaultdict
+import numpy as np
+from marketlib.markets import orderbook as ob
+
+# Maximum number of candidate pairs whose utilities are computed at once.
+GRAPH_BLOCK = 1 << 22
+
+# ------------------------------
+#   Compute utility matrix     -
+# ------------------------------
+def utility_matrix(book, dtype=np.float64):
+    """ Compute the utility of every buyer-seller pair.
+
+    The utility between buyer i and seller j is the difference between their
+    volume-weighted average per-unit prices times the number of units they
+    could trade:
+        (i's per_unit price - j's per_unit price) * min(i's volume, j's volume)
+
+    The per-user prices and volumes are read from the user index of the
+    orderbook, and the matrix is built by broadcasting. It is kept until one
+    side of the book changes, so it is read-only.
+
+    Args:
+        book (OrderBook):
+            The orderbook of a market.
+        dtype (optional):
+            np.float64 (default) or np.float32, to halve the memory of large markets.
+
+    Returns:
+        A tuple (buyers, sellers, utility), where utility[i, j] is the utility
+        between buyers[i] and sellers[j]. Users are listed in the order of
+        their first order.
+    """
+
+    dtype = np.dtype(dtype)
+
+    def compute():
+        buyers, buyer_units, buyer_prices = book.user_summary("bid")
+        sellers, seller_units, seller_prices = book.user_summary("ask")
+
+        utility = np.subtract.outer(buyer_prices.astype(dtype), seller_prices.astype(dtype))
+        utility *= np.minimum.outer(buyer_units.astype(dtype), seller_units.astype(dtype))
+        utility.flags.writeable = False
+
+        return buyers, sellers, utility
+
+    return book._memo(("utility_matrix", dtype.str), (ob.BID, ob.ASK), compute)
+
+# ------------------------------
+#   Compute candidate graph    -
+# ------------------------------
+def candidate_graph(book, top_k=None, dtype=np.float64):
+    """ Compute the candidate sellers of every buyer, as a sparse utility graph.
+
+    Sellers are sorted by average ask price, so the candidates of a buyer, the
+    sellers whose average ask is not above the buyer's average bid, are a prefix
+    of them found by binary search. Pairs with a negative utility are never
+    materialized.
+
+    With top_k, each buyer first scans a window of its 2 * top_k cheapest 
+    candidates. The utility of a later seller is at most the price gap to the
+    first seller past the window times the units they could trade, so the 
+    window is doubled only for the buyers whose bound still ties or beats 
+    their k-th best pair.
+
+    The utilities are computed in blocks of at most GRAPH_BLOCK pairs, buyers
+    with windows of similar widths sharing a dense block. The graph is kept 
+    until one side of the book changes, so its arrays are read-only.
+
+    Args:
+        book (OrderBook):
+            The orderbook of a market.
+        top_k (int, optional):
+            If given, only the top_k candidates of each buyer by utility are kept.
+        dtype (optional):
+            np.float64 (default) or np.float32.
+
+    Returns:
+        A tuple (buyers, sellers, indptr, indices, utility) in CSR form: the
+        candidates of buyers[i] are sellers[indices[indptr[i]:indptr[i + 1]]],
+        with utilities utility[indptr[i]:indptr[i + 1]], sorted by utility in
+        descending order (ties by ask price).
+    """
+
+    dtype = np.dtype(dtype)
+
+    def compute():
+        buyers, buyer_units, buyer_prices = book.user_summary("bid")
+        sellers, seller_units, seller_prices = book.user_summary("ask")
+
+        order = np.argsort(seller_prices, kind='stable')
+        sorted_prices, sorted_units = seller_prices[order], seller_units[order]
+        counts = np.searchsorted(sorted_prices, buyer_prices, side='right')
+
+        # The most units of a seller from each position on.
+        max_units = np.maximum.accumulate(sorted_units[::-1])[::-1]
+
+        width = counts.copy() if top_k is None else np.minimum(counts, 2 * top_k)
+        pending = np.flatnonzero(counts)
+
+        # (buyers, number of pairs kept, positions of their sellers, utilities)
+        blocks = []
+
+        while len(pending):
+            # Buyers with windows of similar widths are padded together.
+            pending = pending[np.argsort(width[pending], kind='stable')]
+            retry = []
+
+            start = 0
+            while start < len(pending):
+                # The buyers [start, stop) padded to the widest window have at 
+                # most GRAPH_BLOCK pairs, or a single buyer more.
+                n = min(len(pending) - start, GRAPH_BLOCK // max(width[pending[start]], 1) + 1)
+                padded = np.arange(1, n + 1) * width[pending[start:start + n]]
+                stop = start + max(np.searchsorted(padded, GRAPH_BLOCK, side='right'), 1)
+                block = pending[start:stop]
+                start = stop
+
+                w = width[block[-1]]
+                util = np.subtract.outer(buyer_prices[block], sorted_prices[:w])
+                util *= np.minimum.outer(buyer_units[block], sorted_units[:w])
+                util[np.arange(w) >= width[block][:, None]] = -np.inf
+
+                # By utility in descending order, ties by ask price.
+                ranked = np.argsort(-util, axis=1, kind='stable')[:, :top_k]
+                util = np.take_along_axis(util, ranked, axis=1)
+                n_kept = np.minimum(width[block], ranked.shape[1])
+
+                if top_k is not None:
+                    # Sellers past the window can still beat or tie the k-th best pair.
+                    kth = np.where(n_kept == top_k, util[:, -1], -np.inf)
+                    past = np.minimum(width[block], len(sellers) - 1)
+                    bound = (buyer_prices[block] - sorted_prices[past]) * np.minimum(buyer_units[block], max_units[past])
+                    again = (width[block] < counts[block]) & (bound >= kth)
+
+                    retry.append(block[again])
+                    block, n_kept, ranked, util = block[~again], n_kept[~again], ranked[~again], util[~again]
+
+                keep = np.arange(ranked.shape[1]) < n_kept[:, None]
+                blocks.append((block, n_kept, ranked[keep], util[keep]))
+
+            pending = np.concatenate(retry) if retry else pending[:0]
+            width[pending] = np.minimum(counts[pending], 2 * width[pending])
+
+        # Place the pairs of each block in the rows of its buyers.
+        n_pairs = np.zeros(len(buyers), dtype=np.int64)
+        for block, n_kept, _, _ in blocks:
+            n_pairs[block] = n_kept
+
+        indptr = np.concatenate(([0], np.cumsum(n_pairs)))
+        indices = np.empty(indptr[-1], dtype=np.int64)
+        utility = np.empty(indptr[-1], dtype=dtype)
+
+        for block, n_kept, positions, util in blocks:
+            starts = np.cumsum(n_kept) - n_kept
+            rows = np.repeat(indptr[block] - starts, n_kept) + np.arange(len(positions))
+            indices[rows] = order[positions]
+            utility[rows] = util
+
+        graph = (buyers, sellers, indptr, indices, utility)
+        for arr in graph[2:]:
+            arr.flags.writeable = False
+
+        return graph
+
+    return book._memo(("candidate_graph", top_k, dtype.str), (ob.BID, ob.ASK), compute)
 
 # ------------------------------
 #   Compute preference lists   -
 # ------------------------------
-def preference_list(bids, asks):
+def preference_list(book, asks=None):
     """ Compute the preference list of buyers and sellers.
+
+    A dict view of utility_matrix(), for code that looks up pairs by user id.
+    Prefer the matrix for large markets.
+
+    Args:
+        book (OrderBook or DataFrame):
+            The orderbook of a market. The per-user totals and average prices
+            are read from its user index. With asks, the bids as a dataframe 
+            with columns Unit, Price, User, as in preference_list(bids, asks).
+        asks (DataFrame, optional):
+            The asks, with columns Unit, Price, User.
+
+    Returns:
+        Buyer/seller preference lists of the form
+        {buyer_id : {seller id : utility}}, {seller_id : {buyer id : utility}}
     """
-    # {participant_id : [average_price_per_unit, total_units]}
-    buyer_price_dict, seller_price_dict = {}, {}
-
-    # Construct buyer_price_dict
-    for row in bids.itertuples(index=False):
-        buyer = row.User
-        units = row.Unit
-        price = row.Price
-        
-        if buyer not in buyer_price_dict:
-            buyer_price_dict[buyer] = [price, units]
-        else:
-            buyer_price_dict[buyer][0] = ((buyer_price_dict[buyer][0] * buyer_price_dict[buyer][1]) + price * units) / (units + buyer_price_dict[buyer][1])
-
-            buyer_price_dict[buyer][1] += units
-
-    # Construct seller_price_dict
-    for row in asks.itertuples(index=False):
-        seller = row.User
-        units = row.Unit
-        price = row.Price
-        
-        if seller not in seller_price_dict:
-            seller_price_dict[seller] = [price, units]
-        else:
-            seller_price_dict[seller][0] = ((seller_price_dict[seller][0] * seller_price_dict[seller][1]) + price * units) / (units + seller_price_dict[seller][1])
-
-            seller_price_dict[seller][1] += units
-
-    # Buyer/seller preference list format:
-    # {buyer_id : {seller id : utility}}, {seller_id : {buyer id : utility}}    
-    # Utility between i and j is the different between their per-unit price 
-    # times the number trading units.
+
+    if asks is not None:
+        bids, book = book, ob._OrderBook()
+        book.add_orders("bid", bids)
+        book.add_orders("ask", asks)
+
+    buyers, sellers, utility = utility_matrix(book)
+    buyers, sellers = buyers.tolist(), sellers.tolist()
+
     buyer_pref_dict, seller_pref_dict = defaultdict(dict), defaultdict(dict)
 
-    for buyer, p_buyer in buyer_price_dict.items():
-        for seller, p_seller in seller_price_dict.items():
-            util = (p_buyer[0] - p_seller[1]) * min(p_buyer[1], p_seller[1])
-            buyer_pref_dict[buyer][seller] = util
-            seller_pref_dict[seller][buyer] = util
-    
+    for buyer, row in zip(buyers, utility.tolist()):
+        buyer_pref_dict[buyer] = dict(zip(sellers, row))
+
+    for seller, col in zip(sellers, utility.T.tolist()):
+        seller_pref_dict[seller] = dict(zip(buyers, col))
+
     return buyer_pref_dict, seller_pref_dict
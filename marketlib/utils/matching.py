@@ -6,13 +6,206 @@ The utilities are for developers only.
 """
 
 from typing import Dict
-import networkx as nx # type: ignore
+from collections import deque
+import heapq
+import numpy as np
 import random
 from marketlib.utils import general
 
+# Epsilon-scaling of the auction algorithm: epsilon is divided by 
+# AUCTION_SCALING after each round. The total utility of the final round
+# is within AUCTION_TOLERANCE times the largest utility of the optimum.
+AUCTION_SCALING = 5
+AUCTION_TOLERANCE = 1e-6
+
+# Auction bidders with more objects than this compare them with numpy.
+AUCTION_VECTOR = 64
+
+# ------------------ #
+#  Utility Graph     #
+# ------------------ #
+def _utility_graph(M):
+    """ The candidate buyer-seller pairs of a sparse market and their utilities.
+
+    The utility between buyer i and seller j is the difference between their
+    per-unit prices times the number of trading units. The candidates come 
+    from general.candidate_graph(): only the sellers whose average ask is not
+    above the buyer's average bid, at most M.top_k of them.
+
+    Args:
+        M (Market): 
+            A market instance.
+
+    Returns:
+        A tuple (buyers, sellers, indptr, indices, utility) in CSR form: the
+        candidates of buyers[i] are sellers[indices[indptr[i]:indptr[i + 1]]],
+        sorted by utility in descending order.
+    """
+
+    return general.candidate_graph(M.book, top_k=getattr(M, "top_k", None))
+
 # ------------------ #
 #  Stable Matching   #
 # ------------------ #
+def _gale_shapley(indptr, preferences, seller_rank, n_sellers):
+    """ Buyer-proposing Gale-Shapley algorithm on a preference graph.
+
+    Free buyers wait in a queue. Each buyer keeps a pointer to its next
+    proposal, so it never proposes twice to the same seller, and sellers 
+    compare proposals with an integer rank table.
+
+    Args:
+        indptr, preferences (list):
+            The preference list of buyer i is preferences[indptr[i]:indptr[i + 1]], 
+            best first.
+        seller_rank (list):
+            seller_rank[e] is the rank of the buyer of pair e in the preference 
+            list of the seller of pair e (the lowest is preferred).
+        n_sellers (int):
+            Number of sellers.
+
+    Returns:
+        A list with the seller matched to each buyer, or None.
+    """
+
+    n_buyers = len(indptr) - 1
+    free_buyers = deque(range(n_buyers))
+    proposal = indptr[:-1]  # Next proposal of each buyer
+
+    buyer_match = [None] * n_buyers
+    seller_match = [None] * n_sellers  # (rank, buyer)
+
+    while free_buyers:
+        buyer = free_buyers[0]  # Get a free buyer
+        e = proposal[buyer]
+
+        # The buyer was rejected by all its candidates.
+        if e == indptr[buyer + 1]:
+            free_buyers.popleft()
+            continue
+
+        proposal[buyer] = e + 1
+        seller = preferences[e]
+        current_partner = seller_match[seller]
+
+        # If seller is free, match buyer and seller
+        if current_partner is None:
+            free_buyers.popleft()
+            buyer_match[buyer] = seller
+            seller_match[seller] = (seller_rank[e], buyer)
+
+        # If seller prefers the new buyer over the current partner
+        elif seller_rank[e] < current_partner[0]:
+            free_buyers.popleft()
+
+            # Break the current match
+            buyer_match[current_partner[1]] = None
+            free_buyers.append(current_partner[1])
+
+            # Match the new buyer and seller
+            buyer_match[buyer] = seller
+            seller_match[seller] = (seller_rank[e], buyer)
+
+        # Otherwise the buyer stays at the front of the queue and proposes 
+        # to its next choice.
+
+    return buyer_match
+
+def _volume_groups(units, prices, descending):
+    """ Group users by volume, each group sorted by price then position.
+
+    Returns:
+        A tuple (order, volumes, starts, ends): the users of the group of 
+        volumes[k] are order[starts[k]:ends[k]], best price first.
+    """
+
+    order = np.lexsort((np.arange(len(units)), -prices if descending else prices, units))
+    volumes, starts = np.unique(units[order], return_index=True)
+    ends = np.append(starts[1:], len(units))
+
+    return order, volumes, starts, ends
+
+def _ordered_matching(buyer_units, buyer_prices, seller_units, seller_prices):
+    """ Match buyers and sellers pair by pair, in descending order of utility,
+    ties by buyer position then seller position, skipping the pairs where 
+    either side is already matched.
+
+    Buyers and sellers are grouped by volume, each group sorted by price. 
+    Between a buyer group and a seller group, the utility only depends on 
+    the prices, so the best free pair is the pair of their heads. A heap 
+    holds, for each buyer group, the pair of its head with the best seller
+    group head. A popped pair whose seller was taken is replaced by the new 
+    best pair of its group. Each step costs O(number of seller volumes) and
+    the utility matrix is never built.
+
+    Returns:
+        A list with the seller matched to each buyer, or None.
+    """
+
+    n_buyers, n_sellers = len(buyer_units), len(seller_units)
+    buyer_match = [None] * n_buyers
+
+    if not n_buyers or not n_sellers:
+        return buyer_match
+
+    b_order, b_volumes, b_head, b_ends = _volume_groups(buyer_units, buyer_prices, True)
+    s_order, s_volumes, s_head, s_ends = _volume_groups(seller_units, seller_prices, False)
+    seller_group = np.searchsorted(s_volumes, seller_units).tolist()
+
+    # The free head of each seller group.
+    head_seller = s_order[s_head]
+    head_price = seller_prices[head_seller]
+    empty = np.zeros(len(s_volumes), dtype=bool)
+
+    def best_pair(j):
+        buyer = int(b_order[b_head[j]])
+
+        # The utility with each seller head, as in general.utility_matrix().
+        utility = (buyer_prices[buyer] - head_price) * np.minimum(b_volumes[j], s_volumes)
+        utility[empty] = -np.inf
+
+        # The best head, ties by seller position.
+        k = int(np.argmax(utility))
+        ties = np.flatnonzero(utility == utility[k])
+        if len(ties) > 1:
+            k = int(ties[np.argmin(head_seller[ties])])
+
+        return (-utility[k], buyer, int(head_seller[k]), j)
+
+    heap = [best_pair(j) for j in range(len(b_volumes))]
+    heapq.heapify(heap)
+
+    taken = [False] * n_sellers
+    n_pairs = min(n_buyers, n_sellers)
+    matched = 0
+
+    while matched < n_pairs:
+        _, buyer, seller, j = heapq.heappop(heap)
+
+        # The seller was taken: push the new best pair of the group.
+        if taken[seller]:
+            heapq.heappush(heap, best_pair(j))
+            continue
+
+        buyer_match[buyer] = seller
+        taken[seller] = True
+        matched += 1
+
+        # Both were the heads of their groups.
+        k = seller_group[seller]
+        s_head[k] += 1
+        if s_head[k] < s_ends[k]:
+            head_seller[k] = s_order[s_head[k]]
+            head_price[k] = seller_prices[head_seller[k]]
+        else:
+            empty[k] = True
+
+        b_head[j] += 1
+        if b_head[j] < b_ends[j] and matched < n_pairs:
+            heapq.heappush(heap, best_pair(j))
+
+    return buyer_match
+
 def stable_matching(M) -> Dict:
     """ Stable matching algorithm.
 
@@ -20,6 +213,16 @@ def stable_matching(M) -> Dict:
     compute a preference list of each participant. Then 
     we do stable matching (Gale-Shapley).
 
+    Each participant prefers partners with a higher utility, ties broken by
+    their order in the book. With M.sparse, buyers only propose to their 
+    candidate sellers (see general.candidate_graph()).
+
+    Otherwise, both sides rank each other by the same utility, so the 
+    preferences follow one order of the pairs, and the stable matching is 
+    the one made by matching pairs in that order (see _ordered_matching()).
+    This takes far fewer steps than the proposals of Gale-Shapley, which 
+    grow as n^2 when all buyers prefer the same sellers.
+
     Args:
         M (Market): 
             A market instance.          
@@ -28,61 +231,35 @@ def stable_matching(M) -> Dict:
 
     Returns:
         A dict that contains one-to-one matching between the 
-        buyers and the sellers. 
+        buyers and the sellers. Buyers who are rejected by all 
+        sellers are left out.
     """
 
-    bids = M.book.orders[(M.book.orders["Type"] == "bid")]
-    asks = M.book.orders[(M.book.orders["Type"] == "ask")]
-
-    # Buyer/seller preference list format:
-    # {buyer_id : {seller id : utility}}, {seller_id : {buyer id : utility}}    
-    # Utility between i and j is the different between their per-unit price 
-    # times the number trading units.
-    buyer_pref_dict, seller_pref_dict = general.preference_list(bids, asks)
+    if getattr(M, "sparse", False):
+        # The preference list of buyers[i] are the sellers 
+        # indices[indptr[i]:indptr[i + 1]], best first.
+        buyers, sellers, indptr, indices, utility = _utility_graph(M)
+        rows = np.repeat(np.arange(len(buyers)), np.diff(indptr))
 
-    # Sort by utility 
-    for buyer in buyer_pref_dict.keys():
-        buyer_pref_dict[buyer] = list(sorted(buyer_pref_dict[buyer].keys(), key=lambda x: buyer_pref_dict[buyer][x], reverse=True))
-    
-    for seller in seller_pref_dict.keys():
-        seller_pref_dict[seller] = list(sorted(seller_pref_dict[seller].keys(), key=lambda x: seller_pref_dict[seller][x], reverse=True))
+        # seller_rank[e] is the rank of the buyer of pair e in the preference 
+        # list of its seller. Ties are kept in the order of the buyers.
+        seller_order = np.lexsort((rows, -utility, indices))
+        seller_starts = np.searchsorted(indices[seller_order], np.arange(len(sellers)))
 
-    # Stable Matching
-    free_buyers = list(buyer_pref_dict.keys())
-    buyer_match = {buyer: None for buyer in buyer_pref_dict}
-    seller_match = {seller: None for seller in seller_pref_dict}
+        seller_rank = np.empty(len(indices), dtype=np.int64)
+        seller_rank[seller_order] = np.arange(len(indices)) - seller_starts[indices[seller_order]]
 
-    seller_rank = {
-        seller: {buyer: rank for rank, buyer in enumerate(preferences)}
-        for seller, preferences in seller_pref_dict.items()
-    }
+        buyer_match = _gale_shapley(indptr.tolist(), indices.tolist(), seller_rank.tolist(), len(sellers))
 
-    # Gale-Shapley algorithm
-    while free_buyers:
-        buyer = free_buyers.pop(0)  # Get a free buyer
-        buyer_preferences = buyer_pref_dict[buyer]
+    else:
+        buyers, buyer_units, buyer_prices = M.book.user_summary("bid")
+        sellers, seller_units, seller_prices = M.book.user_summary("ask")
 
-        for seller in buyer_preferences:
-            current_partner = seller_match[seller]
+        buyer_match = _ordered_matching(buyer_units, buyer_prices, seller_units, seller_prices)
 
-            # If seller is free, match buyer and seller
-            if current_partner is None:
-                buyer_match[buyer] = seller
-                seller_match[seller] = buyer
-                break
-
-            # If seller prefers the new buyer over the current partner
-            elif seller_rank[seller][buyer] < seller_rank[seller][current_partner]:
-                # Break the current match
-                buyer_match[current_partner] = None
-                free_buyers.append(current_partner)
-
-                # Match the new buyer and seller
-                buyer_match[buyer] = seller
-                seller_match[seller] = buyer
-                break
-    
-    return buyer_match
+    sellers = sellers.tolist()
+    return {buyer : sellers[seller] for buyer, seller in zip(buyers.tolist(), buyer_match) 
+            if seller is not None}
     
 # ----------------- #
 #  Random Matching  #
@@ -101,9 +278,9 @@ def random_matching(M):
         buyers and the sellers. 
     """
 
-    buyers = M.book.orders.loc[M.book.orders["Type"] == "bid", "User"].unique().tolist()
+    buyers = M.book.user_summary("bid")[0].tolist()
 
-    sellers = M.book.orders.loc[M.book.orders["Type"] == "ask", "User"].unique().tolist()
+    sellers = M.book.user_summary("ask")[0].tolist()
     random.shuffle(sellers)
 
     return dict(zip(buyers, sellers))
@@ -111,6 +288,164 @@ def random_matching(M):
 # ----------------------- #
 #  Max Weighted Matching  #                
 # ----------------------- #
+def _shortest_augmenting_path(cost):
+    """ Solve a rectangular assignment problem with at most as many rows as 
+    columns (Jonker-Volgenant shortest augmenting paths).
+
+    Each row is assigned in turn along a shortest augmenting path of the 
+    reduced costs (Dijkstra), the inner scans being vectorized over columns.
+
+    Args:
+        cost (np.ndarray):
+            The cost of assigning row i to column j.
+
+    Returns:
+        An array with the column assigned to each row, for the least total cost.
+    """
+
+    n_rows, n_cols = cost.shape
+    u, v = np.zeros(n_rows), np.zeros(n_cols)
+    col4row = np.full(n_rows, -1)
+    row4col = np.full(n_cols, -1)
+
+    for current in range(n_rows):
+        shortest = np.full(n_cols, np.inf)
+        path = np.full(n_cols, -1)
+        scanned_rows = np.zeros(n_rows, dtype=bool)
+        scanned_cols = np.zeros(n_cols, dtype=bool)
+
+        i, min_value, sink = current, 0.0, -1
+        while sink < 0:
+            scanned_rows[i] = True
+
+            reduced = min_value + cost[i] - u[i] - v
+            closer = ~scanned_cols & (reduced < shortest)
+            path[closer] = i
+            shortest[closer] = reduced[closer]
+
+            # The closest unscanned column, a free one among ties.
+            remaining = np.where(scanned_cols, np.inf, shortest)
+            min_value = remaining.min()
+            ties = np.flatnonzero(remaining == min_value)
+            free = ties[row4col[ties] < 0]
+            j = free[0] if len(free) else ties[0]
+
+            scanned_cols[j] = True
+            if row4col[j] < 0:
+                sink = j
+            else:
+                i = row4col[j]
+
+        # Update the dual variables.
+        u[current] += min_value
+        others = scanned_rows.copy()
+        others[current] = False
+        u[others] += min_value - shortest[col4row[others]]
+        v[scanned_cols] -= min_value - shortest[scanned_cols]
+
+        # Augment along the path.
+        j = sink
+        while True:
+            i = path[j]
+            row4col[j] = i
+            col4row[i], j = j, col4row[i]
+            if i == current:
+                break
+
+    return col4row
+
+def _auction(indptr, indices, utility):
+    """ Solve the assignment problem of a sparse utility graph with the 
+    epsilon-scaling auction algorithm.
+
+    Buyers may stay unmatched, so the graph is made square: buyer i gets a 
+    dummy seller, each seller with candidate buyers a dummy buyer, and 
+    each pair (i, j) a dummy pair between the dummy buyer of j and the dummy
+    seller of i, all worth 0. Free bidders bid for their best seller, raising
+    its price by the margin over their second best plus epsilon. Epsilon is
+    divided by AUCTION_SCALING after each round, down to AUCTION_TOLERANCE 
+    times the largest utility over the number of bidders, so the total 
+    utility is within AUCTION_TOLERANCE times the largest utility of the 
+    optimum.
+
+    Returns:
+        A list with the seller matched to each buyer, or None.
+    """
+
+    n_buyers = len(indptr) - 1
+    if not len(utility) or utility.max() <= 0:
+        return [None] * n_buyers
+
+    rows = np.repeat(np.arange(n_buyers), np.diff(indptr))
+
+    # Sellers without candidate buyers are left out.
+    used, indices = np.unique(indices, return_inverse=True)
+    n_sellers = len(used)
+
+    # Objects and benefits of each bidder: buyers, then dummy buyers.
+    by_seller = np.argsort(indices, kind='stable')
+    objects = [np.append(indices[indptr[i]:indptr[i + 1]], n_sellers + i).tolist() for i in range(n_buyers)]
+    benefits = [np.append(utility[indptr[i]:indptr[i + 1]], 0.0).tolist() for i in range(n_buyers)]
+
+    seller_starts = np.searchsorted(indices[by_seller], np.arange(n_sellers + 1))
+    for j in range(n_sellers):
+        objects.append([j] + (n_sellers + rows[by_seller[seller_starts[j]:seller_starts[j + 1]]]).tolist())
+        benefits.append([0.0] * len(objects[-1]))
+
+    n_bidders = len(objects)
+    prices = np.zeros(n_bidders)
+
+    # Bidders with many objects compare them with numpy.
+    for bidder in range(n_bidders):
+        if len(objects[bidder]) > AUCTION_VECTOR:
+            objects[bidder] = np.array(objects[bidder])
+            benefits[bidder] = np.array(benefits[bidder])
+
+    max_utility = float(utility.max())
+    tolerance = max_utility * AUCTION_TOLERANCE / n_bidders
+    epsilon = max(max_utility / AUCTION_SCALING, tolerance)
+
+    while True:
+        owner = [-1] * n_bidders
+        assigned = [-1] * n_bidders
+        free_bidders = list(range(n_bidders))
+
+        while free_bidders:
+            bidder = free_bidders.pop()
+            bidder_objects, bidder_benefits = objects[bidder], benefits[bidder]
+
+            # The best and second best values of the bidder.
+            if isinstance(bidder_objects, np.ndarray):
+                values = bidder_benefits - prices[bidder_objects]
+                k = int(np.argmax(values))
+                best, target = float(values[k]), int(bidder_objects[k])
+                values[k] = -np.inf
+                second = float(values.max())
+            else:
+                best, second, target = -np.inf, -np.inf, -1
+                for obj, benefit in zip(bidder_objects, bidder_benefits):
+                    value = benefit - prices[obj]
+                    if value > best:
+                        best, second, target = value, best, obj
+                    elif value > second:
+                        second = value
+
+            # A single object is worth its price plus epsilon.
+            prices[target] += best - second + epsilon if second > -np.inf else epsilon
+
+            if owner[target] >= 0:
+                assigned[owner[target]] = -1
+                free_bidders.append(owner[target])
+
+            owner[target] = bidder
+            assigned[bidder] = target
+
+        if epsilon <= tolerance:
+            break
+        epsilon = max(epsilon / AUCTION_SCALING, tolerance)
+
+    return [int(used[j]) if j < n_sellers else None for j in assigned[:n_buyers]]
+
 def maximum_weighted_matching(M):
     """ Solve a maximum weighted bipartite matching problem.
 
@@ -118,38 +453,78 @@ def maximum_weighted_matching(M):
     follows:
         (i's per_unit price - j's per_unit price) * min(i's volume, j' volume)
 
+    The matching maximizes the total utility (surplus). Pairs with a 
+    negative utility are never matched, so buyers may stay unmatched. 
+    The dense utility matrix is solved exactly with shortest augmenting 
+    paths. With M.sparse, the candidate graph is solved with the auction 
+    algorithm instead, which scales to large markets.
+
     Args:
         M (Market): 
             A market instance.          
-            Note: We assume that the number of buyers equals to
-            the number of sellers.
 
     Returns:
         A dict that contains one-to-one matching between the 
         buyers and the sellers.
     """
-    bids = M.book.orders[(M.book.orders["Type"] == "bid")]
-    asks = M.book.orders[(M.book.orders["Type"] == "ask")]
 
-    # Buyer/seller preference list format:
-    # {buyer_id : {seller id : utility}}, {seller_id : {buyer id : utility}}    
-    # Utility between i and j is the different between their per-unit price 
-    # times the number trading units.
-    buyer_pref_dict, _ = general.preference_list(bids, asks)
+    if getattr(M, "sparse", False):
+        buyers, sellers, indptr, indices, utility = _utility_graph(M)
+        buyer_match = _auction(indptr, indices, utility)
+        
+    else:
+        buyers, sellers, utility = general.utility_matrix(M.book)
+
+        # Negative pairs are worth nothing, and dropped once assigned.
+        cost = -np.maximum(utility, 0)
+        if len(buyers) <= len(sellers):
+            cols = _shortest_augmenting_path(cost)
+            rows = np.arange(len(buyers))
+        else:
+            rows = _shortest_augmenting_path(cost.T)
+            cols = np.arange(len(sellers))
+
+        buyer_match = [None] * len(buyers)
+        for i, j in zip(rows.tolist(), cols.tolist()):
+            if utility[i, j] >= 0:
+                buyer_match[i] = j
+
+    sellers = sellers.tolist()
+    return {buyer : sellers[seller] for buyer, seller in zip(buyers.tolist(), buyer_match) 
+            if seller is not None}
+
+def matching_surplus(M, matching):
+    """ The total utility of a matching.
+
+    Args:
+        M (Market): 
+            A market instance.          
+        matching (dict):
+            A buyer-seller matching returned by a matching method.
+
+    Returns:
+        The sum of the utilities of the matched pairs. For a transport 
+        matching, the price difference of each pair times its units.
+    """
+
+    buyers, buyer_units, buyer_prices = M.book.user_summary("bid")
+    sellers, seller_units, seller_prices = M.book.user_summary("ask")
+
+    buyer_pos = dict(zip(buyers.tolist(), range(len(buyers))))
+    seller_pos = dict(zip(sellers.tolist(), range(len(sellers))))
 
-    # Maximum weighted bipartite matching
-    G = nx.Graph(nodetype=int)
-    for u in buyer_pref_dict.keys():
-        for v, w in buyer_pref_dict[u].items():
-            G.add_edge(u, v, weight=w)
+    if any(isinstance(seller, dict) for seller in matching.values()):
+        flows = [(buyer_pos[buyer], seller_pos[seller], units) 
+                 for buyer, routed in matching.items() for seller, units in routed.items()]
+        i, j, units = (np.array(col) for col in zip(*flows)) if flows else ([], [], [])
+        return float(np.sum((buyer_prices[i] - seller_prices[j]) * units))
 
-    final_matching = nx.bipartite.maximum_matching(G)
+    i = np.array([buyer_pos[buyer] for buyer in matching.keys()], dtype=np.int64)
+    j = np.array([seller_pos[seller] for seller in matching.values()], dtype=np.int64)
 
-    # The format of final_matching is {user : matched_user}, where the left 
-    # hand side of a pair can be either a buyer or a sellers. This creates
-    # duplicates. Therefore, we only extract the matching where buyers are on
-    # the left-hand side.
-    return {u : v for u, v in final_matching.items() if u in buyer_pref_dict.keys()}
+    # As in general.utility_matrix()
+    surplus = (buyer_prices[i] - seller_prices[j]) * np.minimum(buyer_units[i], seller_units[j])
+    return float(surplus.sum())
 
 # ------------------ #
 #   Greedy Matching  #
@@ -161,7 +536,12 @@ def greedy_matching(M):
     follows:
         (i's per_unit price - j's per_unit price) * min(i's volume, j' volume)
     The market then greedily selects the next (previously unmatched) pair to be
-    matched.
+    matched, ties by buyer id then seller id in descending order.
+
+    Pairs are never all listed and sorted. Without M.sparse, the heap of 
+    _ordered_matching() pulls the best pair of volume groups. With M.sparse, 
+    a heap holds the best candidate of each free buyer, and a buyer whose 
+    seller was taken moves on to its next candidate.
 
     Args:
         M (Market): 
@@ -173,39 +553,297 @@ def greedy_matching(M):
         A dict that contains one-to-one matching between the 
         buyers and the sellers.
     """
-    bids = M.book.orders[(M.book.orders["Type"] == "bid")]
-    asks = M.book.orders[(M.book.orders["Type"] == "ask")]
+    if not getattr(M, "sparse", False):
+        buyers, buyer_units, buyer_prices = M.book.user_summary("bid")
+        sellers, seller_units, seller_prices = M.book.user_summary("ask")
+
+        # Ties are broken by id in descending order, so users are put in that order.
+        b_order = np.argsort(-buyers, kind='stable')
+        s_order = np.argsort(-sellers, kind='stable')
+        buyer_match = _ordered_matching(buyer_units[b_order], buyer_prices[b_order], 
+                                        seller_units[s_order], seller_prices[s_order])
+
+        buyers, sellers = buyers[b_order].tolist(), sellers[s_order].tolist()
+        return {buyers[i] : sellers[j] for i, j in enumerate(buyer_match) if j is not None}
 
-    # Buyer/seller preference list format:
-    # {buyer_id : {seller id : utility}}, {seller_id : {buyer id : utility}}    
-    # Utility between i and j is the different between their per-unit price 
-    # times the number trading units.
-    buyer_pref_dict, _ = general.preference_list(bids, asks) 
+    buyers, sellers, indptr, indices, utility = _utility_graph(M)
+    rows = np.repeat(np.arange(len(buyers)), np.diff(indptr))
+    n_pairs = min(len(buyers), len(sellers))
 
-    sorted_pairs = sorted(
-        [(util, (u, v)) for u, x in buyer_pref_dict.items() for v, util in x.items()], reverse=True
-    )
+    # The candidates of each buyer by utility, ties by seller id in descending order.
+    order = np.lexsort((-sellers[indices], -utility, rows))
+    indices, utility, ends = indices[order].tolist(), utility[order].tolist(), indptr[1:].tolist()
+
+    # A heap holds the best pair (-utility, -buyer id, -seller id, buyer, pair) 
+    # of each free buyer whose seller was free when it was pushed.
+    heap = [(-utility[e], -buyer, -sellers[indices[e]], i, e) 
+            for i, (buyer, e) in enumerate(zip(buyers.tolist(), indptr[:-1].tolist())) if e < ends[i]]
+    heapq.heapify(heap)
 
     # Greedy matching
-    seen_seller = set()
+    taken = [False] * len(sellers)
     final_matching = {}
-    for _, p in sorted_pairs:
-        u, v = p
-
-        if v in seen_seller:
-            continue
-        if u in final_matching.keys():
+    sellers = sellers.tolist()
+
+    while heap and len(final_matching) < n_pairs:
+        _, neg_buyer, _, i, e = heapq.heappop(heap)
+        seller = indices[e]
+
+        # The seller was taken: push the next free candidate of the buyer.
+        if taken[seller]:
+            e += 1
+            while e < ends[i] and taken[indices[e]]:
+                e += 1
+            if e < ends[i]:
+                heapq.heappush(heap, (-utility[e], neg_buyer, -sellers[indices[e]], i, e))
             continue
 
-        final_matching[u] = v
-        seen_seller.add(v)
+        final_matching[-neg_buyer] = sellers[seller]
+        taken[seller] = True
     
     return final_matching
 
+# --------------------- #
+#  Transport Matching   #
+# --------------------- #
+def _transport_sorted(buyer_units, buyer_prices, seller_units, seller_prices):
+    """ Route units from the highest bids to the lowest asks.
+
+    When every buyer may trade with every seller whose ask is not above its 
+    bid, this is an optimal transport: the units with the highest bids are 
+    matched with the units with the lowest asks until the bid falls below 
+    the ask.
+
+    Args:
+        buyer_units, buyer_prices, seller_units, seller_prices (np.ndarray):
+            The volumes and average prices of the buyers and the sellers.
+
+    Returns:
+        A list of (buyer index, seller index, units).
+    """
+
+    buyer_order = np.argsort(-buyer_prices, kind='stable').tolist()
+    seller_order = np.argsort(seller_prices, kind='stable').tolist()
+    supply, demand = buyer_units.tolist(), seller_units.tolist()
+
+    flows = []
+    b, s = 0, 0
+    while (b < len(buyer_order) and s < len(seller_order) 
+           and buyer_prices[buyer_order[b]] >= seller_prices[seller_order[s]]):
+        i, j = buyer_order[b], seller_order[s]
+        units = min(supply[i], demand[j])
+
+        if units > 0:
+            flows.append((i, j, units))
+            supply[i] -= units
+            demand[j] -= units
+
+        if supply[i] <= 0:
+            b += 1
+        if demand[j] <= 0:
+            s += 1
+
+    return flows
+
+def _successive_shortest_paths(indptr, indices, buyer_units, buyer_prices, seller_units, seller_prices):
+    """ Min-cost flow from buyers to their candidate sellers.
+
+    Each buyer i supplies up to its units at a profit of its average bid a_i
+    per unit, each seller j takes up to its units at a cost of its average 
+    ask c_j, and buyers send any number of units to their candidates. Only 
+    the endpoints of a path cost something, so the shortest augmenting path 
+    of buyer i ends at the seller with the lowest ask among those with units
+    left that it reaches in the residual graph: through its candidates, and 
+    back through the buyers that already send units to them.
+
+    Buyers augment in the order of their bids, highest first, until they 
+    run out of units or reach no seller with c_j <= a_i. The nodes of a 
+    search that fails reach no such seller for any later, lower bid either,
+    so they are never searched again. A search stops early when it reaches 
+    the seller with the lowest ask of all.
+
+    Args:
+        indptr, indices (np.ndarray):
+            The candidate sellers of buyer i are indices[indptr[i]:indptr[i + 1]].
+        buyer_units, buyer_prices, seller_units, seller_prices (np.ndarray):
+            The volumes and average prices of the buyers and the sellers.
+
+    Returns:
+        A list of (buyer index, seller index, units).
+    """
+
+    indptr, indices = indptr.tolist(), indices.tolist()
+    supply, demand = buyer_units.tolist(), seller_units.tolist()
+    bids, asks = buyer_prices.tolist(), seller_prices.tolist()
+    n_buyers, n_sellers = len(supply), len(demand)
+
+    # flow[j] = {i : units sent from buyer i to seller j}
+    flow = [{} for _ in range(n_sellers)]
+
+    dead_buyer, dead_seller = [False] * n_buyers, [False] * n_sellers
+    seen_buyer, seen_seller = [0] * n_buyers, [0] * n_sellers
+    # The seller through which a buyer was reached, and the buyer through 
+    # which a seller was reached.
+    buyer_parent, seller_parent = [0] * n_buyers, [0] * n_sellers
+    search = 0
+
+    # The sellers by ask: those before the cursor have no units left or are dead.
+    by_ask = np.argsort(seller_prices, kind='stable').tolist()
+    cursor = 0
+
+    for i in np.argsort(-buyer_prices, kind='stable').tolist():
+        bid = bids[i]
+
+        while supply[i] > 0 and not dead_buyer[i]:
+            while cursor < n_sellers and (demand[by_ask[cursor]] <= 0 or dead_seller[by_ask[cursor]]):
+                cursor += 1
+            cheapest = by_ask[cursor] if cursor < n_sellers else -1
+
+            search += 1
+            seen_buyer[i] = search
+            stack, reached_buyers, reached_sellers = [i], [i], []
+            best = -1
+
+            while stack and best != cheapest:
+                x = stack.pop()
+                for j in indices[indptr[x]:indptr[x + 1]]:
+                    if seen_seller[j] == search or dead_seller[j]:
+                        continue
+                    seen_seller[j] = search
+                    seller_parent[j] = x
+                    reached_sellers.append(j)
+
+                    if demand[j] > 0 and asks[j] <= bid and (best < 0 or asks[j] < asks[best]):
+                        best = j
+
+                    for y in flow[j]:
+                        if seen_buyer[y] != search and not dead_buyer[y]:
+                            seen_buyer[y] = search
+                            buyer_parent[y] = j
+                            reached_buyers.append(y)
+                            stack.append(y)
+
+            if best < 0:
+                for x in reached_buyers:
+                    dead_buyer[x] = True
+                for j in reached_sellers:
+                    dead_seller[j] = True
+                break
+
+            # The units that can be rerouted along the path.
+            units = min(supply[i], demand[best])
+            j = best
+            while seller_parent[j] != i:
+                x = seller_parent[j]
+                j = buyer_parent[x]
+                units = min(units, flow[j][x])
+
+            j = best
+            while True:
+                x = seller_parent[j]
+                flow[j][x] = flow[j].get(x, 0) + units
+                if x == i:
+                    break
+
+                j = buyer_parent[x]
+                flow[j][x] -= units
+                if flow[j][x] <= 0:
+                    del flow[j][x]
+
+            supply[i] -= units
+            demand[best] -= units
+
+    return [(i, j, units) for j in range(n_sellers) for i, units in flow[j].items()]
+
+def transport_matching(M):
+    """ Many-to-many matching of units (a transportation problem).
+
+    Unlike the other matching methods, a participant may trade with several 
+    partners, up to its volume. Each unit traded between buyer i and seller j
+    is worth the difference of their average prices, and the units are routed
+    to maximize the total:
+        sum over (i, j) of (i's per_unit price - j's per_unit price) * units(i, j)
+
+    Any seller whose ask is not above the bid of a buyer may trade with it, 
+    and the units go from the highest bids to the lowest asks. With M.sparse
+    and M.top_k, a buyer only trades with its candidate sellers (see 
+    general.candidate_graph()), and the min-cost flow is solved with 
+    successive shortest paths.
+
+    Args:
+        M (Market): 
+            A market instance.
+
+    Returns:
+        A dict {buyer_id : {seller_id : units}} with the units routed from 
+        each matched buyer to each of its sellers.
+    """
+
+    buyers, buyer_units, buyer_prices = M.book.user_summary("bid")
+    sellers, seller_units, seller_prices = M.book.user_summary("ask")
+
+    if getattr(M, "sparse", False) and getattr(M, "top_k", None) is not None:
+        _, _, indptr, indices, _ = _utility_graph(M)
+        flows = _successive_shortest_paths(indptr, indices, buyer_units, buyer_prices, 
+                                           seller_units, seller_prices)
+    else:
+        flows = _transport_sorted(buyer_units, buyer_prices, seller_units, seller_prices)
+
+    buyers, sellers = buyers.tolist(), sellers.tolist()
+    final_matching = {}
+    for i, j, units in sorted(flows):
+        final_matching.setdefault(buyers[i], {})[sellers[j]] = units
+
+    return final_matching
+
 # --- Factory ---
 MATCHING_METHODS = {
     "random": random_matching,
     "stable": stable_matching,
     "maximum": maximum_weighted_matching,
-    "greedy": greedy_matching
-}
\ No newline at end of file
+    "greedy": greedy_matching,
+    "transport": transport_matching
+}
+
+if __name__ == "__main__":  # python3 -m marketlib.utils.matching
+    import time
+    import networkx as nx # type: ignore
+    from marketlib.markets import bilateral
+
+    def networkx_matching(M):
+        # The previous maximum matching: a maximum cardinality matching, 
+        # which ignores the weights.
+        buyers, sellers, utility = general.utility_matrix(M.book)
+        G = nx.Graph(nodetype=int)
+        G.add_weighted_edges_from(zip(np.repeat(buyers, len(sellers)).tolist(), 
+                                      np.tile(sellers, len(buyers)).tolist(), utility.ravel().tolist()))
+        matching = nx.bipartite.maximum_matching(G, top_nodes=set(buyers.tolist()))
+        return {u : v for u, v in matching.items() if u in set(buyers.tolist())}
+
+    rng = np.random.default_rng(0)
+    n = 500
+
+    M = bilateral.BilateralMarket()
+    M.add_orders("bid", unit=rng.integers(1, 10, n).astype(float), price=rng.uniform(1, 3, n), user_id=np.arange(n))
+    M.add_orders("ask", unit=rng.integers(1, 10, n).astype(float), price=rng.uniform(2, 4, n), user_id=np.arange(n, 2 * n))
+
+    for name, method in [("networkx", networkx_matching), ("assignment", maximum_weighted_matching)]:
+        start = time.perf_counter()
+        matching = method(M)
+        print(f"{name}: {time.perf_counter() - start:.2f}s, {len(matching)} pairs, "
+              f"surplus {matching_surplus(M, matching):.2f}")
+
+    M.sparse = True
+    start = time.perf_counter()
+    matching = maximum_weighted_matching(M)
+    print(f"auction: {time.perf_counter() - start:.2f}s, {len(matching)} pairs, "
+          f"surplus {matching_surplus(M, matching):.2f}")
+
+    # Users trade with several partners, up to their volumes.
+    for top_k in [None, 10]:
+        M.top_k = top_k
+        start = time.perf_counter()
+        matching = transport_matching(M)
+        print(f"transport (top_k={top_k}): {time.perf_counter() - start:.2f}s, "
+              f"{sum(len(sellers) for sellers in matching.values())} pairs, "
+              f"surplus {matching_surplus(M, matching):.2f}")
@@ -0,0 +1,291 @@
+""" Parallel clearing of many independent markets.
+
+    The orders of all markets are stacked into flat columns, sorted by market,
+    and copied once into shared memory (multiprocessing.shared_memory).
+    Workers of a process pool attach to the columns by name and clear a
+    contiguous range of markets, so only the names of the blocks and the
+    row range of each task are sent to the workers, never the orders.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from marketlib.markets import orderbook as ob
+
+# The order columns placed in shared memory.
+SHARED_COLUMNS = {
+    "Market" : np.int64,
+    "Unit" : np.float64,
+    "Price" : np.float64,
+    "Bid" : np.bool_,
+    "User" : np.int64
+}
+
+# Number of tasks per worker, so faster workers pick up more market ranges.
+TASKS_PER_WORKER = 4
+
+# ------------------------
+# -   Shared columns     -
+# ------------------------
+def _share_columns(cols : dict):
+    """ Copy each column into a new shared memory block.
+
+    Returns:
+        A tuple (blocks, spec): the SharedMemory objects, to be closed and
+        unlinked by the caller, and {name : (block name, length)} to attach them.
+    """
+
+    blocks, spec = [], {}
+
+    try:
+        for name, col in cols.items():
+            col = np.ascontiguousarray(col, dtype=SHARED_COLUMNS[name])
+
+            # A block cannot be empty.
+            block = shared_memory.SharedMemory(create=True, size=max(col.nbytes, 1))
+            blocks.append(block)
+
+            np.ndarray(col.shape, dtype=col.dtype, buffer=block.buf)[:] = col
+            spec[name] = (block.name, len(col))
+    except BaseException:
+        _release(blocks)
+        raise
+
+    return blocks, spec
+
+def _attach_columns(spec : dict):
+    """ Attach to the shared columns described by spec.
+
+    Returns:
+        A tuple (blocks, cols): the SharedMemory objects, to be closed once
+        the columns are no longer used, and {name : array}.
+    """
+
+    blocks, cols = [], {}
+    for name, (block_name, length) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        cols[name] = np.ndarray((length,), dtype=SHARED_COLUMNS[name], buffer=block.buf)
+
+    return blocks, cols
+
+def _release(blocks, unlink=True):
+    for block in blocks:
+        block.close()
+        if unlink:
+            block.unlink()
+
+# ------------------------
+# -   Workers            -
+# ------------------------
+def _clear_pool(cols, first, n_markets, options):
+    """ Clear pool markets with the segmented engine of clear_markets().
+    """
+
+    from marketlib.markets import pool
+
+    seg = cols["Market"] - first
+    prices, _, _, buyers, sellers = pool._clear_segments(seg, cols["Unit"], cols["Price"], cols["Bid"],
+                                                         cols["User"], n_markets, options["alloc_type"], 
+                                                         options["divisible"])
+
+    return [(a_seg + first, a_user, a_units, prices[a_seg]) for a_seg, a_user, a_units in (buyers, sellers)]
+
+def _clear_bilateral(cols, first, n_markets, options):
+    """ Clear bilateral markets one by one.
+    """
+
+    from marketlib.markets import bilateral
+
+    seg = cols["Market"] - first
+    starts = np.searchsorted(seg, np.arange(n_markets + 1))
+
+    # Columns (market, user, units, price) of the buyer and seller allocations.
+    results = ([[], [], [], []], [[], [], [], []])
+
+    for m in range(n_markets):
+        rows = slice(starts[m], starts[m + 1])
+        is_bid = cols["Bid"][rows]
+
+        M = bilateral.BilateralMarket(matching_type=options["matching_type"],
+                                      bargain_type=options["bargain_type"])
+        for side, mask in [("bid", is_bid), ("ask", ~is_bid)]:
+            if mask.any():
+                M.add_orders(side, unit=cols["Unit"][rows][mask], price=cols["Price"][rows][mask],
+                             user_id=cols["User"][rows][mask])
+
+        if len(M.book._levels[ob.BID]) and len(M.book._levels[ob.ASK]):
+            M.clearing()
+
+        for result, allocation in [(results[0], M.alloc_buyer), (results[1], M.alloc_seller)]:
+            result[0].append(np.full(len(allocation), first + m, dtype=np.int64))
+            result[1].append(allocation.users)
+            result[2].append(allocation.units)
+            result[3].append(allocation.prices)
+
+    return [tuple(_concat(col) for col in result) for result in results]
+
+def _concat(arrays):
+    return np.concatenate(arrays) if arrays else np.empty(0)
+
+def _clear_range(spec, start, stop, first, n_markets, market_type, options):
+    """ Clear the markets in rows [start, stop) of the shared columns.
+
+    Returns:
+        Two tuples of arrays (market, user, units, price), for buyers and sellers.
+    """
+
+    blocks, cols = _attach_columns(spec)
+
+    try:
+        # Copies, so the blocks can be closed when the task ends.
+        cols = {name : col[start:stop].copy() for name, col in cols.items()}
+    finally:
+        _release(blocks, unlink=False)
+
+    return CLEARING_WORKERS[market_type](cols, first, n_markets, options)
+
+# Factory
+CLEARING_WORKERS = {
+    "pool" : _clear_pool,
+    "bilateral" : _clear_bilateral
+}
+
+# ------------------------
+# -   Parallel clearing  -
+# ------------------------
+def _split(offsets, n_tasks):
+    """ Cut the markets into at most n_tasks ranges with about as many orders each.
+
+    Args:
+        offsets (array):
+            offsets[m] is the first row of market m, offsets[-1] the number of rows.
+
+    Returns:
+        An array of market indices c_0 = 0 < c_1 < ... < c_k = number of markets,
+        the i-th range being markets [c_i, c_{i+1}).
+    """
+
+    n_markets = len(offsets) - 1
+    targets = np.linspace(0, offsets[-1], n_tasks + 1)
+
+    cuts = np.searchsorted(offsets, targets, side='left')
+    cuts = np.clip(cuts, 0, n_markets)
+    cuts[0], cuts[-1] = 0, n_markets
+
+    return np.unique(cuts)
+
+def parallel_clearing(
+    orders : pd.DataFrame,
+    market_type : str = "pool",
+    workers : int = None,
+    alloc_type : str = "uniform",
+    divisible : bool = True,
+    matching_type : str = "random",
+    bargain_type : str = "middle"
+):
+    """ Clear many independent markets with a pool of processes.
+
+    Args:
+        orders (pd.DataFrame):
+            The stacked orders of all markets, with columns
+            "Market" | "Unit" | "Price" | "Type" | "User", Type being "bid" or "ask".
+        market_type (str, optional):
+            "pool" clears each market as PoolMarket (with the segmented engine
+            of pool.clear_markets()), "bilateral" as BilateralMarket.
+        workers (int, optional):
+            Number of processes. Defaults to the number of CPUs. With one
+            worker, the markets are cleared in this process.
+        alloc_type (str, optional):
+            The allocation method of pool markets.
+        divisible (bool, optional):
+            If False, pool markets allocate whole units.
+        matching_type, bargain_type (str, optional):
+            The matching and bargaining methods of bilateral markets.
+
+    Returns:
+        A tuple of two dataframes:
+            (buyer allocation with columns "Market" | "User" | "Units Bought" | "Price",
+             seller allocation with columns "Market" | "User" | "Units Sold" | "Price")
+
+    Raises:
+        ValueError: The market type or an order type does not exist.
+    """
+
+    if market_type not in CLEARING_WORKERS:
+        raise ValueError(f"Invalid market type: {market_type}")
+
+    invalid = ~orders["Type"].isin(ob.TYPES)
+    if invalid.any():
+        raise ValueError(f"Invalid order type: {orders['Type'][invalid].iloc[0]}")
+
+    workers = workers or os.cpu_count() or 1
+    options = {"alloc_type" : alloc_type, "divisible" : divisible, 
+               "matching_type" : matching_type, "bargain_type" : bargain_type}
+
+    # Sort the orders by market, keeping their order within each market.
+    labels, seg = np.unique(orders["Market"].to_numpy(), return_inverse=True)
+    seg = seg.reshape(-1)
+    order = np.argsort(seg, kind='stable')
+
+    cols = {
+        "Market" : seg[order],
+        "Unit" : orders["Unit"].to_numpy(dtype=np.float64)[order],
+        "Price" : orders["Price"].to_numpy(dtype=np.float64)[order],
+        "Bid" : (orders["Type"] == "bid").to_numpy()[order],
+        "User" : orders["User"].to_numpy(dtype=np.int64)[order]
+    }
+
+    offsets = np.searchsorted(cols["Market"], np.arange(len(labels) + 1))
+    cuts = _split(offsets, workers * TASKS_PER_WORKER if workers > 1 else 1)
+    tasks = [(int(offsets[a]), int(offsets[b]), int(a), int(b - a)) for a, b in zip(cuts[:-1], cuts[1:])]
+
+    if workers == 1:
+        results = [CLEARING_WORKERS[market_type]({name : col[start:stop] for name, col in cols.items()},
+                                                 first, n_markets, options)
+                   for start, stop, first, n_markets in tasks]
+    else:
+        blocks, spec = _share_columns(cols)
+        del cols
+
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_clear_range, spec, start, stop, first, n_markets,
+                                           market_type, options)
+                           for start, stop, first, n_markets in tasks]
+                results = [future.result() for future in futures]
+        finally:
+            _release(blocks)
+
+    # Merge the results of all tasks, which are in market order.
+    allocations = []
+    for side, column in [(0, "Units Bought"), (1, "Units Sold")]:
+        a_seg, a_user, a_units, a_price = (_concat([result[side][i] for result in results]) for i in range(4))
+
+        allocations.append(pd.DataFrame({"Market" : labels[a_seg.astype(np.int64)], 
+                                         "User" : a_user.astype(np.int64), 
+                                         column : a_units, "Price" : a_price}))
+
+    return allocations[0], allocations[1]
+
+if __name__ == "__main__":  # python3 -m marketlib.utils.parallel
+    import time
+
+    rng = np.random.default_rng(0)
+    n = 1_000_000
+
+    orders = pd.DataFrame({
+        "Market" : rng.integers(0, 20_000, n),
+        "Unit" : rng.integers(1, 10, n).astype(float),
+        "Price" : rng.uniform(1, 5, n).round(2),
+        "Type" : np.where(rng.random(n) < 0.5, "bid", "ask"),
+        "User" : rng.integers(0, 1000, n)
+    })
+
+    for workers in sorted({1, os.cpu_count()}):
+        start = time.perf_counter()
+        alloc_buyer, alloc_seller = parallel_clearing(orders, "pool", workers=workers)
+        print(f"{workers} worker(s): {time.perf_counter() - start:.2f}s, "
+              f"{len(alloc_buyer)} buyer and {len(alloc_seller)} seller allocations")
@@ -0,0 +1,164 @@
+""" Binary snapshots of orderbooks and clearing results.
+
+    A snapshot is a directory with one .npy file per column, e.g.:
+
+        book/Unit.npy, book/Price.npy, book/Type.npy, book/User.npy, 
+        book/ID.npy, book/Alive.npy, book/levels_bid.npy, book/counts_bid.npy, ...
+
+    The files are loaded with np.load(mmap_mode='r'), so restoring a 
+    snapshot involves no parsing and only touches the pages that are read.
+"""
+
+import os
+import numpy as np
+from marketlib.markets import orderbook as ob
+from marketlib.utils import allocation as alloc
+
+# The columns of alloc_buyer and alloc_seller.
+ALLOC_COLUMNS = {
+    "User" : np.int64,
+    "Units Bought" : np.float64,
+    "Units Sold" : np.float64,
+    "Price" : np.float64,
+    "Welfare" : np.float64
+}
+
+# -----------------------
+# -   Column files      -
+# -----------------------
+def _save_columns(path : str, cols : dict):
+    """ Write each column into path/<name>.npy.
+    """
+
+    os.makedirs(path, exist_ok=True)
+    for name, col in cols.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(col))
+
+def _load_column(path : str, name : str, mmap : bool = True):
+    """ Read path/<name>.npy, memory-mapped if mmap is set.
+    """
+
+    return np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if mmap else None)
+
+# ----------------------
+# -   Orderbook        -
+# ----------------------
+def save_orderbook(book, path : str):
+    """ Save an orderbook as one .npy file per column.
+
+    Args:
+        book (_OrderBook): 
+            The orderbook to save.
+        path (str): 
+            The snapshot directory. Created if it does not exist.
+    """
+
+    cols = {name : book.column(name) for name in book.col_dtypes}
+    cols["levels_bid"] = book._get_bids()
+    cols["levels_ask"] = book._get_asks()
+    cols["counts_bid"] = book._levels[ob.BID].counts()
+    cols["counts_ask"] = book._levels[ob.ASK].counts()
+
+    _save_columns(path, cols)
+
+def load_orderbook(path : str, mmap : bool = True):
+    """ Restore an orderbook saved by save_orderbook().
+
+    Args:
+        path (str): 
+            The snapshot directory.
+        mmap (bool, optional): 
+            If True (default), the columns are memory-mapped read-only. They 
+            are copied into memory when orders are added to the book.
+
+    Returns:
+        An _OrderBook instance.
+    """
+
+    cols = {name : _load_column(path, name, mmap) for name in ob._OrderBook.col_dtypes}
+    levels = tuple((_load_column(path, f"levels_{side}", mmap), _load_column(path, f"counts_{side}", mmap)) 
+                   for side in ob.TYPES)
+
+    return ob._OrderBook._from_columns(cols, levels)
+
+# ----------------------
+# -   Allocations      -
+# ----------------------
+def save_allocation(result, path : str):
+    """ Save alloc_buyer or alloc_seller as one .npy file per column.
+
+    Args:
+        result (AllocationResult): 
+            The allocation of one side of a market.
+        path (str): 
+            The snapshot directory. Created if it does not exist.
+    """
+
+    cols = {
+        "User" : result.users, 
+        result.UNIT_COLUMNS[result.side] : result.units, 
+        "Price" : result.prices, 
+        "Welfare" : result.welfare
+    }
+    _save_columns(path, {name : np.asarray(col, dtype=ALLOC_COLUMNS[name]) for name, col in cols.items()})
+
+def load_allocation(path : str, mmap : bool = True):
+    """ Restore an allocation saved by save_allocation().
+
+    Args:
+        path (str): 
+            The snapshot directory.
+        mmap (bool, optional): 
+            If True (default), the columns are read through memory maps.
+
+    Returns:
+        An AllocationResult. Snapshots without a welfare column (written 
+        before it was added) load with a zero welfare.
+    """
+
+    side = "buyer" if os.path.exists(os.path.join(path, "Units Bought.npy")) else "seller"
+    units = alloc.AllocationResult.UNIT_COLUMNS[side]
+
+    users = _load_column(path, "User", mmap)
+
+    # Snapshots written before the welfare column existed get a zero welfare.
+    welfare = (_load_column(path, "Welfare", mmap) 
+               if os.path.exists(os.path.join(path, "Welfare.npy")) else np.zeros(len(users)))
+
+    return alloc.AllocationResult(side, users, _load_column(path, units, mmap), 
+                                  _load_column(path, "Price", mmap), welfare)
+
+# ----------------------
+# -   Market           -
+# ----------------------
+def save_market(M, path : str):
+    """ Save the orderbook and the clearing results of a market.
+
+    Layout: path/book, path/alloc_buyer, path/alloc_seller.
+
+    Args:
+        M (Market): 
+            A market instance.
+        path (str): 
+            The snapshot directory. Created if it does not exist.
+    """
+
+    save_orderbook(M.book, os.path.join(path, "book"))
+    save_allocation(M.alloc_buyer, os.path.join(path, "alloc_buyer"))
+    save_allocation(M.alloc_seller, os.path.join(path, "alloc_seller"))
+
+def load_market(M, path : str, mmap : bool = True):
+    """ Restore the orderbook and the clearing results of a market saved by save_market().
+
+    Args:
+        M (Market): 
+            The market instance to restore into. Its orderbook and results are replaced.
+        path (str): 
+            The snapshot directory.
+        mmap (bool, optional): 
+            If True (default), the columns are memory-mapped read-only.
+    """
+
+    M.book = load_orderbook(os.path.join(path, "book"), mmap)
+    M.alloc_buyer = load_allocation(os.path.join(path, "alloc_buyer"), mmap)
+    M.alloc_seller = load_allocation(os.path.join(path, "alloc_seller"), mmap)
@@ -0,0 +1,65 @@
+import itertools
+import numpy as np
+import networkx as nx  # type: ignore
+from marketlib.markets import bilateral
+from marketlib.utils import general
+from marketlib.utils import matching as match
+
+rng = np.random.default_rng(7)
+
+def best_assignment(cost):
+    """ The least total cost of a rectangular assignment, by enumeration.
+    """
+    n_rows, n_cols = cost.shape
+    return min(cost[np.arange(n_rows), list(cols)].sum()
+               for cols in itertools.permutations(range(n_cols), n_rows))
+
+def best_surplus(indptr, indices, utility):
+    """ The largest total utility of a matching of a utility graph (networkx).
+    """
+    G = nx.Graph()
+    for i in range(len(indptr) - 1):
+        for e in range(indptr[i], indptr[i + 1]):
+            if utility[e] > 0:
+                G.add_edge(("buyer", i), ("seller", int(indices[e])), weight=float(utility[e]))
+
+    return sum(G[u][v]["weight"] for u, v in nx.max_weight_matching(G))
+
+# Shortest augmenting paths against enumeration.
+for _ in range(300):
+    n_rows = int(rng.integers(1, 6))
+    n_cols = int(rng.integers(n_rows, 7))
+    cost = rng.integers(-9, 10, (n_rows, n_cols)).astype(float)
+
+    cols = match._shortest_augmenting_path(cost)
+    assert len(set(cols.tolist())) == n_rows
+    assert np.isclose(cost[np.arange(n_rows), cols].sum(), best_assignment(cost))
+
+# Dense and sparse (auction) maximum weighted matchings against networkx.
+for t in range(100):
+    M = bilateral.BilateralMarket()
+    n_buyers, n_sellers = rng.integers(1, 15, 2)
+    M.add_orders("bid", unit=rng.uniform(1, 5, 2 * n_buyers), price=rng.integers(1, 8, 2 * n_buyers).astype(float),
+                 user_id=rng.integers(0, n_buyers, 2 * n_buyers))
+    M.add_orders("ask", unit=rng.uniform(1, 5, 2 * n_sellers), price=rng.integers(1, 8, 2 * n_sellers).astype(float),
+                 user_id=rng.integers(100, 100 + n_sellers, 2 * n_sellers))
+
+    buyers, sellers, utility = general.utility_matrix(M.book)
+    indptr = np.arange(len(buyers) + 1) * len(sellers)
+    indices = np.tile(np.arange(len(sellers)), len(buyers))
+
+    m = match.maximum_weighted_matching(M)
+    assert len(set(m.values())) == len(m)
+    assert np.isclose(match.matching_surplus(M, m), best_surplus(indptr, indices, utility.ravel()))
+
+    # The auction is within AUCTION_TOLERANCE times the largest utility of the optimum.
+    M.sparse, M.top_k = True, [None, 2][t % 2]
+    _, _, indptr, indices, graph_utility = general.candidate_graph(M.book, M.top_k)
+    best = best_surplus(indptr, indices, graph_utility)
+
+    m = match.maximum_weighted_matching(M)
+    assert len(set(m.values())) == len(m)
+    surplus = match.matching_surplus(M, m)
+    assert best - 1e-6 * max(utility.max(), 0) - 1e-9 <= surplus <= best + 1e-9
+
+print("Assignment matching: OK")
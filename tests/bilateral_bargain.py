@@ -0,0 +1,17 @@
+from marketlib.markets import bilateral as mk
+from marketlib.utils import bargain
+
+# Buyer 0 bids below the ask of seller 10, so that pair trades nothing and
+# gets no allocation. Buyer 1 and seller 11 trade 2 units at the middle price.
+M = mk.BilateralMarket()
+M.bid(2, 1.0, 0)
+M.bid(2, 5.0, 1)
+M.ask(2, 3.0, 10)
+M.ask(2, 4.0, 11)
+
+bargain.middle_bargaining(M, {0 : 10, 1 : 11})
+
+print(M.alloc_buyer)
+print(M.alloc_seller)
+
+assert len(M.alloc_buyer) == len(M.alloc_seller) == 1
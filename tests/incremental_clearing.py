@@ -0,0 +1,55 @@
+import numpy as np
+from marketlib.markets import pool
+from marketlib.utils import bidask as ba
+
+# Random streams of inserts, bulk inserts, cancels and modifies. After each
+# change, the incremental clearing of one market must match reference_clearing
+# on the curves of a market given the same orders.
+rng = np.random.default_rng(0)
+
+for trial in range(20):
+    M = pool.PoolMarket(incremental=True)
+    R = pool.PoolMarket()
+    ids = []
+
+    # Integer, real, monotone and clustered prices.
+    mode = trial % 4
+
+    for step in range(200):
+        r = rng.random()
+
+        if r < 0.6 or not ids:
+            side = ["bid", "ask"][rng.integers(2)]
+            if mode == 0:
+                price = float(rng.integers(1, 20))
+            elif mode == 1:
+                price = float(rng.uniform(1, 20))
+            elif mode == 2:
+                price = 10 + step * 0.01 * (1 if side == "bid" else -1)
+            else:
+                price = 10 + 1e-6 * step * (rng.random() < 0.5)
+
+            k = int(rng.integers(2, 6)) if rng.random() < 0.1 else 1
+            unit = [float(rng.integers(1, 10))] * k
+            prices = [price + 0.5 * i for i in range(k)]
+
+            ids += list(M.add_orders(side, unit=unit, price=prices, user_id=[0] * k))
+            R.add_orders(side, unit=unit, price=prices, user_id=[0] * k)
+
+        elif r < 0.85:
+            order_id = ids.pop(rng.integers(len(ids)))
+            M.cancel(order_id)
+            R.cancel(order_id)
+
+        else:
+            order_id = ids[rng.integers(len(ids))]
+            price = float(rng.uniform(1, 20))
+            M.modify(order_id, price=price)
+            R.modify(order_id, price=price)
+
+        bids, asks = R.book._get_bids(), R.book._get_asks()
+        if len(bids) and len(asks):
+            expected = ba.reference_clearing(bids.tolist(), asks.tolist())
+            assert np.allclose(M.indicative_price(), expected), (trial, step)
+
+print("Incremental clearing: OK")
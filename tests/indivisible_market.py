@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+from marketlib.markets import pool
+from marketlib.utils import parallel
+
+allocation_methods = ["proportional", "uniform", "price", "welfare"]
+
+def check(bids, asks, volume):
+    """ Clear one indivisible book with every allocation method.
+
+    Asserts whole-unit allocations of the given volume that never exceed the
+    whole units a user offered, and the same volume from PoolMarket,
+    clear_markets() and parallel_clearing().
+    """
+
+    orders = pd.DataFrame({"Market" : 0,
+                           "Unit" : [u for u, _, _ in bids + asks],
+                           "Price" : [p for _, p, _ in bids + asks],
+                           "Type" : ["bid"] * len(bids) + ["ask"] * len(asks),
+                           "User" : [i for _, _, i in bids + asks]})
+
+    for alloc_type in allocation_methods:
+        M = pool.PoolMarket(alloc_type=alloc_type, divisible=False)
+        M.add_orders("bid", unit=[u for u, _, _ in bids], price=[p for _, p, _ in bids],
+                     user_id=[i for _, _, i in bids])
+        M.add_orders("ask", unit=[u for u, _, _ in asks], price=[p for _, p, _ in asks],
+                     user_id=[i for _, _, i in asks])
+        M.clearing()
+
+        assert M.indicative_price()[1] == volume
+
+        for result, side in [(M.alloc_buyer, bids), (M.alloc_seller, asks)]:
+            offered = orders[orders["User"].isin([i for _, _, i in side])].groupby("User")["Unit"].sum()
+            assert np.all(np.isfinite(result.units))
+            assert np.all(result.units == np.floor(result.units))
+            assert np.all(result.units <= np.floor(offered[result.users].to_numpy()))
+            assert result.units.sum() == volume
+
+        info, buyers, sellers = pool.clear_markets(orders, alloc_type=alloc_type, divisible=False)
+        assert info["Volume"].tolist() == [volume]
+        assert buyers["Units Bought"].sum() == sellers["Units Sold"].sum() == volume
+
+        buyers, sellers = parallel.parallel_clearing(orders, alloc_type=alloc_type, divisible=False, workers=1)
+        assert buyers["Units Bought"].sum() == sellers["Units Sold"].sum() == volume
+
+if __name__ == "__main__":
+
+    # Two bids of 2.5 units share a 5-unit ask: 5 units clear, but each buyer
+    # offers 2 whole units, so no one may get 3.
+    check([(2.5, 2.0, 0), (2.5, 2.0, 1)], [(5.0, 1.0, 2)], 4)
+
+    # Fractional orders only: no whole unit to trade.
+    check([(0.5, 2.0, 0), (0.5, 2.0, 1)], [(0.5, 1.0, 2)], 0)
+
+    # An even split would give the 1-unit buyer 2 units.
+    check([(1.0, 2.0, 0), (3.0, 2.0, 1)], [(4.0, 1.0, 2)], 4)
+
+    print("Indivisible markets: OK")
@@ -0,0 +1,78 @@
+import numpy as np
+import networkx as nx  # type: ignore
+from marketlib.markets import bilateral
+from marketlib.utils import matching as match
+
+rng = np.random.default_rng(1)
+
+def best_profit(indptr, indices, buyer_units, buyer_prices, seller_units, seller_prices):
+    """ The largest total of (bid - ask) * units over the edges (networkx min-cost flow).
+
+    Units go source -> buyer -> seller -> sink; a bypass edge lets any unit stay unsold.
+    """
+    total = int(buyer_units.sum())
+
+    G = nx.DiGraph()
+    G.add_node("source", demand=-total)
+    G.add_node("sink", demand=total)
+    G.add_edge("source", "sink", capacity=total, weight=0)
+
+    for i in range(len(buyer_units)):
+        G.add_edge("source", ("buyer", i), capacity=int(buyer_units[i]), weight=-int(buyer_prices[i]))
+        for j in indices[indptr[i]:indptr[i + 1]]:
+            G.add_edge(("buyer", i), ("seller", int(j)), capacity=total, weight=0)
+
+    for j in range(len(seller_units)):
+        G.add_edge(("seller", j), "sink", capacity=int(seller_units[j]), weight=int(seller_prices[j]))
+
+    return -nx.min_cost_flow_cost(G)
+
+def check(flows, allowed, buyer_units, buyer_prices, seller_units, seller_prices):
+    """ The profit of flows that stay on the allowed pairs and within the units.
+    """
+    sent, received = np.zeros(len(buyer_units)), np.zeros(len(seller_units))
+    for i, j, units in flows:
+        assert allowed[i, j] and units > 0
+        sent[i] += units
+        received[j] += units
+
+    assert np.all(sent <= buyer_units) and np.all(received <= seller_units)
+    return sum((buyer_prices[i] - seller_prices[j]) * units for i, j, units in flows)
+
+# Successive shortest paths on random candidate graphs, and the sorted
+# transport on complete ones.
+for _ in range(300):
+    n_buyers, n_sellers = rng.integers(1, 9, 2)
+    buyer_units = rng.integers(1, 6, n_buyers).astype(float)
+    seller_units = rng.integers(1, 6, n_sellers).astype(float)
+    buyer_prices = rng.integers(1, 8, n_buyers).astype(float)
+    seller_prices = rng.integers(1, 8, n_sellers).astype(float)
+    sides = (buyer_units, buyer_prices, seller_units, seller_prices)
+
+    crossing = buyer_prices[:, None] >= seller_prices[None, :]
+    for allowed in (crossing & (rng.random((n_buyers, n_sellers)) < 0.5), crossing):
+        indptr = np.concatenate(([0], np.cumsum(allowed.sum(axis=1))))
+        indices = np.nonzero(allowed)[1]
+
+        flows = match._successive_shortest_paths(indptr, indices, *sides)
+        assert np.isclose(check(flows, allowed, *sides), best_profit(indptr, indices, *sides))
+
+    flows = match._transport_sorted(*sides)
+    assert np.isclose(check(flows, crossing, *sides), best_profit(indptr, indices, *sides))
+
+# Allocations of a bilateral market stay within the units of each user.
+for top_k in (None, 2):
+    M = bilateral.BilateralMarket(matching_type="transport", sparse=top_k is not None, top_k=top_k)
+    M.add_orders("bid", unit=rng.integers(1, 6, 40).astype(float), price=rng.integers(1, 8, 40).astype(float),
+                 user_id=rng.integers(0, 10, 40))
+    M.add_orders("ask", unit=rng.integers(1, 6, 40).astype(float), price=rng.integers(1, 8, 40).astype(float),
+                 user_id=rng.integers(100, 110, 40))
+    M.clearing()
+
+    for result, side in [(M.alloc_buyer, "bid"), (M.alloc_seller, "ask")]:
+        users, totals, _ = M.book.user_summary(side)
+        offered = dict(zip(users.tolist(), totals.tolist()))
+        for user in set(result.users.tolist()):
+            assert result.units[result.users == user].sum() <= offered[user] + 1e-9
+
+print("Transport matching: OK")